@@ -0,0 +1,191 @@
+##############################################################################
+# Import necessary modules and files
+##############################################################################
+
+# The one-hot encoder of the lead features, shared by the training and the
+# inference pipelines so both encode 'model_input' with the same code: the
+# training pipeline fits it and logs its vocabulary with the model, and the
+# inference pipeline loads that vocabulary back and transforms with it. They
+# import it from the dags folder as lead_scoring_data_pipeline.feature_encoding,
+# so it only imports table_writer, relatively when it is imported as part of
+# the package.
+
+
+import json
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+if __package__:
+    from .table_writer import write_table
+else:
+    from table_writer import write_table
+
+
+###############################################################################
+# Define the sparse one-hot encoder
+###############################################################################
+
+def fit_encoder(df, features_to_encode, features, output='sparse'):
+    '''
+    This function fits the one-hot encoder on the training data: the
+    vocabulary of every column in features_to_encode is the sorted list of
+    its levels in df followed by an 'others' level, which the levels unseen
+    at training time (and nulls) are encoded as. The remaining columns of
+    features are passed through as numbers.
+
+    The position of a level in its vocabulary is also its integer code when
+    the columns are encoded as 'codes' for LightGBM's native categorical
+    splits, so the saved encoder is the stable code mapping of the model.
+
+    INPUTS
+        df : dataframe with the columns of features, e.g. the 'model_input' table
+        features_to_encode : columns to one-hot encode
+        features : columns of the model, before encoding
+        output : default output of transform_features for this encoder,
+                 'sparse', 'dense' or 'codes'
+
+    OUTPUT
+        Dictionary with the 'numeric_features' passed through, the
+        'vocabulary' of every encoded column and the 'output', which can be
+        saved as json with save_encoder.
+
+    SAMPLE USAGE
+        encoder = fit_encoder(df_model_input, FEATURES_TO_ENCODE, ONE_HOT_ENCODED_FEATURES)
+    '''
+    vocabulary = {}
+    for column in features_to_encode:
+        levels = sorted({str(level) for level in df[column].dropna().unique()} - {'others'})
+        vocabulary[column] = levels + ['others']
+    return {'numeric_features': [column for column in features if column not in features_to_encode],
+            'vocabulary': vocabulary,
+            'output': output}
+
+
+def get_encoded_feature_names(encoder, output=None):
+    '''
+    Returns the names of the columns transform_features outputs for encoder:
+    the numeric features followed by one '<column>_<level>' column per level
+    of every encoded column (the names pd.get_dummies gives them), or by the
+    encoded columns themselves for the 'codes' output. output defaults to
+    the output of the encoder.
+    '''
+    if (output or encoder['output']) == 'codes':
+        return encoder['numeric_features'] + list(encoder['vocabulary'])
+    return encoder['numeric_features'] + [f"{column}_{level}" for column, levels in encoder['vocabulary'].items()
+                                          for level in levels]
+
+
+def get_level_codes(values, levels):
+    '''
+    Returns the position of every value in levels, with the values not in
+    levels (and nulls) given the position of the last level, 'others'. The
+    values are factorized first, so only their distinct values are looked
+    up in levels.
+    '''
+    codes, uniques = pd.factorize(values)
+    # the last position is the one of the nulls (code -1)
+    unique_positions = np.append(pd.Index(levels).get_indexer(uniques.map(str)), -1)
+    unique_positions[unique_positions == -1] = len(levels) - 1
+    return unique_positions[codes]
+
+
+def transform_features(df, encoder, output=None):
+    '''
+    This function encodes df with a fitted encoder in one vectorized pass,
+    without building a dummy column per level and reindexing the wide frame:
+    the level of every row is looked up once per encoded column and the
+    one-hot positions are written straight into the output. Every row has
+    exactly one non zero per encoded column, so the sparse output holds only
+    the numeric values and one 1 per encoded column.
+
+    INPUTS
+        df : dataframe with the columns of the encoder
+        encoder : encoder returned by fit_encoder or load_encoder
+        output : 'sparse' for a scipy CSR matrix (float32), 'dense' for a
+                 dataframe with the numeric features followed by uint8
+                 one-hot columns, 'codes' for a dataframe with the numeric
+                 features followed by the int32 level code of every encoded
+                 column (for LightGBM's native categorical splits). Defaults
+                 to the output of the encoder.
+
+    OUTPUT
+        CSR matrix or dataframe with the columns of get_encoded_feature_names
+
+    SAMPLE USAGE
+        X = transform_features(df_model_input, encoder)
+    '''
+    numeric_features, vocabulary = encoder['numeric_features'], encoder['vocabulary']
+    output = output or encoder['output']
+    n_rows = len(df)
+
+    if output == 'codes':
+        df_codes = pd.DataFrame({column: get_level_codes(df[column], levels).astype(np.int32)
+                                 for column, levels in vocabulary.items()}, index=df.index)
+        return pd.concat([df[numeric_features].astype(float), df_codes], axis=1)
+
+    offsets = np.cumsum([len(numeric_features)] + [len(levels) for levels in vocabulary.values()])
+    positions = [offset + get_level_codes(df[column], levels)
+                 for offset, (column, levels) in zip(offsets, vocabulary.items())]
+    n_columns = offsets[-1]
+
+    if output == 'dense':
+        one_hot = np.zeros((n_rows, n_columns - len(numeric_features)), dtype=np.uint8)
+        for column_positions in positions:
+            one_hot[np.arange(n_rows), column_positions - len(numeric_features)] = 1
+        one_hot_columns = get_encoded_feature_names(encoder, output)[len(numeric_features):]
+        df_encoded = pd.DataFrame(one_hot, columns=one_hot_columns, index=df.index)
+        return pd.concat([df[numeric_features].astype(float), df_encoded], axis=1)
+    if output != 'sparse':
+        raise ValueError(f"output must be 'sparse', 'dense' or 'codes', got {output!r}")
+
+    values = np.column_stack([df[numeric_features].to_numpy(dtype=np.float32),
+                              np.ones((n_rows, len(positions)), dtype=np.float32)])
+    indices = np.column_stack([np.tile(np.arange(len(numeric_features)), (n_rows, 1))] + positions)
+    indptr = np.arange(0, values.size + 1, values.shape[1])
+    X = sparse.csr_matrix((values.ravel(), indices.ravel(), indptr), shape=(n_rows, n_columns))
+    X.eliminate_zeros()
+    return X
+
+
+def save_encoder(encoder, file_path):
+    '''
+    Saves encoder as json at file_path.
+    '''
+    with open(file_path, 'w') as f:
+        json.dump(encoder, f, indent=2)
+
+
+def load_encoder(file_path):
+    '''
+    Returns the encoder saved as json at file_path by save_encoder.
+    '''
+    with open(file_path) as f:
+        return json.load(f)
+
+
+###############################################################################
+# Define functions to save and load the encoded features
+###############################################################################
+
+def save_encoded_features(cnx, features, file_path):
+    '''
+    Saves the output of transform_features: a CSR matrix is saved to
+    file_path with scipy.sparse.save_npz (a table would need a column per
+    level), a dataframe is saved in the 'features' table.
+    '''
+    if sparse.issparse(features):
+        sparse.save_npz(file_path, features)
+    else:
+        write_table(cnx, 'features', features)
+
+
+def load_encoded_features(cnx, encoder, file_path):
+    '''
+    Returns the features saved by save_encoded_features for encoder, as a
+    CSR matrix for the 'sparse' output or as a dataframe with the columns of
+    get_encoded_feature_names(encoder) for the others.
+    '''
+    if encoder['output'] == 'sparse':
+        return sparse.load_npz(file_path).tocsr()
+    return pd.read_sql('select * from features', cnx)[get_encoded_feature_names(encoder)]
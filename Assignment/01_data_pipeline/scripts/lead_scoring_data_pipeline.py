@@ -23,6 +23,8 @@ default_args = {
 }
 
 
+# Only one of this DAG and Lead_Scoring_Sharded_Data_Engineering_Pipeline should
+# run, both write model_input, interactions_mapped and lead_hashes in the same db
 ML_data_cleaning_dag = DAG(
                 dag_id = 'Lead_Scoring_Data_Engineering_Pipeline',
                 default_args = default_args,
@@ -31,13 +33,17 @@ ML_data_cleaning_dag = DAG(
                 catchup = False
 )
 
+# With USE_ARTIFACT_STORE the cleaning tasks hand their outputs to each other as
+# stage artifacts of the DAG run (templated with the run id) instead of db tables
+stage_kwargs = {'artifact_run_id': '{{ run_id }}'} if utils.USE_ARTIFACT_STORE else {}
+
 ###############################################################################
 # Create a task for build_dbs() function with task_id 'building_db'
 ###############################################################################
 op_build_dbs = PythonOperator(task_id='build_dbs',
                               python_callable=utils.build_dbs,
                               op_kwargs={},
-                              dag=dag)
+                              dag=ML_data_cleaning_dag)
 
 ###############################################################################
 # Create a task for raw_data_schema_check() function with task_id 'checking_raw_data_schema'
@@ -45,50 +51,65 @@ op_build_dbs = PythonOperator(task_id='build_dbs',
 op_check_raw_data_schema = PythonOperator(task_id='check_raw_data_schema',
                                           python_callable=data_validation_checks.raw_data_schema_check,
                                           op_kwargs={},
-                                          dag=dag)
+                                          dag=ML_data_cleaning_dag)
 
 ###############################################################################
 # Create a task for load_data_into_db() function with task_id 'loading_data'
 ##############################################################################
 op_load_data_into_db = PythonOperator(task_id='load_data_into_db',
                               python_callable=utils.load_data_into_db,
-                              op_kwargs={},
-                              dag=dag)
+                              op_kwargs=stage_kwargs,
+                              dag=ML_data_cleaning_dag)
 
 ###############################################################################
 # Create a task for map_city_tier() function with task_id 'mapping_city_tier'
 ###############################################################################
 op_map_city_tier = PythonOperator(task_id='map_city_tier',
                               python_callable=utils.map_city_tier,
-                              op_kwargs={},
-                              dag=dag)
+                              op_kwargs=stage_kwargs,
+                              dag=ML_data_cleaning_dag)
 
 ###############################################################################
 # Create a task for map_categorical_vars() function with task_id 'mapping_categorical_vars'
 ###############################################################################
 op_map_categorical_vars = PythonOperator(task_id='map_categorical_vars',
                               python_callable=utils.map_categorical_vars,
-                              op_kwargs={},
-                              dag=dag)
+                              op_kwargs=stage_kwargs,
+                              dag=ML_data_cleaning_dag)
 
 ###############################################################################
 # Create a task for interactions_mapping() function with task_id 'mapping_interactions'
 ###############################################################################
 op_interactions_mapping = PythonOperator(task_id='interactions_mapping',
                               python_callable=utils.interactions_mapping,
-                              op_kwargs={},
-                              dag=dag)
+                              op_kwargs=stage_kwargs,
+                              dag=ML_data_cleaning_dag)
 
 ###############################################################################
 # Create a task for model_input_schema_check() function with task_id 'checking_model_inputs_schema'
 ###############################################################################
 op_check_model_input_schema = PythonOperator(task_id='check_model_input_schema',
                                           python_callable=data_validation_checks.model_input_schema_check,
-                                          op_kwargs={},
-                                          dag=dag)
+                                          op_kwargs=stage_kwargs,
+                                          dag=ML_data_cleaning_dag)
 
 ###############################################################################
 # Define the relation between the tasks
 ###############################################################################
 
 
+
+op_build_dbs >> op_check_raw_data_schema >> op_load_data_into_db >> op_map_city_tier \
+    >> op_map_categorical_vars >> op_interactions_mapping >> op_check_model_input_schema
+
+###############################################################################
+# Create a task for clean_up_artifacts() function with task_id 'clean_up_artifacts'
+###############################################################################
+# Deletes the stage artifacts of the run once every task succeeded, the
+# artifacts of a failed run are kept to retry it (see ARTIFACT_KEEP_RUNS)
+if utils.USE_ARTIFACT_STORE:
+    op_clean_up_artifacts = PythonOperator(task_id='clean_up_artifacts',
+                                           python_callable=utils.clean_up_artifacts,
+                                           op_kwargs=stage_kwargs,
+                                           dag=ML_data_cleaning_dag)
+    op_check_model_input_schema >> op_clean_up_artifacts
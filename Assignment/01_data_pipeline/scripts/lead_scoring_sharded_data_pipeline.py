@@ -0,0 +1,109 @@
+##############################################################################
+# Import necessary modules
+# #############################################################################
+
+
+from airflow import DAG
+from airflow.operators.python import PythonOperator
+
+from datetime import datetime, timedelta
+import utils
+import data_validation_checks
+
+
+###############################################################################
+# Define default arguments and DAG
+###############################################################################
+
+default_args = {
+    'owner': 'airflow',
+    'start_date': datetime(2024,8,18),
+    'retries' : 1,
+    'retry_delay' : timedelta(seconds=5)
+}
+
+
+# Sharded variant of Lead_Scoring_Data_Engineering_Pipeline: the leads are split
+# into DAG_SHARD_COUNT shards by created_date and one clean_shard task is mapped
+# over every shard, so the shards are cleaned in parallel (up to
+# max_active_tasks_per_dag at a time, with an executor that runs tasks in
+# parallel like the LocalExecutor; the SequentialExecutor runs them one by one).
+# Both DAGs write model_input, interactions_mapped and lead_hashes in the same
+# db, so only one of them should run: this one is not scheduled and is
+# triggered manually, unpause it in place of the @daily linear DAG
+ML_data_cleaning_sharded_dag = DAG(
+                dag_id = 'Lead_Scoring_Sharded_Data_Engineering_Pipeline',
+                default_args = default_args,
+                description = 'DAG to run data pipeline for lead scoring on shards of the leads in parallel',
+                schedule_interval = None,
+                catchup = False
+)
+
+# The tasks hand the shards to each other as stage artifacts of the DAG run
+run_kwargs = {'artifact_run_id': '{{ run_id }}'}
+
+###############################################################################
+# Create a task for build_dbs() function with task_id 'building_db'
+###############################################################################
+op_build_dbs = PythonOperator(task_id='build_dbs',
+                              python_callable=utils.build_dbs,
+                              op_kwargs={},
+                              dag=ML_data_cleaning_sharded_dag)
+
+###############################################################################
+# Create a task for raw_data_schema_check() function with task_id 'checking_raw_data_schema'
+###############################################################################
+op_check_raw_data_schema = PythonOperator(task_id='check_raw_data_schema',
+                                          python_callable=data_validation_checks.raw_data_schema_check,
+                                          op_kwargs={},
+                                          dag=ML_data_cleaning_sharded_dag)
+
+###############################################################################
+# Create a task for split_leads_into_shards() function with task_id 'split_leads_into_shards'
+###############################################################################
+op_split_leads_into_shards = PythonOperator(task_id='split_leads_into_shards',
+                              python_callable=utils.split_leads_into_shards,
+                              op_kwargs=run_kwargs,
+                              dag=ML_data_cleaning_sharded_dag)
+
+###############################################################################
+# Map a clean_shard() task over the shards returned by split_leads_into_shards
+###############################################################################
+op_clean_shard = PythonOperator.partial(task_id='clean_shard',
+                              python_callable=utils.clean_shard,
+                              dag=ML_data_cleaning_sharded_dag).expand(op_kwargs=op_split_leads_into_shards.output)
+
+###############################################################################
+# Create a task for merge_shards() function with task_id 'merge_shards'
+###############################################################################
+op_merge_shards = PythonOperator(task_id='merge_shards',
+                              python_callable=utils.merge_shards,
+                              op_kwargs=run_kwargs,
+                              dag=ML_data_cleaning_sharded_dag)
+
+###############################################################################
+# Create a task for model_input_schema_check() function with task_id 'checking_model_inputs_schema'
+###############################################################################
+op_check_model_input_schema = PythonOperator(task_id='check_model_input_schema',
+                                          python_callable=data_validation_checks.model_input_schema_check,
+                                          op_kwargs=run_kwargs,
+                                          dag=ML_data_cleaning_sharded_dag)
+
+###############################################################################
+# Create a task for clean_up_artifacts() function with task_id 'clean_up_artifacts'
+###############################################################################
+# Deletes the shard artifacts of the run once every task succeeded, the
+# artifacts of a failed run are kept to retry it (see ARTIFACT_KEEP_RUNS)
+op_clean_up_artifacts = PythonOperator(task_id='clean_up_artifacts',
+                                       python_callable=utils.clean_up_artifacts,
+                                       op_kwargs=run_kwargs,
+                                       dag=ML_data_cleaning_sharded_dag)
+
+###############################################################################
+# Define the relation between the tasks
+###############################################################################
+
+
+
+op_build_dbs >> op_check_raw_data_schema >> op_split_leads_into_shards >> op_clean_shard \
+    >> op_merge_shards >> op_check_model_input_schema >> op_clean_up_artifacts
@@ -21,3 +21,43 @@ raw_data_schema = ['created_date', 'city_mapped', 'first_platform_c',
 model_input_schema = ['total_leads_droppped', 'city_tier', 'referred_lead', 
                     'first_platform_c', 'first_utm_medium_c', 'first_utm_source_c', 
                     'app_complete_flag']
+
+
+# compact dtypes used when reading the raw data, one per column of raw_data_schema.
+# Counts and interaction flags can be missing so they are read as float32. Cities
+# are categoricals so their tiers are looked up once per distinct city.
+raw_data_dtypes = {column: 'float32' for column in raw_data_schema}
+raw_data_dtypes.update({'created_date': 'datetime64[ns]',
+                        'city_mapped': 'category',
+                        'first_platform_c': 'category',
+                        'first_utm_medium_c': 'category',
+                        'first_utm_source_c': 'category',
+                        'app_complete_flag': 'int8'})
+
+
+# value domains checked by the validation pass: a set of allowed values or a
+# regular expression every non null value has to match
+raw_data_domains = {'first_platform_c': r'Level\d+',
+                    'first_utm_medium_c': r'Level\d+',
+                    'first_utm_source_c': r'Level\d+',
+                    'referred_lead': {0, 1},
+                    'app_complete_flag': {0, 1}}
+
+model_input_dtypes = {'total_leads_droppped': 'float32',
+                      'city_tier': 'float32',
+                      'referred_lead': 'float32',
+                      'first_platform_c': 'category',
+                      'first_utm_medium_c': 'category',
+                      'first_utm_source_c': 'category',
+                      'app_complete_flag': 'int8'}
+
+model_input_domains = {'city_tier': {1, 2, 3},
+                       'first_platform_c': r'Level\d+|others',
+                       'first_utm_medium_c': r'Level\d+|others',
+                       'first_utm_source_c': r'Level\d+|others',
+                       'referred_lead': {0, 1},
+                       'app_complete_flag': {0, 1}}
+
+# highest share of nulls allowed in a column, columns not listed aren't limited
+raw_data_max_null_rates = {'created_date': 0.0, 'app_complete_flag': 0.0}
+model_input_max_null_rates = {column: 0.0 for column in model_input_schema}
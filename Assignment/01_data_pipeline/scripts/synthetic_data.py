@@ -0,0 +1,178 @@
+##############################################################################
+# Import necessary modules and files
+##############################################################################
+
+
+import pandas as pd
+import numpy as np
+from constants import *
+from schema import raw_data_schema
+from mapping.city_tier_mapping import city_tier_mapping
+from mapping.significant_categorical_level import significant_levels_by_column
+
+
+###############################################################################
+# Define the shape of the synthetic lead data
+###############################################################################
+
+# number of distinct levels of the categorical columns (as seen in
+# leadscoring_inference.csv). The significant levels get the most leads and
+# the remaining levels share a long tail.
+SYNTHETIC_LEVEL_COUNTS = {'first_platform_c': 47,
+                          'first_utm_medium_c': 364,
+                          'first_utm_source_c': 123}
+
+# exponent of the Zipf-like skew of the categorical columns and cities
+SYNTHETIC_SKEW = 1.1
+
+# share of leads without a city, with a null 'referred_lead', referred by
+# someone and with the app completed
+SYNTHETIC_CITY_NULL_RATE = 0.04
+SYNTHETIC_REFERRED_NULL_RATE = 0.004
+SYNTHETIC_REFERRED_RATE = 0.033
+SYNTHETIC_APP_COMPLETE_RATE = 0.5
+
+# success probability of the geometric distribution of 'total_leads_droppped'
+SYNTHETIC_LEADS_DROPPED_P = 0.62
+
+# columns holding the interactions of a lead with the website
+INTERACTION_COLUMNS = raw_data_schema[raw_data_schema.index('referred_lead') + 1:
+                                      raw_data_schema.index('app_complete_flag')]
+
+
+###############################################################################
+# Define function to write a synthetic leadscoring file
+###############################################################################
+
+def generate_synthetic_leads(file_path, n_rows, seed=0, chunk_size=CHUNK_SIZE,
+                             start_date='2021-07-01', end_date='2022-02-14',
+                             interaction_rate=0.0003):
+    '''
+    This function writes a csv file of n_rows synthetic leads with the columns
+    of raw_data_schema, to load test the pipelines at sizes the real files
+    don't reach (1e4 to 1e8 rows).
+
+    The leads are generated and appended to the file chunk_size rows at a
+    time, so memory is bounded by the chunk size and not by n_rows. Every
+    chunk draws from its own random generator seeded with (seed, chunk
+    number), so the same seed and chunk_size always write the same file.
+
+    The columns follow the shape of the real data:
+        created_date : uniform between start_date and end_date
+        city_mapped : cities of city_tier_mapping with a Zipf-like skew and
+                      SYNTHETIC_CITY_NULL_RATE nulls
+        first_platform_c, first_utm_medium_c, first_utm_source_c : 'LevelN'
+                      values with a Zipf-like skew where the significant levels
+                      of significant_levels_by_column are the most frequent
+        total_leads_droppped : geometric, 1 for most of the leads
+        referred_lead, app_complete_flag : 0/1 flags
+        interaction columns : sparse, each value is 1.0 with probability
+                      interaction_rate and null otherwise
+
+
+    INPUTS
+        file_path : path of the csv file to write, replaced if it exists
+        n_rows : number of leads to write
+        seed : seed of the random generators
+        chunk_size : number of leads generated and written at a time
+        start_date, end_date : range of 'created_date'
+        interaction_rate : share of non null values of the interaction columns
+
+
+    OUTPUT
+        Writes the leads to file_path and returns the number of rows written.
+
+
+    SAMPLE USAGE
+        generate_synthetic_leads(f"{DATA_DIRECTORY}/leadscoring_1e6.csv", 1000000, seed=42)
+    '''
+    level_choices = {column: get_skewed_choices(get_level_names(column, n_levels))
+                     for column, n_levels in SYNTHETIC_LEVEL_COUNTS.items()}
+    city_choices = get_skewed_choices(list(city_tier_mapping))
+    start, end = pd.Timestamp(start_date).value // 10**9, pd.Timestamp(end_date).value // 10**9
+    flag_cells = np.array(['0.0', '1.0', ''], dtype=object)
+
+    with open(file_path, 'w', newline='') as f:
+        f.write(",".join(raw_data_schema) + "\n")
+        for chunk_number, chunk_start in enumerate(range(0, n_rows, chunk_size)):
+            rng = np.random.default_rng([seed, chunk_number])
+            n = min(chunk_size, n_rows - chunk_start)
+
+            created_date = pd.to_datetime(rng.integers(start, end, n), unit='s').strftime('%Y-%m-%d %H:%M:%S')
+            city_mapped = draw_skewed(rng, city_choices, n, SYNTHETIC_CITY_NULL_RATE)
+            levels = [draw_skewed(rng, choices, n) for choices in level_choices.values()]
+            leads_dropped = rng.geometric(SYNTHETIC_LEADS_DROPPED_P, n)
+            referred_lead = np.where(rng.random(n) < SYNTHETIC_REFERRED_NULL_RATE, 2,
+                                     (rng.random(n) < SYNTHETIC_REFERRED_RATE).astype(int))
+            interactions = draw_sparse_interactions(rng, n, interaction_rate)
+            app_complete_flag = (rng.random(n) < SYNTHETIC_APP_COMPLETE_RATE).astype(int)
+
+            # The lines are joined from arrays of csv cells: DataFrame.to_csv
+            # spends most of its time formatting the (almost always empty)
+            # interaction columns one cell at a time.
+            cells = [np.asarray(created_date, dtype=object), city_mapped, *levels,
+                     np.array([f"{i}.0" for i in range(leads_dropped.max() + 1)], dtype=object)[leads_dropped],
+                     flag_cells[referred_lead], interactions,
+                     np.array(['0', '1'], dtype=object)[app_complete_flag]]
+            lines = cells[0]
+            for column_cells in cells[1:]:
+                lines = lines + ',' + column_cells
+            f.write("\n".join(lines) + "\n")
+
+    print(f"{n_rows} synthetic leads written to {file_path}.")
+    return n_rows
+
+
+def get_level_names(column, n_levels):
+    '''
+    Returns n_levels 'LevelN' names for column, starting with its significant
+    levels so they get the most leads.
+    '''
+    significant_levels = significant_levels_by_column.get(column, [])
+    other_levels = [f"Level{i}" for i in range(n_levels * 2) if f"Level{i}" not in significant_levels]
+    return (significant_levels + other_levels)[:n_levels]
+
+
+def get_skewed_choices(values):
+    '''
+    Returns values as an array with the cumulative probabilities of a Zipf-like
+    distribution with exponent SYNTHETIC_SKEW over them, the first value being
+    the most likely.
+    '''
+    weights = 1.0 / np.arange(1, len(values) + 1) ** SYNTHETIC_SKEW
+    return np.array(values, dtype=object), np.cumsum(weights / weights.sum())
+
+
+def draw_skewed(rng, choices, n, null_rate=0.0):
+    '''
+    Returns n values drawn from choices (as returned by get_skewed_choices),
+    with null_rate of them replaced by an empty (null) cell.
+    '''
+    values, cumulative_probabilities = choices
+    positions = np.searchsorted(cumulative_probabilities, rng.random(n), side='right')
+    drawn = values[np.minimum(positions, len(values) - 1)]
+    if null_rate:
+        drawn[rng.random(n) < null_rate] = ''
+    return drawn
+
+
+def draw_sparse_interactions(rng, n, interaction_rate):
+    '''
+    Returns the csv cells of INTERACTION_COLUMNS for n leads as one string
+    per lead, where each value is 1.0 with probability interaction_rate and
+    null otherwise. Only the positions of the non null values are drawn and
+    only the leads with an interaction get their own string, so the cost grows
+    with the number of interactions and not with n times the number of
+    columns.
+    '''
+    n_columns = len(INTERACTION_COLUMNS)
+    cells = np.full(n, ',' * (n_columns - 1), dtype=object)
+    n_interactions = rng.binomial(n * n_columns, interaction_rate)
+    positions = np.unique(rng.integers(0, n * n_columns, n_interactions))
+    rows, columns = np.divmod(positions, n_columns)
+    for row in np.unique(rows):
+        row_cells = [''] * n_columns
+        for column in columns[rows == row]:
+            row_cells[column] = '1.0'
+        cells[row] = ','.join(row_cells)
+    return cells
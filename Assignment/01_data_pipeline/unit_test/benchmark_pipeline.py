@@ -0,0 +1,222 @@
+##############################################################################
+# Import necessary modules and files
+##############################################################################
+
+
+import argparse
+import inspect
+import json
+import os
+import sqlite3
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime
+import pandas as pd
+import utils
+import data_validation_checks
+from synthetic_data import generate_synthetic_leads
+
+
+###############################################################################
+# Define the benchmark settings
+###############################################################################
+
+# stages benchmarked, in the order they run in the data pipeline DAG
+BENCHMARK_STAGES = [data_validation_checks.raw_data_schema_check,
+                    utils.load_data_into_db,
+                    utils.map_city_tier,
+                    utils.map_categorical_vars,
+                    utils.interactions_mapping,
+                    data_validation_checks.model_input_schema_check]
+
+# numbers of synthetic leads the stages are benchmarked on
+BENCHMARK_SCALES = [10000, 100000]
+
+# metrics compared against the baseline
+BENCHMARK_METRICS = ['wall_seconds', 'cpu_seconds', 'peak_traced_bytes']
+
+# json file with the baseline results, kept in the repo next to this file
+BENCHMARK_BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+
+###############################################################################
+# Define function to benchmark the data cleaning stages
+###############################################################################
+
+def run_benchmarks(scales=BENCHMARK_SCALES, repeats=3, seed=0):
+    '''
+    This function times and memory profiles the stages in BENCHMARK_STAGES on
+    synthetic lead files of every size in scales. For every scale a file is
+    generated with generate_synthetic_leads in a temporary directory and the
+    stages run against a db there, with the stage cache turned off. The
+    measurements are the ones instrument_stage saves in the 'stage_metrics'
+    table.
+
+    The stages are timed over repeats runs without tracemalloc, keeping the
+    fastest wall and CPU time, and then run once more with tracemalloc for
+    their peak memory. Tracing every allocation makes the stages that create
+    many small python objects (like the string columns of the schema checks)
+    several times slower, so traced runs are never timed.
+
+
+    INPUTS
+        scales : list of the numbers of leads to benchmark on
+        repeats : number of runs of every stage at every scale
+        seed : seed of the synthetic lead files
+
+
+    OUTPUT
+        Dictionary with the settings of the run and a 'results' list with one
+        entry per scale and stage, ready to be saved as json.
+
+
+    SAMPLE USAGE
+        results = run_benchmarks(scales=[10000], repeats=1)
+    '''
+    results = []
+    for scale in scales:
+        with tempfile.TemporaryDirectory() as directory:
+            generate_synthetic_leads(f"{directory}/leadscoring_test.csv", scale, seed=seed)
+            with benchmark_settings(directory + '/'):
+                utils.build_dbs()
+                for run in range(repeats + 1):
+                    utils.TRACE_STAGE_MEMORY = run == repeats
+                    for stage in BENCHMARK_STAGES:
+                        if 'use_cache' in inspect.signature(stage).parameters:
+                            stage(use_cache=False)
+                        else:
+                            stage()
+
+                conn = sqlite3.connect(f"{directory}/{utils.DB_FILE_NAME}")
+                metrics = pd.read_sql("SELECT * FROM stage_metrics", conn)
+                conn.close()
+
+        stage_names = [stage.__name__ for stage in BENCHMARK_STAGES]
+        metrics = metrics[metrics['stage'].isin(stage_names)]
+        timed = metrics[metrics['peak_traced_bytes'].isna()]
+        summary = timed.groupby('stage').agg(wall_seconds=('wall_seconds', 'min'),
+                                             cpu_seconds=('cpu_seconds', 'min'),
+                                             rows_out=('rows_out', 'max'))
+        summary['peak_traced_bytes'] = metrics.groupby('stage')['peak_traced_bytes'].max()
+        summary = summary.reindex(stage_names)[['wall_seconds', 'cpu_seconds', 'peak_traced_bytes', 'rows_out']]
+        for stage, row in summary.iterrows():
+            results.append({'scale': scale, 'stage': stage,
+                            **{column: None if pd.isna(value) else float(value) for column, value in row.items()}})
+        print(f"Benchmarked {len(stage_names)} stages on {scale} leads.")
+
+    return {'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'repeats': repeats,
+            'seed': seed,
+            'results': results}
+
+
+@contextmanager
+def benchmark_settings(directory):
+    '''
+    Points DB_PATH and DATA_DIRECTORY of the pipeline modules at directory
+    inside the with block and turns COUNT_STAGE_ROWS on so the benchmark
+    reports the rows written by every stage, and sets them and
+    TRACE_STAGE_MEMORY back to their values from constants.py after.
+    '''
+    modules = [utils, data_validation_checks]
+    saved = [(module, module.DB_PATH, module.DATA_DIRECTORY) for module in modules]
+    trace_stage_memory, count_stage_rows = utils.TRACE_STAGE_MEMORY, utils.COUNT_STAGE_ROWS
+    try:
+        for module in modules:
+            module.DB_PATH, module.DATA_DIRECTORY = directory, directory
+        utils.COUNT_STAGE_ROWS = True
+        yield directory
+    finally:
+        for module, db_path, data_directory in saved:
+            module.DB_PATH, module.DATA_DIRECTORY = db_path, data_directory
+        utils.TRACE_STAGE_MEMORY, utils.COUNT_STAGE_ROWS = trace_stage_memory, count_stage_rows
+
+
+###############################################################################
+# Define functions to save and compare the benchmark baselines
+###############################################################################
+
+def save_baseline(results, file_path=BENCHMARK_BASELINE_FILE):
+    '''
+    Saves the output of run_benchmarks as the json baseline at file_path.
+    '''
+    with open(file_path, 'w') as f:
+        json.dump(results, f, indent=2)
+        f.write("\n")
+    print(f"Benchmark baseline saved to {file_path}.")
+
+
+def load_baseline(file_path=BENCHMARK_BASELINE_FILE):
+    '''
+    Returns the json baseline saved at file_path by save_baseline.
+    '''
+    with open(file_path) as f:
+        return json.load(f)
+
+
+def compare_benchmarks(results, baseline, threshold=0.25, min_seconds=0.05):
+    '''
+    This function compares the output of run_benchmarks with a baseline and
+    flags every stage, scale and metric of BENCHMARK_METRICS that got worse by
+    more than threshold (a share of the baseline value). Time differences
+    smaller than min_seconds are never flagged, so the timer noise of the
+    fast stages doesn't show up as regressions. Stages or scales missing from
+    the baseline are skipped.
+
+
+    INPUTS
+        results : output of run_benchmarks
+        baseline : baseline loaded with load_baseline
+        threshold : largest relative increase that isn't a regression
+        min_seconds : smallest increase in seconds that can be a regression
+
+
+    OUTPUT
+        Dataframe with the columns 'scale', 'stage', 'metric', 'baseline',
+        'current', 'change' and 'regression', printed with the regressions.
+
+
+    SAMPLE USAGE
+        comparison = compare_benchmarks(run_benchmarks(), load_baseline())
+    '''
+    key = ['scale', 'stage']
+    current = pd.DataFrame(results['results']).melt(id_vars=key, value_vars=BENCHMARK_METRICS,
+                                                    var_name='metric', value_name='current')
+    previous = pd.DataFrame(baseline['results']).melt(id_vars=key, value_vars=BENCHMARK_METRICS,
+                                                      var_name='metric', value_name='baseline')
+    comparison = previous.merge(current, on=key + ['metric']).dropna(subset=['baseline', 'current'])
+    comparison = comparison[key + ['metric', 'baseline', 'current']]
+    comparison['change'] = (comparison['current'] / comparison['baseline'] - 1).round(4)
+
+    increase = comparison['current'] - comparison['baseline']
+    is_time = comparison['metric'].str.endswith('_seconds')
+    comparison['regression'] = (comparison['change'] > threshold) & (~is_time | (increase > min_seconds))
+
+    regressions = comparison[comparison['regression']]
+    if regressions.empty:
+        print(f"No regressions beyond {threshold:.0%} of the baseline.")
+    else:
+        print(f"{len(regressions)} regressions beyond {threshold:.0%} of the baseline:")
+        print(regressions.to_string(index=False))
+    return comparison
+
+
+###############################################################################
+# Run the benchmarks from the command line
+###############################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the data cleaning stages on synthetic leads.')
+    parser.add_argument('--scales', type=int, nargs='+', default=BENCHMARK_SCALES)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--threshold', type=float, default=0.25)
+    parser.add_argument('--baseline', default=BENCHMARK_BASELINE_FILE)
+    parser.add_argument('--save', action='store_true', help='save the results as the new baseline')
+    args = parser.parse_args()
+
+    benchmark_results = run_benchmarks(scales=args.scales, repeats=args.repeats)
+    if args.save:
+        save_baseline(benchmark_results, args.baseline)
+    else:
+        comparison = compare_benchmarks(benchmark_results, load_baseline(args.baseline), threshold=args.threshold)
+        raise SystemExit(1 if comparison['regression'].any() else 0)
@@ -8,6 +8,62 @@ INDEX_COLUMNS_TRAINING = ['created_date', 'first_platform_c', 'first_utm_medium_
 INDEX_COLUMNS_INFERENCE = ['created_date', 'first_platform_c', 'first_utm_medium_c', 'first_utm_source_c', 'total_leads_droppped', 'city_tier', 'referred_lead']
 NOT_FEATURES = []
 
+# write 'loaded_data', 'city_tier_mapped' and 'categorical_variables_mapped' when running the fused pipeline
+WRITE_INTERMEDIATE_TABLES = False
 
+# number of rows of leadscoring.csv read at a time by the streaming stages
+CHUNK_SIZE = 100000
 
+# skip a stage when the fingerprint of its inputs hasn't changed since its last run
+USE_STAGE_CACHE = True
 
+# name of the Prometheus textfile written in DB_PATH with the latest metrics of
+# every stage, whether stages trace their peak memory with tracemalloc (which
+# slows them down many times over) and whether they count the rows of their
+# input and output tables
+STAGE_METRICS_FILE_NAME = 'lead_scoring_data_pipeline.prom'
+TRACE_STAGE_MEMORY = False
+COUNT_STAGE_ROWS = False
+
+# number of distinct raw city names whose normalized form is cached by
+# normalize_city_name
+CITY_NAME_CACHE_SIZE = 65536
+
+# where map_city_tier, map_categorical_vars and interactions_mapping run:
+# 'pandas' reads the tables into dataframes, 'sql' runs the transforms in SQLite
+EXECUTION_BACKEND = 'pandas'
+
+# where the pipeline tables (loaded_data ... model_input) are stored: 'sqlite'
+# keeps them in DB_FILE_NAME, 'duckdb' in a columnar .duckdb file next to it
+# (needs pip install duckdb). The stage metrics, stage cache, lead hashes and
+# watermarks always stay in DB_FILE_NAME.
+STORAGE_BACKEND = 'sqlite'
+
+# hand the stage outputs between the DAG tasks as files in ARTIFACT_DIRECTORY
+# (under DB_PATH, one sub-directory per DAG run id) instead of db tables,
+# written as 'parquet' or 'arrow' (Arrow IPC, memory-mapped on read). Needs
+# pip install pyarrow. 'model_input' is still published to the db at the end
+# of the run if PUBLISH_MODEL_INPUT is True.
+USE_ARTIFACT_STORE = False
+ARTIFACT_DIRECTORY = 'artifacts'
+ARTIFACT_FORMAT = 'parquet'
+PUBLISH_MODEL_INPUT = True
+# the artifacts of a DAG run are deleted by its last task (clean_up_artifacts),
+# which also keeps only the ARTIFACT_KEEP_RUNS latest directories left by runs
+# that failed before it
+ARTIFACT_KEEP_RUNS = 5
+
+# date-partitioned storage of 'loaded_data' and 'model_input' (see
+# load_data_into_partitions): parquet files under PARTITION_DIRECTORY (in
+# DB_PATH), one per 'day' or 'month' of created_date
+PARTITION_DIRECTORY = 'partitions'
+PARTITION_GRANULARITY = 'day'
+
+# number of worker processes of run_parallel_pipeline (None for one per CPU
+# core) and how its shards split the leads by created_date: 'range' or 'hash'
+PARALLEL_WORKERS = None
+PARALLEL_SHARD_BY = 'range'
+
+# number of shards the sharded data pipeline DAG splits the leads into, one
+# mapped clean_shard task per shard
+DAG_SHARD_COUNT = 8
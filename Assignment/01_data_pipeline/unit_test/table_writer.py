@@ -0,0 +1,149 @@
+##############################################################################
+# Import necessary modules and files
+##############################################################################
+
+# The writes of dataframes to the pipeline tables, shared with the training and
+# inference pipelines. The module imports none of the data pipeline's modules,
+# so they can import it as lead_scoring_data_pipeline.table_writer from the
+# dags folder.
+
+
+import numpy as np
+import pandas as pd
+
+try:
+    import duckdb
+except ImportError:
+    # duckdb is only needed when STORAGE_BACKEND is 'duckdb'
+    duckdb = None
+
+# pragmas applied to the db connection before writing tables and the number of
+# rows inserted per executemany call
+SQLITE_PRAGMAS = {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'cache_size': -65536, 'temp_store': 'MEMORY'}
+WRITE_BATCH_SIZE = 50000
+
+###############################################################################
+# Define functions to write dataframes to the database
+###############################################################################
+
+def apply_write_pragmas(conn):
+    '''
+    Applies SQLITE_PRAGMAS (WAL journal, relaxed synchronous, larger page
+    cache, in-memory temp store) to an open connection. Must be called outside
+    of a transaction since the journal mode can't change inside one.
+    '''
+    for pragma, value in SQLITE_PRAGMAS.items():
+        conn.execute(f"PRAGMA {pragma} = {value}")
+
+
+def write_table(conn, table_name, df, if_exists='replace', batch_size=WRITE_BATCH_SIZE):
+    '''
+    Writes df to table_name on an open connection. This is a faster drop-in
+    for df.to_sql(table_name, con=conn, if_exists=if_exists, index=False):
+    the write pragmas are applied, then the old table is dropped (for
+    'replace'), the typed table is created and the rows are inserted with
+    batched executemany calls, all in one transaction. Readers therefore see
+    either the old table or the complete new one, and a failed write leaves
+    the old table untouched.
+
+
+    INPUTS
+        conn : open connection from connect_db (sqlite3 or duckdb)
+        table_name : name of the table to write
+        df : dataframe to write, without its index
+        if_exists : 'replace' to replace the table or 'append' to add the rows
+                    to it. Either way the table is created if it is missing.
+        batch_size : number of rows inserted per executemany call
+
+
+    SAMPLE USAGE
+        write_table(conn, 'loaded_data', df)
+    '''
+    if if_exists not in ('replace', 'append'):
+        raise ValueError(f"if_exists must be 'replace' or 'append', got {if_exists!r}")
+
+    if not is_duckdb_connection(conn):
+        if conn.in_transaction:
+            conn.commit()
+        apply_write_pragmas(conn)
+
+    try:
+        conn.execute("BEGIN")
+        if if_exists == 'replace':
+            conn.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+        insert_dataframe(conn, table_name, df, batch_size)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def insert_dataframe(conn, table_name, df, batch_size=WRITE_BATCH_SIZE):
+    '''
+    Appends the rows of df to table_name on an open connection without
+    committing, so several calls can share one transaction. The table is
+    created from df's schema (INTEGER, REAL, TIMESTAMP or TEXT columns) if it
+    doesn't exist yet, and the rows are inserted batch_size at a time.
+
+    On a duckdb connection the whole frame is inserted in one vectorized
+    INSERT ... SELECT from the registered dataframe instead (see
+    insert_duckdb_dataframe).
+    '''
+    if is_duckdb_connection(conn):
+        insert_duckdb_dataframe(conn, table_name, df)
+        return
+
+    create_query = pd.io.sql.get_schema(df, table_name, con=conn)
+    conn.execute(create_query.replace("CREATE TABLE", "CREATE TABLE IF NOT EXISTS", 1))
+
+    columns = ", ".join(f'"{col}"' for col in df.columns)
+    placeholders = ", ".join("?" for _ in df.columns)
+    insert_query = f'INSERT INTO "{table_name}" ({columns}) VALUES ({placeholders})'
+
+    for start in range(0, len(df), batch_size):
+        batch = df.iloc[start:start + batch_size]
+        conn.executemany(insert_query, zip(*[get_sqlite_values(batch[col]) for col in batch.columns]))
+
+
+def get_sqlite_values(series):
+    '''
+    Returns the values of series as a list of python objects sqlite3 can bind.
+    Numeric and string columns go through tolist() (NaN floats are stored as
+    NULL by sqlite), datetimes are formatted like to_sql does and anything
+    else is boxed to objects with None for nulls.
+    '''
+    if pd.api.types.is_datetime64_any_dtype(series):
+        # the microseconds of NaT are NaN, which mustn't switch the format
+        date_format = '%Y-%m-%d %H:%M:%S.%f' if (series.dt.microsecond > 0).any() else '%Y-%m-%d %H:%M:%S'
+        series = series.dt.strftime(date_format)
+    elif isinstance(series.dtype, np.dtype) and series.dtype.kind in 'biuf':
+        return series.tolist()
+    elif pd.api.types.is_string_dtype(series) and not isinstance(series.dtype, pd.CategoricalDtype):
+        return series.tolist()
+    return series.astype(object).where(series.notna(), None).tolist()
+
+
+def is_duckdb_connection(conn):
+    '''
+    Returns True if conn is a duckdb connection.
+    '''
+    return duckdb is not None and isinstance(conn, duckdb.DuckDBPyConnection)
+
+
+def insert_duckdb_dataframe(conn, table_name, df):
+    '''
+    Appends the rows of df to table_name on a duckdb connection without
+    committing, creating the table from df's schema if it doesn't exist yet.
+    df is registered as a view and copied with one INSERT ... SELECT, so the
+    rows are never bound one by one. Categorical columns are written as
+    their values, as SQLite stores them, rather than as duckdb ENUMs whose
+    levels would differ between chunks.
+    '''
+    categorical_columns = [col for col in df.columns if isinstance(df[col].dtype, pd.CategoricalDtype)]
+    df = df.astype({col: df[col].cat.categories.dtype for col in categorical_columns})
+    conn.register('insert_dataframe_view', df)
+    try:
+        conn.execute(f'CREATE TABLE IF NOT EXISTS "{table_name}" AS SELECT * FROM insert_dataframe_view LIMIT 0')
+        conn.execute(f'INSERT INTO "{table_name}" BY NAME SELECT * FROM insert_dataframe_view')
+    finally:
+        conn.unregister('insert_dataframe_view')
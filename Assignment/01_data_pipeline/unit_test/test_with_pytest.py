@@ -2,11 +2,22 @@
 # Import the necessary modules
 ##############################################################################
 
+import importlib
+import os
+import shutil
+import sys
 import pytest
 import pandas as pd
 import sqlite3
 from utils import *
 from constants import *
+from data_validation_checks import raw_data_schema_check, model_input_schema_check, validate_chunks
+from schema import raw_data_schema, model_input_schema, model_input_dtypes, model_input_domains, model_input_max_null_rates
+from schema import raw_data_dtypes, raw_data_domains, raw_data_max_null_rates
+from synthetic_data import generate_synthetic_leads
+from benchmark_pipeline import run_benchmarks, compare_benchmarks, save_baseline, load_baseline
+from feature_encoding import fit_encoder, transform_features, save_encoder, load_encoder
+from feature_encoding import save_encoded_features, load_encoded_features
 
 ###############################################################################
 # Write test cases for load_data_into_db() function
@@ -63,6 +74,64 @@ def test_load_data_into_db(db_connections):
     pd.testing.assert_frame_equal(df_result, df_expected, check_dtype=False)
     
 
+###############################################################################
+# Write test cases for load_data_into_db() function in streaming mode
+# ##############################################################################
+
+def test_load_data_into_db_in_chunks(db_connections):
+    """_summary_
+    This function checks if load_data_into_db streams the csv in chunks and
+    still produces the same 'loaded_data' table as the test case provided in
+    the db in a table named 'loaded_data_test_case'
+
+    INPUTS
+        DB_FILE_NAME : Name of the database file 'utils_output.db'
+        DB_PATH : path where the db file should be present
+        UNIT_TEST_DB_FILE_NAME: Name of the test database file 'unit_test_cases.db'
+
+    SAMPLE USAGE
+        output=test_load_data_into_db_in_chunks()
+
+    """
+    conn, conn_test = db_connections
+    
+    # Run the function under test with chunks smaller than the file
+    load_data_into_db(chunksize=30, use_cache=False)
+    
+    df_test_case = pd.read_sql("SELECT * FROM loaded_data_test_case", conn_test)
+    df_result = pd.read_sql("SELECT * FROM loaded_data", conn)
+    
+    df_expected = df_test_case.sort_values(by='created_date').reset_index(drop=True)
+    df_result = df_result.sort_values(by='created_date').reset_index(drop=True)
+    
+    pd.testing.assert_frame_equal(df_result, df_expected, check_dtype=False)
+    
+
+###############################################################################
+# Write test cases for the raw data dtype plan
+# ##############################################################################
+
+def test_get_raw_data_read_options():
+    """_summary_
+    This function checks if reading the raw data with get_raw_data_read_options
+    applies the compact dtypes of raw_data_dtypes at read time.
+
+    INPUTS
+        DATA_DIRECTORY : path of the directory where 'leadscoring_test.csv' 
+                        file is present
+
+    SAMPLE USAGE
+        output=test_get_raw_data_read_options()
+
+    """
+    df = pd.read_csv(f"{DATA_DIRECTORY}/leadscoring_test.csv", **get_raw_data_read_options())
+    
+    assert pd.api.types.is_datetime64_any_dtype(df['created_date'])
+    assert isinstance(df['first_platform_c'].dtype, pd.CategoricalDtype)
+    assert df['referred_lead'].dtype == 'float32'
+    assert df['app_complete_flag'].dtype == 'int8'
+    
+
 ###############################################################################
 # Write test cases for map_city_tier() function
 # ##############################################################################
@@ -103,6 +172,29 @@ def test_map_city_tier(db_connections):
     pd.testing.assert_frame_equal(df_result, df_expected, check_dtype=False)
     
     
+###############################################################################
+# Write test cases for the city tier lookup
+# ##############################################################################
+
+def test_apply_city_tier_mapping_normalized_names():
+    """_summary_
+    This function checks if apply_city_tier_mapping matches city names
+    regardless of case and whitespace, and counts the unmapped and null
+    cities in the misses it returns.
+
+    SAMPLE USAGE
+        output=test_apply_city_tier_mapping_normalized_names()
+
+    """
+    df = pd.DataFrame({'city_mapped': ['Mumbai', ' agra', 'PUNE  ', 'atlantis', 'Atlantis ', None, 'atlantis']})
+    
+    df_result, df_misses = apply_city_tier_mapping(df, return_misses=True)
+    
+    assert df_result['city_tier'].tolist() == [1.0, 2.0, 1.0, 3.0, 3.0, 3.0, 3.0]
+    assert 'city_mapped' not in df_result.columns
+    assert df_misses.values.tolist() == [['atlantis', 'atlantis', 2], ['Atlantis ', 'atlantis', 1], [None, None, 1]]
+
+
 ###############################################################################
 # Write test cases for map_categorical_vars() function
 # ##############################################################################    
@@ -143,6 +235,29 @@ def test_map_categorical_vars(db_connections):
     pd.testing.assert_frame_equal(df_result, df_expected, check_dtype=False)
     
 
+def test_apply_categorical_mapping_extra_columns():
+    """_summary_
+    This function checks if apply_categorical_mapping remaps any column passed
+    in significant_levels, mapping insignificant levels and nulls to 'others'
+    and leaving columns that are not configured untouched.
+
+    SAMPLE USAGE
+        output=test_apply_categorical_mapping_extra_columns()
+
+    """
+    df = pd.DataFrame({'first_platform_c': ['Level0', 'Level5', None],
+                       'extra_level_c': ['Level1', 'Level2', 'Level1']})
+    
+    df_result = apply_categorical_mapping(df.copy(), {'extra_level_c': ['Level1']})
+    
+    assert df_result['extra_level_c'].tolist() == ['Level1', 'others', 'Level1']
+    assert df_result['first_platform_c'].tolist() == df['first_platform_c'].tolist()
+    
+    df_result = apply_categorical_mapping(df.copy())
+    
+    assert df_result['first_platform_c'].tolist() == ['Level0', 'others', 'others']
+    
+
 ###############################################################################
 # Write test cases for interactions_mapping() function
 # ##############################################################################    
@@ -185,3 +300,822 @@ def test_interactions_mapping(db_connections):
     # Compare results
     pd.testing.assert_frame_equal(df_result.sort_index(axis=1), df_expected.sort_index(axis=1), check_dtype=False)
 
+
+
+###############################################################################
+# Write test cases for run_fused_pipeline() function
+# ##############################################################################    
+def test_run_fused_pipeline(db_connections):
+    """_summary_
+    This function checks if run_fused_pipeline produces the same
+    'interactions_mapped' table as running the stages one by one, by comparing
+    its output with test cases provided in the db in a table named
+    'interactions_mapped_test_case'
+
+    INPUTS
+        DB_FILE_NAME : Name of the database file 'utils_output.db'
+        DB_PATH : path where the db file should be present
+        UNIT_TEST_DB_FILE_NAME: Name of the test database file 'unit_test_cases.db'
+
+    SAMPLE USAGE
+        output=test_run_fused_pipeline()
+
+    """ 
+    conn, conn_test = db_connections
+    
+    # Drop the output of the staged run so the fused run has to recreate it
+    conn.execute("DROP TABLE IF EXISTS interactions_mapped")
+    conn.commit()
+    
+    # Run the function under test
+    run_fused_pipeline(write_intermediate_tables=False)
+    
+    df_test_case = pd.read_sql("SELECT * FROM interactions_mapped_test_case", conn_test)
+    df_result = pd.read_sql("SELECT * FROM interactions_mapped", conn)
+    
+    df_expected = df_test_case.sort_values(by='created_date').reset_index(drop=True)
+    df_result = df_result[df_test_case.columns].sort_values(by='created_date').reset_index(drop=True)
+    
+    pd.testing.assert_frame_equal(df_result, df_expected, check_dtype=False)
+
+
+###############################################################################
+# Write test cases for run_parallel_pipeline() function
+# ##############################################################################    
+def test_run_parallel_pipeline(db_connections):
+    """_summary_
+    This function checks if run_parallel_pipeline writes the same
+    'model_input' and 'city_tier_misses' tables as run_fused_pipeline for
+    both shardings and for one or more workers, and if the leads of a
+    'created_date' always share a shard.
+
+    SAMPLE USAGE
+        output=test_run_parallel_pipeline()
+
+    """
+    conn, conn_test = db_connections
+
+    run_fused_pipeline(write_intermediate_tables=False)
+    df_expected = pd.read_sql("SELECT * FROM model_input", conn)
+    df_misses_expected = pd.read_sql("SELECT * FROM city_tier_misses", conn)
+
+    for n_workers, shard_by in [(3, 'range'), (2, 'hash'), (1, 'range')]:
+        run_parallel_pipeline(n_workers=n_workers, shard_by=shard_by)
+        pd.testing.assert_frame_equal(pd.read_sql("SELECT * FROM model_input", conn), df_expected)
+        df_misses = pd.read_sql("SELECT * FROM city_tier_misses", conn)
+        pd.testing.assert_frame_equal(df_misses.sort_values('lead_count').reset_index(drop=True),
+                                      df_misses_expected.sort_values('lead_count').reset_index(drop=True))
+
+    created_date = pd.Series(pd.to_datetime(['2021-07-03', '2021-07-01', '2021-07-03', '2021-07-02', None]))
+    assert get_shard_ids(created_date, 2, 'range').tolist() == [1, 0, 1, 0, 0]
+    hash_ids = get_shard_ids(created_date, 4, 'hash')
+    assert hash_ids[0] == hash_ids[2] and hash_ids.max() < 4
+    with pytest.raises(ValueError):
+        get_shard_ids(created_date, 2, 'created_date')
+
+
+###############################################################################
+# Write test cases for the tasks of the sharded data pipeline DAG
+# ##############################################################################    
+def test_sharded_dag_tasks(db_connections, monkeypatch, tmp_path):
+    """_summary_
+    This function runs the tasks of the sharded DAG one after the other
+    (split_leads_into_shards, a clean_shard per shard and merge_shards) and
+    checks if the 'model_input' they publish is the same as the one of
+    run_fused_pipeline and passes model_input_schema_check, and if
+    clean_up_artifacts deletes the shard artifacts at the end.
+
+    SAMPLE USAGE
+        output=test_sharded_dag_tasks()
+
+    """
+    pytest.importorskip('pyarrow')
+    import utils
+
+    conn, conn_test = db_connections
+    monkeypatch.setattr(utils, 'ARTIFACT_DIRECTORY', str(tmp_path))
+
+    run_fused_pipeline(write_intermediate_tables=False)
+    df_expected = pd.read_sql("SELECT * FROM model_input", conn)
+
+    shard_kwargs = split_leads_into_shards('test_run', n_shards=4)
+    assert [kwargs['shard'] for kwargs in shard_kwargs] == [0, 1, 2, 3]
+    for kwargs in shard_kwargs:
+        clean_shard(**kwargs)
+    merge_shards(artifact_run_id='test_run', n_shards=4)
+
+    pd.testing.assert_frame_equal(pd.read_sql("SELECT * FROM model_input", conn), df_expected)
+    assert len(read_artifact('test_run', 'model_input')) == len(df_expected)
+    model_input_schema_check(artifact_run_id='test_run')
+    clean_up_artifacts(artifact_run_id='test_run')
+    assert not os.path.exists(tmp_path / 'test_run')
+
+
+###############################################################################
+# Write test cases for run_incremental_pipeline() function
+# ##############################################################################    
+def test_run_incremental_pipeline(db_connections):
+    """_summary_
+    This function checks if run_incremental_pipeline processes all the leads
+    on its first run, matching the test cases provided in the db in a table
+    named 'interactions_mapped_test_case', and appends nothing when it is run
+    again on the same file.
+
+    INPUTS
+        DB_FILE_NAME : Name of the database file 'utils_output.db'
+        DB_PATH : path where the db file should be present
+        UNIT_TEST_DB_FILE_NAME: Name of the test database file 'unit_test_cases.db'
+
+    SAMPLE USAGE
+        output=test_run_incremental_pipeline()
+
+    """ 
+    conn, conn_test = db_connections
+    
+    # Start without a high-water mark so the first run processes every lead
+    conn.execute("DROP TABLE IF EXISTS pipeline_watermark")
+    conn.commit()
+    
+    run_incremental_pipeline(chunksize=30)
+    
+    df_test_case = pd.read_sql("SELECT * FROM interactions_mapped_test_case", conn_test)
+    df_result = pd.read_sql("SELECT * FROM interactions_mapped", conn)
+    
+    df_expected = df_test_case.sort_values(by='created_date').reset_index(drop=True)
+    df_result = df_result[df_test_case.columns].sort_values(by='created_date').reset_index(drop=True)
+    
+    pd.testing.assert_frame_equal(df_result, df_expected, check_dtype=False)
+    
+    # A second run on the same file has no new leads to append
+    run_incremental_pipeline(chunksize=30)
+    
+    for table_name in ['loaded_data', 'interactions_mapped', 'model_input']:
+        assert pd.read_sql(f"SELECT COUNT(*) AS n FROM {table_name}", conn)['n'][0] == len(df_test_case)
+    
+    # Leads re-delivered after the high-water mark was lost are found by their hash
+    conn.execute("DELETE FROM pipeline_watermark")
+    conn.commit()
+    run_incremental_pipeline(chunksize=30)
+    
+    for table_name in ['loaded_data', 'interactions_mapped', 'model_input']:
+        assert pd.read_sql(f"SELECT COUNT(*) AS n FROM {table_name}", conn)['n'][0] == len(df_test_case)
+
+
+def test_run_incremental_pipeline_new_leads(db_connections, monkeypatch, tmp_path):
+    """_summary_
+    This function checks if the tables run_incremental_pipeline appends to
+    over two files match the tables of a full run on the second file, when
+    the second file adds leads at the high-water mark of the first run, after
+    it and without a 'created_date'.
+
+    SAMPLE USAGE
+        output=test_run_incremental_pipeline_new_leads()
+
+    """
+    import utils
+
+    conn, conn_test = db_connections
+    monkeypatch.setattr(utils, 'DATA_DIRECTORY', str(tmp_path))
+    tables = ['loaded_data', 'city_tier_mapped', 'categorical_variables_mapped', 'interactions_mapped', 'model_input']
+    read_sorted = lambda table_name: (lambda df: df.sort_values(list(df.columns)).reset_index(drop=True))(
+        pd.read_sql(f"SELECT * FROM {table_name}", conn))
+
+    df_leads = pd.read_csv(f"{DATA_DIRECTORY}/leadscoring_test.csv", dtype=str, keep_default_na=False)
+    df_leads = df_leads.sort_values('created_date', ignore_index=True)
+    watermark = df_leads['created_date'][len(df_leads) // 2]
+
+    # The first file stops at the high-water mark, the second one adds a lead at
+    # the high-water mark, the leads after it and a lead without a 'created_date'
+    df_at_watermark = df_leads.iloc[[0]].assign(created_date=watermark, referred_lead='1.0')
+    df_without_date = df_leads.iloc[[1]].assign(created_date='', referred_lead='1.0')
+    df_first = df_leads[df_leads['created_date'] <= watermark]
+    df_second = pd.concat([df_leads, df_at_watermark, df_without_date], ignore_index=True)
+
+    conn.execute("DROP TABLE IF EXISTS pipeline_watermark")
+    conn.commit()
+    df_first.to_csv(tmp_path / 'leadscoring_test.csv', index=False)
+    run_incremental_pipeline(chunksize=30)
+    df_second.to_csv(tmp_path / 'leadscoring_test.csv', index=False)
+    run_incremental_pipeline(chunksize=30)
+    incremental = {table_name: read_sorted(table_name) for table_name in tables}
+    assert len(incremental['loaded_data']) == len(df_second)
+
+    # A full run on the second file gives the same tables
+    conn.execute("DROP TABLE IF EXISTS pipeline_watermark")
+    conn.commit()
+    run_incremental_pipeline(chunksize=30)
+    for table_name in tables:
+        pd.testing.assert_frame_equal(incremental[table_name], read_sorted(table_name))
+
+    # Restore the tables of the test file for the tests that follow
+    conn.execute("DROP TABLE IF EXISTS pipeline_watermark")
+    conn.commit()
+    monkeypatch.undo()
+    run_incremental_pipeline(chunksize=30)
+
+
+###############################################################################
+# Write test cases for the lead hashes
+# ##############################################################################
+
+def test_get_lead_hashes(db_connections):
+    """_summary_
+    This function checks if get_lead_hashes gives a lead the same hash when
+    it is read from the csv with the dtype plan and when it is read back from
+    the 'categorical_variables_mapped' table, and different hashes to
+    different leads.
+
+    INPUTS
+        DB_FILE_NAME : Name of the database file 'utils_output.db'
+        DB_PATH : path where the db file should be present
+        DATA_DIRECTORY : path of the directory where 'leadscoring_test.csv' 
+                        file is present
+
+    SAMPLE USAGE
+        output=test_get_lead_hashes()
+
+    """
+    conn, conn_test = db_connections
+    
+    run_fused_pipeline(write_intermediate_tables=True)
+    
+    df = pd.read_csv(f"{DATA_DIRECTORY}/leadscoring_test.csv", **get_raw_data_read_options())
+    df = apply_categorical_mapping(apply_city_tier_mapping(fill_missing_lead_counts(df)))
+    df_table = pd.read_sql("SELECT * FROM categorical_variables_mapped", conn)
+    
+    lead_hashes = get_lead_hashes(df)
+    assert lead_hashes.dtype == 'int64'
+    assert (lead_hashes == get_lead_hashes(df_table)).all()
+    assert len(set(lead_hashes)) == len(df.drop_duplicates())
+    
+    saved_hashes = pd.read_sql("SELECT row_hash FROM lead_hashes", conn)['row_hash']
+    assert set(saved_hashes) == set(lead_hashes)
+    assert not find_new_leads(conn, lead_hashes).any()
+
+
+###############################################################################
+# Write test cases for the push-down SQL backend
+# ##############################################################################
+def test_sql_backend(db_connections):
+    """_summary_
+    This function checks if map_city_tier, map_categorical_vars and
+    interactions_mapping give the test case tables when run with
+    backend='sql', and if check_backend_parity finds the same output for the
+    pandas and SQL backends.
+
+    SAMPLE USAGE
+        output=test_sql_backend()
+
+    """
+    conn, conn_test = db_connections
+
+    map_city_tier(use_cache=False, backend='sql')
+    map_categorical_vars(use_cache=False, backend='sql')
+    interactions_mapping(use_cache=False, backend='sql')
+
+    for table_name in ['city_tier_mapped', 'categorical_variables_mapped', 'interactions_mapped']:
+        df_test_case = pd.read_sql(f"SELECT * FROM {table_name}_test_case", conn_test)
+        df_result = pd.read_sql(f"SELECT * FROM {table_name}", conn)
+        common_columns = df_result.columns.intersection(df_test_case.columns)
+        df_expected = df_test_case[common_columns].sort_values(by=list(common_columns)).reset_index(drop=True)
+        df_result = df_result[common_columns].sort_values(by=list(common_columns)).reset_index(drop=True)
+        pd.testing.assert_frame_equal(df_result, df_expected, check_dtype=False)
+
+    df_model_input = pd.read_sql("SELECT * FROM model_input", conn)
+    assert list(df_model_input.columns[:len(INDEX_COLUMNS_TRAINING)]) == INDEX_COLUMNS_TRAINING
+    df_hashes = pd.read_sql("SELECT row_hash FROM lead_hashes", conn)
+    df_categorical = pd.read_sql("SELECT * FROM categorical_variables_mapped", conn)
+    assert set(df_hashes['row_hash']) == set(get_lead_hashes(df_categorical))
+
+    report = check_backend_parity()
+    assert (report['status'] == 'passed').all(), report
+
+    with pytest.raises(ValueError):
+        map_city_tier(use_cache=False, backend='spark')
+
+
+###############################################################################
+# Write test cases for the storage backends
+# ##############################################################################
+def test_storage_backend(tmp_path):
+    """_summary_
+    This function checks if a table written with write_table on a connection
+    from connect_db is read back unchanged by read_table, in one go and in
+    chunks, and if unknown or missing storage backends are reported.
+
+    SAMPLE USAGE
+        output=test_storage_backend()
+
+    """
+    db_file_path = f"{tmp_path}/storage.db"
+    df = pd.DataFrame({'city_tier': [1.0, 2.0, None], 'first_platform_c': ['Level0', None, 'Level3']})
+
+    conn = connect_db(db_file_path, backend='sqlite')
+    assert not table_exists(conn, 'model_input')
+    write_table(conn, 'model_input', df)
+    assert table_exists(conn, 'model_input')
+    assert get_table_columns(conn, 'model_input') == ['city_tier', 'first_platform_c']
+    pd.testing.assert_frame_equal(read_table(conn, 'model_input'), df, check_dtype=False)
+    chunks = list(read_table(conn, 'model_input', columns=['city_tier'], chunksize=2))
+    assert [len(chunk) for chunk in chunks] == [2, 1]
+    conn.close()
+
+    assert get_storage_file_path(db_file_path, backend='duckdb') == f"{tmp_path}/storage.duckdb"
+    with pytest.raises(ValueError):
+        connect_db(db_file_path, backend='parquet')
+    if duckdb is None:
+        with pytest.raises(ImportError):
+            connect_db(db_file_path, backend='duckdb')
+
+
+def test_duckdb_storage_backend(db_connections, monkeypatch):
+    """_summary_
+    This function checks if the cleaning stages give the same 'model_input'
+    when their tables are stored in DuckDB as when they are stored in SQLite.
+    It is skipped if duckdb isn't installed.
+
+    SAMPLE USAGE
+        output=test_duckdb_storage_backend()
+
+    """
+    pytest.importorskip('duckdb')
+    import utils
+
+    conn, conn_test = db_connections
+
+    df_expected = pd.read_sql("SELECT * FROM model_input", conn)
+
+    monkeypatch.setattr(utils, 'STORAGE_BACKEND', 'duckdb')
+    load_data_into_db(use_cache=False)
+    map_city_tier(use_cache=False)
+    map_categorical_vars(use_cache=False)
+    interactions_mapping(use_cache=False)
+
+    duckdb_conn = connect_db(f"{DB_PATH}/{DB_FILE_NAME}")
+    df_result = read_table(duckdb_conn, 'model_input')
+    duckdb_conn.close()
+
+    with pytest.raises(ValueError):
+        map_city_tier(use_cache=False, backend='sql')
+
+    df_result['created_date'] = df_result['created_date'].astype(str)
+    pd.testing.assert_frame_equal(df_result, df_expected, check_dtype=False)
+
+
+###############################################################################
+# Write test cases for the stage artifacts
+# ##############################################################################
+def test_stage_artifacts(db_connections, monkeypatch, tmp_path):
+    """_summary_
+    This function checks if the cleaning stages run on stage artifacts of a
+    DAG run, in both artifact formats, give the 'model_input' of the db
+    tables with the dtypes kept between the stages, and if 'model_input' is
+    published to the db at the end.
+
+    SAMPLE USAGE
+        output=test_stage_artifacts()
+
+    """
+    import utils
+
+    conn, conn_test = db_connections
+    run_id = 'manual__2024-08-18T00:00:00+00:00'
+    monkeypatch.setattr(utils, 'ARTIFACT_DIRECTORY', str(tmp_path))
+    monkeypatch.setattr(utils, 'COUNT_STAGE_ROWS', True)
+
+    interactions_mapping(use_cache=False)
+    df_expected = pd.read_sql("SELECT * FROM model_input", conn)
+    conn.execute("DELETE FROM model_input")
+    conn.commit()
+
+    for artifact_format in ['parquet', 'arrow']:
+        monkeypatch.setattr(utils, 'ARTIFACT_FORMAT', artifact_format)
+        load_data_into_db(artifact_run_id=run_id)
+        map_city_tier(artifact_run_id=run_id)
+        map_categorical_vars(artifact_run_id=run_id)
+        interactions_mapping(artifact_run_id=run_id)
+        model_input_schema_check(artifact_run_id=run_id)
+
+        assert get_artifact_path(run_id, 'model_input').endswith(f"manual__2024-08-18T00_00_00_00_00/model_input.{artifact_format}")
+        assert pd.api.types.is_datetime64_any_dtype(read_artifact(run_id, 'loaded_data')['created_date'])
+        assert count_artifact_rows(run_id, 'city_tier_mapped') == 100
+
+        df_result = read_artifact(run_id, 'model_input')
+        df_result['created_date'] = df_result['created_date'].astype(str)
+        pd.testing.assert_frame_equal(df_result, df_expected, check_dtype=False, check_categorical=False)
+        pd.testing.assert_frame_equal(pd.read_sql("SELECT * FROM model_input", conn), df_expected)
+
+        for path in tmp_path.rglob('*'):
+            if path.is_file():
+                path.unlink()
+
+    metrics = pd.read_sql("SELECT * FROM stage_metrics WHERE stage = 'map_city_tier' "
+                          "ORDER BY rowid DESC LIMIT 1", conn)
+    assert metrics.loc[0, 'rows_in'] == 100
+
+    # The last task deletes the artifacts of its run and of all but the latest
+    # keep_runs runs that failed before it
+    for artifact_run_id in ['failed_run_1', 'failed_run_2', run_id]:
+        path = write_artifact(df_expected, artifact_run_id, 'model_input')
+        os.utime(os.path.dirname(path), (0, 0) if artifact_run_id == 'failed_run_1' else None)
+    assert sorted(clean_up_artifacts(artifact_run_id=run_id, keep_runs=1)) == [
+        'failed_run_1', 'manual__2024-08-18T00_00_00_00_00']
+    assert [path.name for path in tmp_path.iterdir()] == ['failed_run_2']
+
+    with pytest.raises(FileNotFoundError):
+        read_artifact('missing_run', 'model_input')
+    with pytest.raises(ValueError):
+        map_city_tier(backend='sql', artifact_run_id=run_id)
+
+
+###############################################################################
+# Write test cases for the date-partitioned storage
+# ##############################################################################
+def test_partitions(db_connections, monkeypatch, tmp_path):
+    """_summary_
+    This function checks if the month-partitioned 'model_input' rebuilt from
+    the 'loaded_data' partitions matches the 'model_input' table, if only the
+    changed partitions are rewritten and rebuilt, and if date-bounded reads
+    only open the partitions in the range.
+
+    SAMPLE USAGE
+        output=test_partitions()
+
+    """
+    import utils
+
+    conn, conn_test = db_connections
+    monkeypatch.setattr(utils, 'PARTITION_DIRECTORY', str(tmp_path))
+    monkeypatch.setattr(utils, 'PUBLISH_MODEL_INPUT', False)
+
+    interactions_mapping(use_cache=False)
+    df_expected = pd.read_sql("SELECT * FROM model_input", conn)
+
+    written = load_data_into_partitions(granularity='month')
+    assert written == ['2021-07', '2021-08', '2021-09', '2021-10', '2021-11', '2021-12', '2022-01', '2022-02']
+    assert get_partition_catalog('loaded_data')['row_count'].sum() == 100
+    assert load_data_into_partitions(granularity='month') == []
+    assert rebuild_partitions() == written
+    assert rebuild_partitions() == []
+
+    df_result = read_partitions('model_input')
+    df_result['created_date'] = df_result['created_date'].astype(str)
+    pd.testing.assert_frame_equal(df_result, df_expected, check_dtype=False, check_categorical=False)
+
+    # Backfilling a month rewrites and rebuilds only that month
+    df_month = read_partitions('loaded_data', partition_keys=['2021-08'])
+    df_month['referred_lead'] = 1.0
+    assert write_partitions(df_month, 'loaded_data', 'month') == ['2021-08']
+    assert rebuild_partitions() == ['2021-08']
+    assert rebuild_partitions(start_date='2021-08-05', end_date='2021-08-05', force=True) == ['2021-08']
+
+    # Publishing replaces only the rows of the rebuilt month in the db
+    monkeypatch.setattr(utils, 'PUBLISH_MODEL_INPUT', True)
+    assert rebuild_partitions(partition_keys=['2021-08'], force=True) == ['2021-08']
+    df_published = pd.read_sql("SELECT * FROM model_input", conn)
+    in_month = df_published['created_date'].str[:7] == '2021-08'
+    assert len(df_published) == len(df_expected)
+    assert in_month.sum() == (df_expected['created_date'].str[:7] == '2021-08').sum()
+    assert (df_published.loc[in_month, 'referred_lead'] == 1).all()
+    pd.testing.assert_frame_equal(df_published[~in_month].reset_index(drop=True),
+                                  df_expected[df_expected['created_date'].str[:7] != '2021-08'].reset_index(drop=True))
+    interactions_mapping(use_cache=False)
+
+    # Only the partitions of the range are read, and the rows outside it dropped
+    assert list_partitions('model_input', '2021-07-05', '2021-08-03') == ['2021-07', '2021-08']
+    df_range = read_partitions('model_input', start_date='2021-07-05', end_date='2021-08-03')
+    days = df_expected['created_date'].str[:10]
+    assert len(df_range) == ((days >= '2021-07-05') & (days <= '2021-08-03')).sum()
+    assert get_partition_keys(pd.Series(['2021-07-05 10:00:00'])).tolist() == ['2021-07-05']
+
+
+###############################################################################
+# Write test cases for the stage cache
+# ##############################################################################    
+def test_stage_cache(db_connections, monkeypatch):
+    """_summary_
+    This function checks if a stage is skipped as a cache hit when its inputs
+    haven't changed since its last run, and rerun as a miss once its code
+    changed or its input table has been rewritten by a stage.
+
+    INPUTS
+        DB_FILE_NAME : Name of the database file 'utils_output.db'
+        DB_PATH : path where the db file should be present
+
+    SAMPLE USAGE
+        output=test_stage_cache()
+
+    """ 
+    conn, conn_test = db_connections
+    
+    db_file_path = f"{DB_PATH}/{DB_FILE_NAME}"
+    fingerprint = lambda: get_table_fingerprint(db_file_path, 'city_tier_mapped')
+    
+    load_data_into_db(use_cache=False)
+    map_city_tier()
+    first_fingerprint = fingerprint()
+    
+    assert first_fingerprint is not None
+    
+    # Nothing changed, so the stage is a hit and its output keeps its fingerprint
+    map_city_tier()
+    last_result = conn.execute("SELECT result FROM stage_cache_log WHERE stage = 'map_city_tier' "
+                               "ORDER BY rowid DESC LIMIT 1").fetchone()[0]
+    assert last_result == 'hit'
+    assert fingerprint() == first_fingerprint
+    
+    report = get_stage_cache_report()
+    assert report.set_index('stage').loc['map_city_tier', 'hits'] >= 1
+    
+    # A deploy that changes the code of the stages invalidates their outputs
+    import utils
+    with monkeypatch.context() as patch:
+        patch.setattr(utils, 'get_code_fingerprint', lambda: 'changed code')
+        map_city_tier()
+        last_result = conn.execute("SELECT result FROM stage_cache_log WHERE stage = 'map_city_tier' "
+                                   "ORDER BY rowid DESC LIMIT 1").fetchone()[0]
+        assert last_result == 'miss'
+    
+    # Writing loaded_data outside the cached stages invalidates the downstream stage
+    run_fused_pipeline(write_intermediate_tables=True)
+    assert get_table_fingerprint(db_file_path, 'loaded_data') is None
+    
+    map_city_tier()
+    last_result = conn.execute("SELECT result FROM stage_cache_log WHERE stage = 'map_city_tier' "
+                               "ORDER BY rowid DESC LIMIT 1").fetchone()[0]
+    assert last_result == 'miss'
+
+
+###############################################################################
+# Write test cases for the streaming schema validation
+# ##############################################################################
+
+def test_raw_data_schema_check(db_connections):
+    """_summary_
+    This function checks if raw_data_schema_check validates the test data and
+    saves one row per column of raw_data_schema in the table named
+    'raw_data_validation_report'.
+
+    INPUTS
+        DB_FILE_NAME : Name of the database file 'utils_output.db'
+        DB_PATH : path where the db file should be present
+        DATA_DIRECTORY : path of the directory where 'leadscoring_test.csv' 
+                        file is present
+
+    SAMPLE USAGE
+        output=test_raw_data_schema_check()
+
+    """
+    conn, conn_test = db_connections
+    
+    raw_data_schema_check()
+    report = pd.read_sql('SELECT * FROM raw_data_validation_report', conn)
+    
+    assert set(report['column_name']) == set(raw_data_schema)
+    assert (report['status'] == 'passed').all()
+    assert (report['rows'] == 100).all()
+
+
+def test_model_input_schema_check(db_connections):
+    """_summary_
+    This function checks if model_input_schema_check passes the 'model_input'
+    of run_fused_pipeline and raises a ValueError when a column of
+    model_input_schema is missing from it, so a broken 'model_input' stops the
+    pipeline before training.
+
+    SAMPLE USAGE
+        output=test_model_input_schema_check()
+
+    """
+    conn, conn_test = db_connections
+
+    run_fused_pipeline(write_intermediate_tables=False)
+    model_input_schema_check()
+    report = pd.read_sql('SELECT * FROM model_input_validation_report', conn)
+    assert (report['status'] == 'passed').all()
+
+    df_model_input = pd.read_sql("SELECT * FROM model_input", conn)
+    write_table(conn, 'model_input', df_model_input.drop(columns=model_input_schema[-1]))
+    with pytest.raises(ValueError):
+        model_input_schema_check()
+
+    run_fused_pipeline(write_intermediate_tables=False)
+
+
+def test_validate_chunks():
+    """_summary_
+    This function checks if validate_chunks counts the values of every chunk
+    and fails the columns with values out of their dtype, domain or null rate.
+
+    SAMPLE USAGE
+        output=test_validate_chunks()
+
+    """
+    chunks = [pd.DataFrame({'city_tier': ['1', '2'], 'referred_lead': ['0', '1']}),
+              pd.DataFrame({'city_tier': ['4', None], 'referred_lead': ['x', '1']})]
+    report = validate_chunks(chunks, model_input_dtypes, model_input_domains,
+                             model_input_max_null_rates).set_index('column_name')
+    
+    assert report.loc['city_tier', 'rows'] == 4
+    assert report.loc['city_tier', 'null_count'] == 1
+    assert report.loc['city_tier', 'domain_violations'] == 1
+    assert report.loc['referred_lead', 'dtype_violations'] == 1
+    assert (report['status'] == 'failed').all()
+
+
+###############################################################################
+# Write test cases for the stage instrumentation
+# ##############################################################################
+
+def test_instrument_stage(db_connections, monkeypatch):
+    """_summary_
+    This function checks if the instrumented stages save their wall time, CPU
+    time and, once switched on, their row counts and traced peak memory in the
+    table named 'stage_metrics' and the latest run of every stage in the
+    Prometheus textfile.
+
+    INPUTS
+        DB_FILE_NAME : Name of the database file 'utils_output.db'
+        DB_PATH : path where the db file should be present
+        STAGE_METRICS_FILE_NAME : Name of the Prometheus textfile
+
+    SAMPLE USAGE
+        output=test_instrument_stage()
+
+    """
+    import utils
+
+    conn, conn_test = db_connections
+    
+    map_city_tier(use_cache=False)
+    default = pd.read_sql("SELECT * FROM stage_metrics WHERE stage = 'map_city_tier' "
+                          "ORDER BY rowid DESC LIMIT 1", conn).iloc[0]
+    assert default['wall_seconds'] > 0
+    assert pd.isna(default['rows_in']) and pd.isna(default['peak_traced_bytes'])
+    
+    monkeypatch.setattr(utils, 'COUNT_STAGE_ROWS', True)
+    monkeypatch.setattr(utils, 'TRACE_STAGE_MEMORY', True)
+    load_data_into_db(use_cache=False)
+    map_city_tier(use_cache=False)
+    
+    metrics = pd.read_sql("SELECT * FROM stage_metrics WHERE rowid IN "
+                          "(SELECT MAX(rowid) FROM stage_metrics GROUP BY stage)", conn).set_index('stage')
+    
+    assert metrics.loc['load_data_into_db', 'status'] == 'success'
+    assert metrics.loc['load_data_into_db', 'rows_out'] == 100
+    assert metrics.loc['map_city_tier', 'rows_in'] == 100
+    assert metrics.loc['map_city_tier', 'rows_out'] == 100
+    assert metrics.loc['map_city_tier', 'wall_seconds'] > 0
+    assert metrics.loc['map_city_tier', 'peak_traced_bytes'] > 0
+    
+    with open(f"{DB_PATH}/{STAGE_METRICS_FILE_NAME}") as f:
+        textfile = f.read()
+    assert '# TYPE lead_scoring_stage_wall_seconds gauge' in textfile
+    assert 'lead_scoring_stage_rows_out{stage="map_city_tier",status="success"} 100' in textfile
+
+
+###############################################################################
+# Write test cases for the synthetic lead data generator
+# ##############################################################################
+
+def test_generate_synthetic_leads(tmp_path):
+    """_summary_
+    This function checks if generate_synthetic_leads writes the same file for
+    the same seed, and if the file follows raw_data_schema and passes the raw
+    data validation checks.
+
+    SAMPLE USAGE
+        output=test_generate_synthetic_leads()
+
+    """
+    file_path = tmp_path / 'leadscoring_synthetic.csv'
+    generate_synthetic_leads(file_path, 2500, seed=7, chunk_size=1000, interaction_rate=0.01)
+    first_file = file_path.read_text()
+    generate_synthetic_leads(file_path, 2500, seed=7, chunk_size=1000, interaction_rate=0.01)
+    
+    assert file_path.read_text() == first_file
+    
+    df = pd.read_csv(file_path, **get_raw_data_read_options())
+    assert df.columns.tolist() == raw_data_schema
+    assert len(df) == 2500
+    assert set(df['city_mapped'].dropna()) <= set(city_tier_mapping)
+    assert df['view_programs_page'].notna().any()
+    
+    report = validate_chunks(pd.read_csv(file_path, dtype=str, chunksize=1000),
+                             raw_data_dtypes, raw_data_domains, raw_data_max_null_rates)
+    assert (report['status'] == 'passed').all()
+
+
+###############################################################################
+# Write test cases for the feature encoder of the training and inference pipelines
+# ##############################################################################
+
+def test_feature_encoding(db_connections, tmp_path):
+    """_summary_
+    This function checks if the features the inference pipeline encodes with
+    the encoder saved by the training pipeline are the same as the features
+    the training pipeline encoded, for every output of the encoder, and if
+    the levels unseen at training time are encoded as 'others'.
+
+    SAMPLE USAGE
+        output=test_feature_encoding()
+
+    """
+    conn, conn_test = db_connections
+    features_to_encode = ['first_platform_c', 'first_utm_medium_c', 'first_utm_source_c']
+    features = ['total_leads_droppped', 'referred_lead', 'city_tier'] + features_to_encode
+
+    interactions_mapping(use_cache=False)
+    df_model_input = pd.read_sql("SELECT * FROM model_input", conn)
+
+    for output in ['sparse', 'dense', 'codes']:
+        # training: fit, save the encoder and the encoded features
+        encoder = fit_encoder(df_model_input, features_to_encode, features, output=output)
+        save_encoder(encoder, tmp_path / 'encoder.json')
+        X_train = transform_features(df_model_input, encoder)
+        save_encoded_features(conn, X_train, tmp_path / 'features.npz')
+
+        # inference: load the saved encoder and encode the same frame
+        inference_encoder = load_encoder(tmp_path / 'encoder.json')
+        X_inference = transform_features(df_model_input, inference_encoder)
+        X_loaded = load_encoded_features(conn, inference_encoder, tmp_path / 'features.npz')
+        if output == 'sparse':
+            assert (X_train != X_inference).nnz == 0
+            assert (X_train != X_loaded).nnz == 0
+        else:
+            pd.testing.assert_frame_equal(X_inference, X_train)
+            pd.testing.assert_frame_equal(X_loaded, X_train, check_dtype=False)
+
+    df_unseen = df_model_input.assign(first_platform_c='unseen_level')
+    codes = transform_features(df_unseen, inference_encoder)['first_platform_c']
+    assert (codes == inference_encoder['vocabulary']['first_platform_c'].index('others')).all()
+
+
+def test_pipeline_imports(monkeypatch, tmp_path):
+    """_summary_
+    This function checks if the utils of the training and inference pipelines
+    import in the airflow dags layout, with only the dags folder on the python
+    path, and if both encode with the encoder of the data pipeline.
+
+    SAMPLE USAGE
+        output=test_pipeline_imports()
+
+    """
+    for package in ['mlflow', 'lightgbm', 'sklearn']:
+        pytest.importorskip(package)
+    assignment_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+    dags_path = tmp_path / 'dags'
+    (dags_path / 'lead_scoring_data_pipeline').mkdir(parents=True)
+    # the regular package takes precedence over the lead_scoring_data_pipeline.py
+    # DAG files on the path, which a namespace package wouldn't
+    for file_name in ['__init__.py', 'feature_encoding.py', 'table_writer.py']:
+        shutil.copy(os.path.join(assignment_path, 'airflow', 'dags', 'lead_scoring_data_pipeline', file_name),
+                    dags_path / 'lead_scoring_data_pipeline' / file_name)
+    shutil.copytree(os.path.join(assignment_path, '02_training_pipeline', 'scripts'),
+                    dags_path / 'Lead_scoring_training_pipeline')
+    shutil.copytree(os.path.join(assignment_path, '03_inference_pipeline', 'scripts'),
+                    dags_path / 'Lead_scoring_inference_pipeline')
+
+    packages = ('lead_scoring_data_pipeline', 'Lead_scoring_training_pipeline', 'Lead_scoring_inference_pipeline')
+    monkeypatch.syspath_prepend(str(dags_path))
+    try:
+        training_utils = importlib.import_module('Lead_scoring_training_pipeline.utils')
+        inference_utils = importlib.import_module('Lead_scoring_inference_pipeline.utils')
+        assert training_utils.transform_features is inference_utils.transform_features
+        assert training_utils.write_table is inference_utils.write_table
+    finally:
+        for name in [name for name in sys.modules if name.split('.')[0] in packages]:
+            del sys.modules[name]
+
+
+###############################################################################
+# Write test cases for the benchmark suite
+# ##############################################################################
+
+def test_benchmarks(tmp_path):
+    """_summary_
+    This function checks if run_benchmarks measures every benchmarked stage
+    and if compare_benchmarks flags a stage only when it got slower than the
+    baseline by more than the threshold.
+
+    SAMPLE USAGE
+        output=test_benchmarks()
+
+    """
+    results = run_benchmarks(scales=[500], repeats=1)
+    
+    assert [result['stage'] for result in results['results']] == [
+        'raw_data_schema_check', 'load_data_into_db', 'map_city_tier',
+        'map_categorical_vars', 'interactions_mapping', 'model_input_schema_check']
+    assert all(result['wall_seconds'] > 0 for result in results['results'])
+    
+    save_baseline(results, tmp_path / 'baseline.json')
+    baseline = load_baseline(tmp_path / 'baseline.json')
+    assert not compare_benchmarks(results, baseline)['regression'].any()
+    
+    slower = {**results, 'results': [dict(result, wall_seconds=result['wall_seconds'] + 1)
+                                     if result['stage'] == 'map_city_tier' else result
+                                     for result in results['results']]}
+    comparison = compare_benchmarks(slower, baseline, threshold=0.25)
+    regressions = comparison[comparison['regression']]
+    assert regressions[['stage', 'metric']].values.tolist() == [['map_city_tier', 'wall_seconds']]
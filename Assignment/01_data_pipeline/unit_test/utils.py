@@ -4,16 +4,221 @@
 
 
 import pandas as pd
+import numpy as np
 import os
 import sqlite3
+import sys
+import time
+import hashlib
+import re
+import resource
+import shutil
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import lru_cache, wraps
 from sqlite3 import Error
 from constants import *
+from table_writer import SQLITE_PRAGMAS, WRITE_BATCH_SIZE, apply_write_pragmas, write_table, insert_dataframe
+from table_writer import get_sqlite_values, is_duckdb_connection, insert_duckdb_dataframe
+from schema import raw_data_schema, raw_data_dtypes
 from significant_categorical_level import *
 from city_tier_mapping import city_tier_mapping
+
+try:
+    import duckdb
+except ImportError:
+    # duckdb is only needed when STORAGE_BACKEND is 'duckdb'
+    duckdb = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    # pyarrow is only needed for the stage artifacts (USE_ARTIFACT_STORE)
+    pa = pq = None
+
+###############################################################################
+# Define functions to instrument the pipeline stages
+###############################################################################
+
+STAGE_METRICS_COLUMNS = ['stage', 'status', 'started_at', 'wall_seconds', 'cpu_seconds',
+                         'peak_traced_bytes', 'peak_rss_bytes', 'rows_in', 'rows_out']
+
+
+def instrument_stage(input_table=None, output_table=None):
+    '''
+    Decorator that measures every run of a pipeline stage: wall time, CPU time,
+    peak memory allocated during the stage (traced with tracemalloc when
+    TRACE_STAGE_MEMORY is True), peak RSS of the process and, when
+    COUNT_STAGE_ROWS is True, the number of rows in input_table before and in
+    output_table after the stage (in their stage artifacts when the stage is
+    called with an artifact_run_id). The measurements are saved in the 'stage_metrics' table (see
+    save_stage_metrics), also when the stage raises.
+
+
+    INPUTS
+        input_table : table the stage reads, or None if it reads no table
+        output_table : table the stage writes, or None if it writes no table
+
+
+    OUTPUT
+        The decorated function, which returns what the stage returns.
+
+
+    SAMPLE USAGE
+        @instrument_stage(input_table='loaded_data', output_table='city_tier_mapped')
+        def map_city_tier(): ...
+    '''
+    def decorator(stage):
+        @wraps(stage)
+        def instrumented_stage(*args, **kwargs):
+            db_file_path = f"{DB_PATH}/{DB_FILE_NAME}"
+            artifact_run_id = kwargs.get('artifact_run_id')
+            rows_in = count_stage_rows(db_file_path, artifact_run_id, input_table) if COUNT_STAGE_ROWS else None
+
+            start_tracing = TRACE_STAGE_MEMORY and not tracemalloc.is_tracing()
+            if start_tracing:
+                tracemalloc.start()
+            started_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            wall_start, cpu_start = time.perf_counter(), time.process_time()
+            status = 'failed'
+            try:
+                result = stage(*args, **kwargs)
+                status = 'success'
+                return result
+            finally:
+                wall_seconds = time.perf_counter() - wall_start
+                cpu_seconds = time.process_time() - cpu_start
+                peak_traced_bytes = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None
+                if start_tracing:
+                    tracemalloc.stop()
+                save_stage_metrics(db_file_path, {'stage': stage.__name__,
+                                                  'status': status,
+                                                  'started_at': started_at,
+                                                  'wall_seconds': round(wall_seconds, 6),
+                                                  'cpu_seconds': round(cpu_seconds, 6),
+                                                  'peak_traced_bytes': peak_traced_bytes,
+                                                  'peak_rss_bytes': get_peak_rss_bytes(),
+                                                  'rows_in': rows_in,
+                                                  'rows_out': count_stage_rows(db_file_path, artifact_run_id,
+                                                                               output_table)
+                                                              if COUNT_STAGE_ROWS else None})
+        return instrumented_stage
+    return decorator
+
+
+def count_stage_rows(db_file_path, artifact_run_id, table_name):
+    '''
+    Returns the number of rows of table_name in the stage artifacts of
+    artifact_run_id, or in the db if artifact_run_id is None.
+    '''
+    if artifact_run_id is not None:
+        return count_artifact_rows(artifact_run_id, table_name)
+    return count_table_rows(db_file_path, table_name)
+
+
+def count_table_rows(db_file_path, table_name):
+    '''
+    Returns the number of rows in table_name, or None if no table is given or
+    the db or the table doesn't exist.
+    '''
+    if table_name is None or not os.path.isfile(get_storage_file_path(db_file_path)):
+        return None
+    conn = connect_db(db_file_path)
+    try:
+        if not table_exists(conn, table_name):
+            return None
+        return conn.execute(f'SELECT COUNT(*) FROM "{table_name}"').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def get_peak_rss_bytes():
+    '''
+    Returns the peak resident set size of the process so far in bytes
+    (ru_maxrss is in kilobytes on Linux and in bytes on macOS).
+    '''
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+
+def save_stage_metrics(db_file_path, metrics):
+    '''
+    Appends metrics (a dictionary with the STAGE_METRICS_COLUMNS keys) to the
+    'stage_metrics' table, prints them and rewrites the Prometheus textfile
+    with the latest run of every stage. A failure to save the metrics is
+    printed and never fails the stage itself.
+    '''
+    print(f"Stage {metrics['stage']} {metrics['status']} in {metrics['wall_seconds']:.3f}s "
+          f"(cpu {metrics['cpu_seconds']:.3f}s, rows in {metrics['rows_in']}, rows out {metrics['rows_out']})")
+    if not os.path.isfile(db_file_path):
+        return
+    conn = sqlite3.connect(db_file_path)
+    try:
+        create_stage_metrics_table(conn)
+        conn.execute(f"INSERT INTO stage_metrics ({', '.join(STAGE_METRICS_COLUMNS)}) "
+                     f"VALUES ({', '.join('?' for _ in STAGE_METRICS_COLUMNS)})",
+                     [metrics[column] for column in STAGE_METRICS_COLUMNS])
+        conn.commit()
+        latest = pd.read_sql("SELECT * FROM stage_metrics WHERE rowid IN "
+                             "(SELECT MAX(rowid) FROM stage_metrics GROUP BY stage) ORDER BY stage", conn)
+        write_prometheus_textfile(latest, f"{DB_PATH}/{STAGE_METRICS_FILE_NAME}")
+    except (Error, OSError) as e:
+        print(f"Could not save the metrics of stage {metrics['stage']}: {e}")
+    finally:
+        conn.close()
+
+
+def create_stage_metrics_table(conn):
+    '''
+    Creates the 'stage_metrics' table if it doesn't exist yet.
+    '''
+    conn.execute("CREATE TABLE IF NOT EXISTS stage_metrics "
+                 "(stage TEXT, status TEXT, started_at TEXT, wall_seconds REAL, cpu_seconds REAL, "
+                 "peak_traced_bytes INTEGER, peak_rss_bytes INTEGER, rows_in INTEGER, rows_out INTEGER)")
+
+
+def write_prometheus_textfile(latest_metrics, file_path):
+    '''
+    Writes the latest metrics of every stage (one row per stage) to file_path
+    in the Prometheus text exposition format, to be picked up by the
+    node_exporter textfile collector. The file is written to a temporary file
+    first and moved in place so a scrape never reads a half written file.
+    '''
+    gauges = {'wall_seconds': 'Wall time of the last run of the stage in seconds.',
+              'cpu_seconds': 'CPU time of the last run of the stage in seconds.',
+              'peak_traced_bytes': 'Peak memory traced by tracemalloc during the last run of the stage.',
+              'peak_rss_bytes': 'Peak resident set size of the process at the end of the last run of the stage.',
+              'rows_in': 'Rows in the input table of the stage at the start of its last run.',
+              'rows_out': 'Rows in the output table of the stage at the end of its last run.'}
+    lines = []
+    for column, help_text in gauges.items():
+        name = f"lead_scoring_stage_{column}"
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+        for row in latest_metrics.itertuples(index=False):
+            value = getattr(row, column)
+            if pd.notna(value):
+                # counts come back as floats when another stage left them null
+                value = int(value) if float(value).is_integer() else value
+                lines.append(f'{name}{{stage="{row.stage}",status="{row.status}"}} {value}')
+    name = 'lead_scoring_stage_last_run_timestamp_seconds'
+    lines += [f"# HELP {name} Unix time the last run of the stage started at.", f"# TYPE {name} gauge"]
+    for row in latest_metrics.itertuples(index=False):
+        lines.append(f'{name}{{stage="{row.stage}",status="{row.status}"}} '
+                     f'{datetime.strptime(row.started_at, "%Y-%m-%d %H:%M:%S").timestamp():.0f}')
+
+    temporary_file_path = f"{file_path}.tmp"
+    with open(temporary_file_path, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(temporary_file_path, file_path)
+
+
 ###############################################################################
 # Define the function to build database
 ###############################################################################
 
+@instrument_stage()
 def build_dbs():
     '''
     This function checks if the db file with specified name is present 
@@ -62,23 +267,570 @@ def build_dbs():
                 conn.close()
                 return "DB Created"
 
+###############################################################################
+# Define functions for the stage cache
+###############################################################################
+
+def hash_file(file_path):
+    '''
+    Returns the sha256 hex digest of the contents of file_path, read in
+    blocks so large files are never held in memory.
+    '''
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def get_code_fingerprint():
+    '''
+    Returns the sha256 of the source of this module, which holds the
+    transforms of every cached stage. It goes into every stage fingerprint,
+    so a deploy that changes the code misses the cache instead of keeping
+    the tables the old code wrote.
+    '''
+    return hash_file(os.path.abspath(__file__))
+
+
+def get_stage_fingerprint(stage, *inputs):
+    '''
+    Returns a fingerprint of a stage run from the name of the stage, the
+    code of the stages (see get_code_fingerprint) and everything its output
+    depends on (input table/file fingerprints, mappings and constants).
+    Returns None if any input can't be fingerprinted.
+    '''
+    if any(value is None for value in inputs):
+        return None
+    return hashlib.sha256(repr((stage, get_code_fingerprint()) + inputs).encode('utf-8')).hexdigest()
+
+
+def get_read_options_fingerprint(read_options):
+    '''
+    Returns read_options (pd.read_csv keyword arguments) in a form that can go
+    into a stage fingerprint: a callable, like the usecols filter, is replaced
+    by the bytecode, constants and names of its code, so changing the filter
+    changes the fingerprint.
+    '''
+    def describe(value):
+        if callable(value):
+            code = value.__code__
+            return (code.co_code, code.co_consts, code.co_names)
+        return value
+    return sorted((option, describe(value)) for option, value in read_options.items())
+
+
+def get_table_fingerprint(db_file_path, table_name):
+    '''
+    Returns the fingerprint table_name was last written with by a cached
+    stage, or None if it wasn't written by one (or was overwritten since).
+    '''
+    conn = sqlite3.connect(db_file_path)
+    try:
+        create_stage_cache_tables(conn)
+        row = conn.execute("SELECT fingerprint FROM stage_fingerprints WHERE table_name = ?",
+                           (table_name,)).fetchone()
+    finally:
+        conn.close()
+    return row[0] if row else None
+
+
+def stage_cache_hit(db_file_path, stage, fingerprint, output_tables):
+    '''
+    Returns True if every output table of the stage exists and was last
+    written with fingerprint, in which case the stage can be skipped. The
+    hit or miss is printed and logged in the 'stage_cache_log' table.
+    '''
+    data_conn = connect_db(db_file_path)
+    try:
+        output_tables_exist = all(table_exists(data_conn, table_name) for table_name in output_tables)
+    finally:
+        data_conn.close()
+
+    conn = sqlite3.connect(db_file_path)
+    try:
+        create_stage_cache_tables(conn)
+        hit = fingerprint is not None and output_tables_exist
+        for table_name in output_tables:
+            row = conn.execute("SELECT fingerprint FROM stage_fingerprints WHERE table_name = ?",
+                               (table_name,)).fetchone()
+            hit = hit and row is not None and row[0] == fingerprint
+        conn.execute("INSERT INTO stage_cache_log (stage, fingerprint, result, logged_at) VALUES (?, ?, ?, ?)",
+                     (stage, fingerprint, 'hit' if hit else 'miss',
+                      datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        conn.commit()
+    finally:
+        conn.close()
+
+    if hit:
+        print(f"Stage cache hit for {stage}: inputs are unchanged, skipping.")
+    else:
+        print(f"Stage cache miss for {stage}: running the stage.")
+    return hit
+
+
+def save_stage_fingerprint(db_file_path, fingerprint, output_tables):
+    '''
+    Records fingerprint for each of output_tables after a stage wrote them.
+    Passing None forgets the tables' fingerprints, so the stages reading or
+    writing them miss the cache next time.
+    '''
+    conn = sqlite3.connect(db_file_path)
+    try:
+        create_stage_cache_tables(conn)
+        for table_name in output_tables:
+            if fingerprint is None:
+                conn.execute("DELETE FROM stage_fingerprints WHERE table_name = ?", (table_name,))
+            else:
+                conn.execute("INSERT OR REPLACE INTO stage_fingerprints (table_name, fingerprint, updated_at) "
+                             "VALUES (?, ?, ?)",
+                             (table_name, fingerprint, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def create_stage_cache_tables(conn):
+    '''
+    Creates the 'stage_fingerprints' and 'stage_cache_log' metadata tables if
+    they don't exist yet.
+    '''
+    conn.execute("CREATE TABLE IF NOT EXISTS stage_fingerprints "
+                 "(table_name TEXT PRIMARY KEY, fingerprint TEXT, updated_at TEXT)")
+    conn.execute("CREATE TABLE IF NOT EXISTS stage_cache_log "
+                 "(stage TEXT, fingerprint TEXT, result TEXT, logged_at TEXT)")
+
+
+def get_stage_cache_report(since=None):
+    '''
+    Returns the number of cache hits and misses per stage logged in the
+    'stage_cache_log' table, optionally only those logged at or after since
+    (a 'YYYY-MM-DD HH:MM:SS' string), and prints it.
+
+    SAMPLE USAGE
+        get_stage_cache_report()
+        get_stage_cache_report(since='2024-08-18 00:00:00')
+    '''
+    db_file_path = f"{DB_PATH}/{DB_FILE_NAME}"
+
+    conn = sqlite3.connect(db_file_path)
+    try:
+        create_stage_cache_tables(conn)
+        report = pd.read_sql("SELECT stage, "
+                             "SUM(result = 'hit') AS hits, SUM(result = 'miss') AS misses "
+                             "FROM stage_cache_log WHERE logged_at >= ? GROUP BY stage",
+                             conn, params=(since or '',))
+    finally:
+        conn.close()
+
+    print(report)
+    return report
+
+
+###############################################################################
+# Define the storage backends of the pipeline tables
+###############################################################################
+
+def check_storage_backend(backend):
+    '''
+    Raises a ValueError if backend isn't one of the storage backends.
+    '''
+    if backend not in ('sqlite', 'duckdb'):
+        raise ValueError(f"storage backend must be 'sqlite' or 'duckdb', got {backend!r}")
+
+
+def check_sqlite_storage(feature):
+    '''
+    Raises a ValueError if STORAGE_BACKEND isn't 'sqlite', for the features
+    that run their SQL inside the SQLite db.
+    '''
+    if STORAGE_BACKEND != 'sqlite':
+        raise ValueError(f"{feature} needs STORAGE_BACKEND = 'sqlite', got {STORAGE_BACKEND!r}")
+
+
+def get_storage_file_path(db_file_path, backend=None):
+    '''
+    Returns the path of the file holding the pipeline tables of the db at
+    db_file_path: the db itself for 'sqlite' and a .duckdb file with the same
+    name next to it for 'duckdb'. backend defaults to STORAGE_BACKEND.
+    '''
+    backend = backend or STORAGE_BACKEND
+    check_storage_backend(backend)
+    if backend == 'duckdb':
+        return os.path.splitext(db_file_path)[0] + '.duckdb'
+    return db_file_path
+
+
+def connect_db(db_file_path, backend=None):
+    '''
+    This function opens a connection to the pipeline tables of the db at
+    db_file_path, in the storage backend given by STORAGE_BACKEND. Both
+    connections work with read_table, write_table, table_exists and
+    get_table_columns, so the stages don't depend on where their tables are.
+
+    DuckDB stores the tables column by column and scans, filters and
+    aggregates them vectorized and multi-threaded in-process, which suits the
+    full table reads and rewrites of the cleaning stages better than the
+    row-oriented SQLite db.
+
+
+    INPUTS
+        db_file_path : path of the SQLite db file (DB_PATH/DB_FILE_NAME)
+        backend : 'sqlite' or 'duckdb', defaults to STORAGE_BACKEND
+
+
+    OUTPUT
+        Open sqlite3 or duckdb connection. Raises an ImportError for 'duckdb'
+        if the duckdb package isn't installed.
+
+
+    SAMPLE USAGE
+        conn = connect_db(f"{DB_PATH}/{DB_FILE_NAME}")
+        df = read_table(conn, 'loaded_data')
+    '''
+    backend = backend or STORAGE_BACKEND
+    storage_file_path = get_storage_file_path(db_file_path, backend)
+    if backend == 'duckdb':
+        if duckdb is None:
+            raise ImportError("STORAGE_BACKEND = 'duckdb' needs the duckdb package: pip install duckdb")
+        return duckdb.connect(storage_file_path)
+    return sqlite3.connect(storage_file_path)
+
+
+def read_table(conn, table_name, columns=None, chunksize=None):
+    '''
+    Reads table_name (only columns if given) from a connection returned by
+    connect_db into a dataframe, or into an iterator of dataframes of about
+    chunksize rows if chunksize is passed. This is the reading counterpart of
+    write_table.
+    '''
+    selected = ", ".join(f'"{col}"' for col in columns) if columns else "*"
+    query = f'SELECT {selected} FROM "{table_name}"'
+    if not is_duckdb_connection(conn):
+        return pd.read_sql(query, conn, chunksize=chunksize)
+    if chunksize is None:
+        return conn.execute(query).df()
+    return read_duckdb_chunks(conn.execute(query), chunksize)
+
+
+def read_duckdb_chunks(result, chunksize):
+    '''
+    Yields the rows of a duckdb query result as dataframes of about chunksize
+    rows (duckdb fetches whole vectors of 2048 rows).
+    '''
+    vectors_per_chunk = max(1, chunksize // 2048)
+    while True:
+        chunk = result.fetch_df_chunk(vectors_per_chunk)
+        if chunk.empty:
+            return
+        yield chunk
+
+
+def get_table_columns(conn, table_name):
+    '''
+    Returns the column names of table_name in their order in the table, on a
+    connection returned by connect_db (both backends support table_info).
+    '''
+    return [row[1] for row in conn.execute(f'PRAGMA table_info("{table_name}")').fetchall()]
+
+
+def table_exists(conn, table_name):
+    '''
+    Returns True if table_name exists on a connection returned by connect_db.
+    '''
+    if is_duckdb_connection(conn):
+        query = "SELECT 1 FROM information_schema.tables WHERE table_name = ?"
+    else:
+        query = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?"
+    return conn.execute(query, (table_name,)).fetchone() is not None
+
+
+###############################################################################
+# Define the stage artifact store
+###############################################################################
+
+def check_pyarrow():
+    '''
+    Raises an ImportError if pyarrow, needed for the stage artifacts, isn't
+    installed.
+    '''
+    if pa is None:
+        raise ImportError("The stage artifacts need the pyarrow package: pip install pyarrow")
+
+
+def check_artifact_backend(backend):
+    '''
+    Raises a ValueError if backend can't run on stage artifacts: the 'sql'
+    backend runs inside the db, where the artifacts aren't.
+    '''
+    check_backend(backend)
+    if backend != 'pandas':
+        raise ValueError(f"Stage artifacts need backend='pandas', got {backend!r}")
+
+
+def get_artifact_path(artifact_run_id, name, artifact_format=None):
+    '''
+    Returns the path of the stage artifact name of the DAG run
+    artifact_run_id: DB_PATH/ARTIFACT_DIRECTORY/<run id>/<name>.parquet (or
+    .arrow). Characters of the run id that don't belong in a directory name
+    (Airflow run ids look like 'scheduled__2024-08-18T00:00:00+00:00') are
+    replaced with '_'. artifact_format defaults to ARTIFACT_FORMAT.
+    '''
+    artifact_format = artifact_format or ARTIFACT_FORMAT
+    if artifact_format not in ('parquet', 'arrow'):
+        raise ValueError(f"artifact format must be 'parquet' or 'arrow', got {artifact_format!r}")
+    run_directory = re.sub(r'[^\w.-]', '_', str(artifact_run_id))
+    return os.path.join(DB_PATH, ARTIFACT_DIRECTORY, run_directory, f"{name}.{artifact_format}")
+
+
+def find_artifact_path(artifact_run_id, name):
+    '''
+    Returns the path of the stage artifact name of artifact_run_id in
+    whichever format it was written, or None if it doesn't exist.
+    '''
+    for artifact_format in ('parquet', 'arrow'):
+        path = get_artifact_path(artifact_run_id, name, artifact_format)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def write_artifact(df, artifact_run_id, name):
+    '''
+    This function saves df as the stage artifact name of the DAG run
+    artifact_run_id, so the next task of the run can read it with
+    read_artifact. The artifacts are columnar files written in ARTIFACT_FORMAT:
+    'parquet' (compressed, the smallest on disk) or 'arrow' (Arrow IPC, which
+    read_artifact memory-maps). Either way the dtypes survive the hop between
+    tasks: 'created_date' stays a datetime and the categorical columns stay
+    categoricals, unlike the db tables which store them as text.
+
+    The file is written under a temporary name and moved in place, so a
+    reader never sees a half written artifact and a retried task replaces it.
+
+
+    INPUTS
+        df : dataframe to save, without its index
+        artifact_run_id : DAG run id the artifact belongs to
+        name : name of the artifact, the name of the table it stands in for
+
+
+    OUTPUT
+        Path of the artifact written.
+
+
+    SAMPLE USAGE
+        write_artifact(df, run_id, 'loaded_data')
+    '''
+    path = get_artifact_path(artifact_run_id, name)
+    write_arrow_file(df, path, ARTIFACT_FORMAT)
+
+    print(f"Stage artifact '{name}' saved to {path}.")
+    return path
+
+
+def write_arrow_file(df, path, file_format='parquet'):
+    '''
+    Writes df to path as a 'parquet' or 'arrow' (Arrow IPC) file, creating its
+    directory. The file is written under a temporary name and moved in
+    place, so readers never see a half written file.
+    '''
+    check_pyarrow()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if file_format == 'parquet':
+        pq.write_table(table, path + '.tmp')
+    else:
+        with pa.OSFile(path + '.tmp', 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(path + '.tmp', path)
+
+
+def read_artifact(artifact_run_id, name, columns=None):
+    '''
+    Returns the stage artifact name of artifact_run_id (only columns if
+    given) as a dataframe. Arrow IPC artifacts are memory-mapped and their
+    numeric columns are handed to pandas without a copy; parquet artifacts
+    are decoded from a memory-mapped file. Raises a FileNotFoundError if the
+    artifact wasn't written.
+    '''
+    check_pyarrow()
+    path = find_artifact_path(artifact_run_id, name)
+    if path is None:
+        raise FileNotFoundError(f"No stage artifact '{name}' for the run {artifact_run_id!r}.")
+
+    if path.endswith('.arrow'):
+        table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+        if columns:
+            table = table.select(columns)
+    else:
+        table = pq.read_table(path, columns=columns, memory_map=True)
+    return table.to_pandas(split_blocks=True)
+
+
+def get_artifact_columns(artifact_run_id, name):
+    '''
+    Returns the column names of the stage artifact name of artifact_run_id
+    from its schema, without reading its rows, or [] if it doesn't exist.
+    '''
+    check_pyarrow()
+    path = find_artifact_path(artifact_run_id, name)
+    if path is None:
+        return []
+    if path.endswith('.arrow'):
+        return pa.ipc.open_file(pa.memory_map(path)).schema.names
+    return pq.read_schema(path).names
+
+
+def count_artifact_rows(artifact_run_id, name):
+    '''
+    Returns the number of rows of the stage artifact name of artifact_run_id
+    from its metadata, or None if no name is given, pyarrow isn't installed or
+    the artifact doesn't exist.
+    '''
+    if name is None or pa is None:
+        return None
+    path = find_artifact_path(artifact_run_id, name)
+    if path is None:
+        return None
+    if path.endswith('.arrow'):
+        reader = pa.ipc.open_file(pa.memory_map(path))
+        return sum(reader.get_batch(i).num_rows for i in range(reader.num_record_batches))
+    return pq.ParquetFile(path).metadata.num_rows
+
+
+@instrument_stage()
+def clean_up_artifacts(artifact_run_id, keep_runs=ARTIFACT_KEEP_RUNS):
+    '''
+    This function is the last task of the DAG runs with stage artifacts. Once
+    the run has published its 'model_input' none of its artifacts has a
+    consumer left, so the artifact directory of artifact_run_id is deleted.
+    The directories of the other runs, left by runs that failed before this
+    task, are kept for the keep_runs most recent ones (to debug or retry
+    them) and deleted for the older ones, so the artifacts on disk don't
+    grow with the number of runs.
+
+
+    INPUTS
+        DB_PATH : path where the db file and ARTIFACT_DIRECTORY are present
+        artifact_run_id : DAG run id whose artifacts are deleted
+        keep_runs : number of artifact directories of other runs to keep,
+                    defaults to ARTIFACT_KEEP_RUNS
+
+
+    OUTPUT
+        List of the names of the run directories deleted.
+
+
+    SAMPLE USAGE
+        clean_up_artifacts(artifact_run_id='scheduled__2024-08-18T00:00:00+00:00')
+    '''
+    artifact_directory = os.path.join(DB_PATH, ARTIFACT_DIRECTORY)
+    if not os.path.isdir(artifact_directory):
+        return []
+    run_directory = os.path.dirname(get_artifact_path(artifact_run_id, 'model_input'))
+    other_directories = sorted((entry.path for entry in os.scandir(artifact_directory)
+                                if entry.is_dir() and entry.path != run_directory),
+                               key=os.path.getmtime, reverse=True)
+
+    deleted = [path for path in [run_directory] + other_directories[keep_runs:] if os.path.isdir(path)]
+    for path in deleted:
+        shutil.rmtree(path)
+    print(f"{len(deleted)} stage artifact directories deleted from {artifact_directory}.")
+    return [os.path.basename(path) for path in deleted]
+
+
+def publish_model_input(db_file_path, df_model_input):
+    '''
+    Writes the 'model_input' of an artifact run to the db, the final sink
+    the training pipeline reads it from, and forgets its stage cache
+    fingerprint since it wasn't written by the cached stage.
+    '''
+    conn = connect_db(db_file_path)
+    try:
+        write_table(conn, 'model_input', df_model_input)
+    finally:
+        conn.close()
+    save_stage_fingerprint(db_file_path, None, ['model_input'])
+    print(f"Model input published to the database at {db_file_path} in the 'model_input' table.")
+
+
+def publish_model_input_partitions(db_file_path, partition_keys):
+    '''
+    Replaces the rows of the partitions partition_keys of the db's
+    'model_input' with the rows of their 'model_input' parquet partitions,
+    in one transaction, and leaves the rows of the other partitions as they
+    are. The whole partitioned table is published instead (see
+    publish_model_input) if the db has no 'model_input' yet or its columns
+    differ from the partitions'.
+    '''
+    df_model_input = read_partitions('model_input', partition_keys=partition_keys)
+    conn = connect_db(db_file_path)
+    try:
+        publish_all = (not table_exists(conn, 'model_input')
+                       or get_table_columns(conn, 'model_input') != list(df_model_input.columns))
+        if not publish_all:
+            if not is_duckdb_connection(conn):
+                if conn.in_transaction:
+                    conn.commit()
+                apply_write_pragmas(conn)
+            try:
+                conn.execute("BEGIN")
+                # a key is the 'YYYY-MM-DD' or 'YYYY-MM' prefix of the dates of its rows
+                for key in partition_keys:
+                    conn.execute("DELETE FROM model_input WHERE substr(CAST(created_date AS TEXT), 1, ?) = ?",
+                                 (len(key), key))
+                insert_dataframe(conn, 'model_input', df_model_input)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+    finally:
+        conn.close()
+
+    if publish_all:
+        publish_model_input(db_file_path, read_partitions('model_input'))
+        return
+    save_stage_fingerprint(db_file_path, None, ['model_input'])
+    print(f"{len(partition_keys)} partitions of 'model_input' published to the database at {db_file_path}.")
+
+
 ###############################################################################
 # Define function to load the csv file to the database
 ###############################################################################
 
-def load_data_into_db():
+@instrument_stage(output_table='loaded_data')
+def load_data_into_db(chunksize=None, use_cache=USE_STAGE_CACHE, artifact_run_id=None):
     '''
     Thie function loads the data present in data directory into the db
     which was created previously.
     It also replaces any null values present in 'toal_leads_dropped' and
     'referred_lead' columns with 0.
 
+    If chunksize is passed the csv is streamed in chunks of that many rows
+    instead of being read in one go. Each chunk gets its nulls filled and is
+    appended to 'loaded_data' as soon as it is parsed, and all the chunks are
+    written inside one transaction so a failed load leaves the previous table
+    untouched. Peak memory is bounded by the chunk size rather than the size
+    of the file, and the number of rows loaded per second is printed.
+
 
     INPUTS
         DB_FILE_NAME : Name of the database file
         DB_PATH : path where the db file should be
         DATA_DIRECTORY : path of the directory where 'leadscoring.csv' 
                         file is present
+        chunksize : number of rows to read per chunk. If None (default) the
+                    whole file is read at once.
+        use_cache : if True (default USE_STAGE_CACHE) the stage is skipped when
+                    its input fingerprint matches the one its output was
+                    last written with.
+        artifact_run_id : DAG run id to save the loaded data as the
+                    'loaded_data' stage artifact of (see write_artifact)
+                    instead of the db table. The file is then read in one go
+                    and chunksize and use_cache aren't used.
         
 
     OUTPUT
@@ -89,26 +841,102 @@ def load_data_into_db():
 
     SAMPLE USAGE
         load_data_into_db()
+        load_data_into_db(chunksize=100000)
     '''
     db_file_path = f"{DB_PATH}/{DB_FILE_NAME}"
     
     data_file_path = f"{DATA_DIRECTORY}/leadscoring_test.csv"
-    df = pd.read_csv(data_file_path)
-    
+
+    if artifact_run_id is not None:
+        df = fill_missing_lead_counts(pd.read_csv(data_file_path, **get_raw_data_read_options()))
+        write_artifact(df, artifact_run_id, 'loaded_data')
+        return
+
+    # the dtype plan and the read options decide what is loaded as much as the file does
+    fingerprint = get_stage_fingerprint('load_data_into_db', hash_file(data_file_path),
+                                        raw_data_schema, raw_data_dtypes,
+                                        get_read_options_fingerprint(get_raw_data_read_options()))
+    if use_cache and stage_cache_hit(db_file_path, 'load_data_into_db', fingerprint, ['loaded_data']):
+        return
+
+    if chunksize:
+        load_data_into_db_in_chunks(db_file_path, data_file_path, chunksize)
+    else:
+        df = pd.read_csv(data_file_path, **get_raw_data_read_options())
+        
+        df = fill_missing_lead_counts(df)
+        
+        conn = connect_db(db_file_path)
+        
+        write_table(conn, 'loaded_data', df)
+        
+        conn.close()
+
+        print(f"Data loaded into the database at {db_file_path} in the 'loaded_data' table.")
+
+    save_stage_fingerprint(db_file_path, fingerprint, ['loaded_data'])
+
+
+def get_raw_data_read_options():
+    '''
+    Returns the pd.read_csv keyword arguments that apply the dtype plan in
+    schema.py's raw_data_dtypes while the csv is parsed: only the columns of
+    raw_data_schema are read, 'created_date' is parsed as a datetime, the
+    cities and LevelN columns are read as categoricals and the counts and flags get
+    compact numeric dtypes, so no compression pass is needed afterwards.
+    '''
+    date_columns = [col for col, dtype in raw_data_dtypes.items() if dtype.startswith('datetime')]
+    return {'usecols': lambda column: column in raw_data_dtypes,
+            'dtype': {col: dtype for col, dtype in raw_data_dtypes.items() if col not in date_columns},
+            'parse_dates': date_columns}
+
+
+def fill_missing_lead_counts(df):
+    '''
+    Replaces the null values in 'total_leads_dropped' and 'referred_lead'
+    with 0 and returns the dataframe.
+    '''
     if 'total_leads_dropped' in df.columns:
         df['total_leads_dropped'] = df['total_leads_dropped'].fillna(0)
     
     if 'referred_lead' in df.columns:
         df['referred_lead'] = df['referred_lead'].fillna(0)
-    
-    conn = sqlite3.connect(db_file_path)
-    
-    df.to_sql('loaded_data', con=conn, if_exists='replace', index=False)
-    
-    conn.commit()
-    conn.close()
 
-    print(f"Data loaded into the database at {db_file_path} in the 'loaded_data' table.")
+    return df
+
+
+def load_data_into_db_in_chunks(db_file_path, data_file_path, chunksize):
+    '''
+    Streams the csv at data_file_path into the 'loaded_data' table of the db
+    at db_file_path, chunksize rows at a time. The table is dropped, recreated
+    from the first chunk's schema and filled in a single transaction which is
+    rolled back if any chunk fails.
+    '''
+    start_time = time.time()
+    total_rows = 0
+
+    conn = connect_db(db_file_path)
+    if not is_duckdb_connection(conn):
+        apply_write_pragmas(conn)
+    try:
+        conn.execute("BEGIN")
+        conn.execute("DROP TABLE IF EXISTS loaded_data")
+
+        for chunk in pd.read_csv(data_file_path, chunksize=chunksize, **get_raw_data_read_options()):
+            chunk = fill_missing_lead_counts(chunk)
+            insert_dataframe(conn, 'loaded_data', chunk)
+            total_rows += len(chunk)
+
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    elapsed = max(time.time() - start_time, 1e-9)
+    print(f"Data streamed into the database at {db_file_path} in the 'loaded_data' table: "
+          f"{total_rows} rows in {elapsed:.2f}s ({total_rows / elapsed:.0f} rows/sec).")
     
 
 ###############################################################################
@@ -116,7 +944,8 @@ def load_data_into_db():
 ###############################################################################
 
     
-def map_city_tier():
+@instrument_stage(input_table='loaded_data', output_table='city_tier_mapped')
+def map_city_tier(use_cache=USE_STAGE_CACHE, backend=EXECUTION_BACKEND, artifact_run_id=None):
     '''
     This function maps all the cities to their respective tier as per the
     mappings provided in the city_tier_mapping.py file. If a
@@ -124,17 +953,32 @@ def map_city_tier():
     file then the function maps that particular city to 3.0 which represents
     tier-3.
 
+    City names are matched after normalize_city_name (case and whitespace
+    are ignored), and the cities that still aren't mapped are counted in the
+    'city_tier_misses' table so the mapping can be extended.
+
 
     INPUTS
         DB_FILE_NAME : Name of the database file
         DB_PATH : path where the db file should be
         city_tier_mapping : a dictionary that maps the cities to their tier
+        use_cache : if True (default USE_STAGE_CACHE) the stage is skipped when
+                    its input fingerprint matches the one its output was
+                    last written with.
+        backend : 'pandas' to run the transform on a dataframe or 'sql' to run
+                  it inside SQLite (see the push-down SQL backend). Defaults
+                  to EXECUTION_BACKEND.
+        artifact_run_id : DAG run id whose stage artifacts the stage reads and
+                  writes instead of the db tables (see write_artifact). If
+                  None (default) the db tables are used.
 
     
     OUTPUT
         Saves the processed dataframe in the db in a table named
         'city_tier_mapped'. If the table with the same name already 
         exsists then the function replaces it.
+        Saves the unmapped cities with their number of leads in a table
+        named 'city_tier_misses', replacing it as well.
 
     
     SAMPLE USAGE
@@ -142,32 +986,108 @@ def map_city_tier():
 
     '''
     db_file_path = f"{DB_PATH}/{DB_FILE_NAME}"
+
+    if artifact_run_id is not None:
+        check_artifact_backend(backend)
+        df, df_misses = apply_city_tier_mapping(read_artifact(artifact_run_id, 'loaded_data'), return_misses=True)
+        write_artifact(df, artifact_run_id, 'city_tier_mapped')
+        write_artifact(df_misses, artifact_run_id, 'city_tier_misses')
+        return
+
+    fingerprint = get_stage_fingerprint('map_city_tier',
+                                        get_table_fingerprint(db_file_path, 'loaded_data'),
+                                        city_tier_mapping)
+    if use_cache and stage_cache_hit(db_file_path, 'map_city_tier', fingerprint,
+                                     ['city_tier_mapped', 'city_tier_misses']):
+        return
     
-    conn = sqlite3.connect(db_file_path)
+    check_backend(backend)
+    conn = connect_db(db_file_path)
+    
+    if backend == 'sql':
+        run_sql_transform(conn, {'city_tier_mapped': get_city_tier_query(conn),
+                                 'city_tier_misses': get_city_tier_misses_query()})
+    else:
+        df = read_table(conn, 'loaded_data')
+        
+        df, df_misses = apply_city_tier_mapping(df, return_misses=True)
+        
+        write_table(conn, 'city_tier_mapped', df)
+        write_table(conn, 'city_tier_misses', df_misses)
     
-    query = "SELECT * FROM loaded_data"
-    df = pd.read_sql(query, conn)
+    conn.close()
+
+    save_stage_fingerprint(db_file_path, fingerprint, ['city_tier_mapped', 'city_tier_misses'])
+
+    print(f"Data with city tiers mapped has been saved to the database at {db_file_path} in the 'city_tier_mapped' table.")
+
+
+def apply_city_tier_mapping(df, return_misses=False):
+    '''
+    Adds the 'city_tier' column to df from 'city_mapped' using city_tier_mapping,
+    defaulting unmapped cities to 3.0, and drops 'city_mapped'. This is the
+    in-memory transform behind map_city_tier().
+
+    'city_mapped' is factorized once (a categorical read with the dtype plan
+    of get_raw_data_read_options already is), only its distinct values are
+    normalized and looked up, and the tier of every row is taken from the
+    tiers of the distinct values by its code. The cost of the lookup grows
+    with the number of distinct cities and not with the number of rows.
+
+    If return_misses is True a dataframe of the unmapped cities is returned
+    too, with the columns 'city_mapped', 'normalized_city' and 'lead_count'
+    (null cities are counted in a row with a null 'city_mapped').
+    '''
+    if isinstance(df['city_mapped'].dtype, pd.CategoricalDtype):
+        codes, cities = df['city_mapped'].cat.codes.to_numpy(), df['city_mapped'].cat.categories
+    else:
+        codes, cities = pd.factorize(df['city_mapped'])
+    normalized_cities = [normalize_city_name(city) for city in cities]
     
-    df['city_tier'] = df['city_mapped'].map(city_tier_mapping)
+    # the last tier is the one of the null cities (code -1)
+    tiers = np.array([CITY_TIER_LOOKUP.get(city, np.nan) for city in normalized_cities] + [np.nan])
+    df['city_tier'] = tiers[codes]
     
     # Fill any missing values with 3.0 (default tier)
     df['city_tier'] = df['city_tier'].fillna(3.0)
     
     df = df.drop(['city_mapped'], axis = 1)
-    
-    df.to_sql('city_tier_mapped', con=conn, if_exists='replace', index=False)
-    
-    conn.commit()
-    conn.close()
 
-    print(f"Data with city tiers mapped has been saved to the database at {db_file_path} in the 'city_tier_mapped' table.")
+    if not return_misses:
+        return df
+
+    unmapped = np.isnan(tiers[:-1])
+    df_misses = pd.DataFrame({'city_mapped': np.asarray(cities, dtype=object)[unmapped],
+                              'normalized_city': np.array(normalized_cities, dtype=object)[unmapped],
+                              'lead_count': np.bincount(codes[codes >= 0], minlength=len(cities))[unmapped]})
+    null_count = int((codes == -1).sum())
+    if null_count:
+        df_misses = pd.concat([df_misses, pd.DataFrame({'city_mapped': [None], 'normalized_city': [None],
+                                                        'lead_count': [null_count]})], ignore_index=True)
+    df_misses = df_misses.sort_values('lead_count', ascending=False, kind='stable').reset_index(drop=True)
+
+    return df, df_misses
+
+
+@lru_cache(maxsize=CITY_NAME_CACHE_SIZE)
+def normalize_city_name(city):
+    '''
+    Returns city in lower case with the whitespace around and inside it
+    collapsed, so 'Navi  Mumbai ' and 'navi mumbai' map to the same tier.
+    '''
+    return " ".join(str(city).split()).lower()
+
+
+# city_tier_mapping with normalized city names
+CITY_TIER_LOOKUP = {normalize_city_name(city): tier for city, tier in city_tier_mapping.items()}
 
 ###############################################################################
 # Define function to map insignificant categorial variables to "others"
 ###############################################################################
 
 
-def map_categorical_vars():
+@instrument_stage(input_table='city_tier_mapped', output_table='categorical_variables_mapped')
+def map_categorical_vars(use_cache=USE_STAGE_CACHE, backend=EXECUTION_BACKEND, artifact_run_id=None):
     '''
     This function maps all the insignificant variables present in 'first_platform_c'
     'first_utm_medium_c' and 'first_utm_source_c'. The list of significant variables
@@ -181,6 +1101,18 @@ def map_categorical_vars():
         list_platform : list of all the significant platform.
         list_medium : list of all the significat medium
         list_source : list of all rhe significant source
+        significant_levels_by_column : dictionary mapping each column to be
+                 remapped to its list of significant levels. Extra columns
+                 can be remapped the same way by adding them here.
+        use_cache : if True (default USE_STAGE_CACHE) the stage is skipped when
+                    its input fingerprint matches the one its output was
+                    last written with.
+        backend : 'pandas' to run the transform on a dataframe or 'sql' to run
+                  it inside SQLite (see the push-down SQL backend). Defaults
+                  to EXECUTION_BACKEND.
+        artifact_run_id : DAG run id whose stage artifacts the stage reads and
+                  writes instead of the db tables (see write_artifact). If
+                  None (default) the db tables are used.
 
         **NOTE : list_platform, list_medium & list_source are all constants and
                  must be stored in 'significant_categorical_level.py'
@@ -201,39 +1133,87 @@ def map_categorical_vars():
     
     db_file_path = f"{DB_PATH}/{DB_FILE_NAME}"
 
-    conn = sqlite3.connect(db_file_path)
-    
-    query = "SELECT * FROM city_tier_mapped"
-    df = pd.read_sql(query, conn)
-    
-    # Define a mapping function
-    def map_to_significant_levels(column, significant_levels):
-        """
-        Map the column values to significant levels, replacing insignificant levels
-        with 'Other'.
-        """
-        df[column] = df[column].apply(lambda x: x if x in significant_levels else 'others')
-    
-    # Map each categorical variable using the defined lists
-    map_to_significant_levels('first_platform_c', list_platform)
-    map_to_significant_levels('first_utm_medium_c', list_medium)
-    map_to_significant_levels('first_utm_source_c', list_source)
+    if artifact_run_id is not None:
+        check_artifact_backend(backend)
+        df = apply_categorical_mapping(read_artifact(artifact_run_id, 'city_tier_mapped'))
+        write_artifact(df, artifact_run_id, 'categorical_variables_mapped')
+        return
+
+    fingerprint = get_stage_fingerprint('map_categorical_vars',
+                                        get_table_fingerprint(db_file_path, 'city_tier_mapped'),
+                                        significant_levels_by_column)
+    if use_cache and stage_cache_hit(db_file_path, 'map_categorical_vars', fingerprint,
+                                     ['categorical_variables_mapped']):
+        return
+
+    check_backend(backend)
+    conn = connect_db(db_file_path)
     
-    # Save the processed DataFrame to the database
-    df.to_sql('categorical_variables_mapped', con=conn, if_exists='replace', index=False)
+    if backend == 'sql':
+        run_sql_transform(conn, {'categorical_variables_mapped': get_categorical_query(conn)})
+    else:
+        df = read_table(conn, 'city_tier_mapped')
+        
+        df = apply_categorical_mapping(df)
+        
+        # Save the processed DataFrame to the database
+        write_table(conn, 'categorical_variables_mapped', df)
     
-    # Commit changes and close the connection
-    conn.commit()
     conn.close()
 
+    save_stage_fingerprint(db_file_path, fingerprint, ['categorical_variables_mapped'])
+
     print(f"Data with categorical variables mapped has been saved to the database at {db_file_path} in the 'categorical_variables_mapped' table.")
 
 
+def apply_categorical_mapping(df, significant_levels=None):
+    '''
+    Replaces the insignificant levels of every column in significant_levels
+    (by default 'first_platform_c', 'first_utm_medium_c' and 'first_utm_source_c'
+    from significant_levels_by_column) in df with 'others'. This is the
+    in-memory transform behind map_categorical_vars().
+
+    Each column is factorized once so membership is only checked for its
+    distinct values, and the whole column is then remapped in one vectorized
+    step instead of testing every row against the list of levels.
+    '''
+    if significant_levels is None:
+        significant_levels = SIGNIFICANT_LEVEL_LOOKUP
+    else:
+        significant_levels = compile_significant_levels(significant_levels)
+
+    for column, levels in significant_levels.items():
+        if column not in df.columns:
+            continue
+        codes, uniques = pd.factorize(df[column])
+        # codes are -1 for nulls, which are never a significant level
+        is_significant = np.append(uniques.isin(levels), False)
+        if isinstance(df[column].dtype, pd.CategoricalDtype) and 'others' not in df[column].cat.categories:
+            df[column] = df[column].cat.add_categories(['others'])
+        df[column] = df[column].where(is_significant[codes], 'others')
+        if isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].cat.remove_unused_categories()
+
+    return df
+
+
+def compile_significant_levels(significant_levels):
+    '''
+    Turns a {column: list of levels} mapping into {column: pd.Index of levels}
+    so the levels are hashed once and reused for every lookup.
+    '''
+    return {column: pd.Index(levels).unique() for column, levels in significant_levels.items()}
+
+
+SIGNIFICANT_LEVEL_LOOKUP = compile_significant_levels(significant_levels_by_column)
+
+
 
 ##############################################################################
 # Define function that maps interaction columns into 4 types of interactions
 ##############################################################################
-def interactions_mapping():
+@instrument_stage(input_table='categorical_variables_mapped', output_table='model_input')
+def interactions_mapping(use_cache=USE_STAGE_CACHE, backend=EXECUTION_BACKEND, artifact_run_id=None):
     '''
     This function maps the interaction columns into 4 unique interaction columns
     These mappings are present in 'interaction_mapping.csv' file. 
@@ -249,6 +1229,15 @@ def interactions_mapping():
         INDEX_COLUMNS_INFERENCE: list of columns to be used as index while pivoting and
                                  unpivoting during inference
         NOT_FEATURES: Features which have less significance and needs to be dropped
+        use_cache : if True (default USE_STAGE_CACHE) the stage is skipped when
+                    its input fingerprint matches the one its output was
+                    last written with.
+        backend : 'pandas' to run the transform on a dataframe or 'sql' to run
+                  it inside SQLite (see the push-down SQL backend). Defaults
+                  to EXECUTION_BACKEND.
+        artifact_run_id : DAG run id whose stage artifacts the stage reads and
+                  writes instead of the db tables (see write_artifact). If
+                  None (default) the db tables are used.
                                  
         NOTE : Since while inference we will not have 'app_complete_flag' which is
         our label, we will have to exculde it from our features list. It is recommended 
@@ -266,58 +1255,1204 @@ def interactions_mapping():
         It also drops all the features that are not requried for training model and 
         writes it in a table named 'model_input'
 
+        The hashes of the distinct leads are saved in the 'lead_hashes' table
+        (see save_lead_hashes), replacing the previous ones, so incremental
+        runs can drop the leads that were already processed.
+
+        With an artifact_run_id both outputs are saved as stage artifacts
+        instead, and 'model_input' is then published to the db as the final
+        sink if PUBLISH_MODEL_INPUT is True.
+
     
     SAMPLE USAGE
         interactions_mapping()
     '''
     db_file_path = f"{DB_PATH}/{DB_FILE_NAME}"
+
+    if artifact_run_id is not None:
+        check_artifact_backend(backend)
+        df = read_artifact(artifact_run_id, 'categorical_variables_mapped')
+        lead_hashes = get_lead_hashes(df)
+        df_pivot = apply_interactions_mapping(df, lead_hashes)
+        df_model_input = get_model_input(df_pivot)
+        write_artifact(df_pivot, artifact_run_id, 'interactions_mapped')
+        write_artifact(df_model_input, artifact_run_id, 'model_input')
+        replace_lead_hashes(db_file_path, lead_hashes)
+        if PUBLISH_MODEL_INPUT:
+            publish_model_input(db_file_path, df_model_input)
+        return
+
+    fingerprint = get_stage_fingerprint('interactions_mapping',
+                                        get_table_fingerprint(db_file_path, 'categorical_variables_mapped'),
+                                        hash_file(INTERACTION_MAPPING),
+                                        INDEX_COLUMNS_TRAINING, NOT_FEATURES)
+    if use_cache and stage_cache_hit(db_file_path, 'interactions_mapping', fingerprint,
+                                     ['interactions_mapped', 'model_input']):
+        return
     
-    conn = sqlite3.connect(db_file_path)
-    
-    df_event_mapping = pd.read_csv(INTERACTION_MAPPING, index_col=0)
+    check_backend(backend)
+    conn = connect_db(db_file_path)
     
-    # Load the data from the database
-    query = "SELECT * FROM categorical_variables_mapped"
-    df = pd.read_sql(query, conn)
+    if backend == 'sql':
+        run_sql_transform(conn, {'interactions_mapped': get_interactions_query(conn)})
+        run_sql_transform(conn, {'model_input': get_model_input_query(conn)})
+        
+        # The hashes are computed in chunks so the table is never held in memory
+        lead_hashes = [get_lead_hashes(chunk) for chunk in
+                       pd.read_sql("SELECT * FROM categorical_variables_mapped", conn, chunksize=CHUNK_SIZE)]
+        save_lead_hashes(conn, np.concatenate(lead_hashes) if lead_hashes else [], replace=True)
+        conn.commit()
+    else:
+        # Load the data from the database
+        df = read_table(conn, 'categorical_variables_mapped')
+        
+        lead_hashes = get_lead_hashes(df)
+        df_pivot = apply_interactions_mapping(df, lead_hashes)
+        
+        # Save the processed DataFrame to the database
+        write_table(conn, 'interactions_mapped', df_pivot)
+        
+        replace_lead_hashes(db_file_path, lead_hashes)
+        
+        # Save the model input DataFrame
+        df_model_input = get_model_input(df_pivot)
+        write_table(conn, 'model_input', df_model_input)
     
-    df = df.drop_duplicates()
+    conn.close()
+
+    save_stage_fingerprint(db_file_path, fingerprint, ['interactions_mapped', 'model_input'])
     
-    df_unpivot = pd.melt(df, id_vars=INDEX_COLUMNS_TRAINING, var_name='interaction_type', value_name='interaction_value')
+    print(f"Interaction columns have been mapped and saved to 'interactions_mapped'. Model input features saved to 'model_input'.")
+
+
+def apply_interactions_mapping(df, lead_hashes=None):
+    '''
+    Drops duplicate rows from df and sums its interaction columns into the
+    interaction groups of INTERACTION_MAPPING, dropping NOT_FEATURES. This is
+    the in-memory transform behind interactions_mapping().
+
+    Duplicate rows are found by their hash (lead_hashes, as returned by
+    get_lead_hashes for df, is computed if not passed) and the first of them
+    is kept, as df.drop_duplicates() did.
+
+    The mapping is compiled into a column-to-group indicator matrix, so all the
+    interaction groups are computed with one matrix product over the wide frame
+    instead of melting it into a long frame and pivoting it back.
+    '''
+    interaction_matrix = compile_interaction_matrix(INTERACTION_MAPPING)
     
-    # Fill NaN values in interaction_value column
-    df_unpivot['interaction_value'] = df_unpivot['interaction_value'].fillna(0)
+    if lead_hashes is None:
+        lead_hashes = get_lead_hashes(df)
+    df = df[~pd.Series(lead_hashes).duplicated().to_numpy()]
     
-    # Merge with the interaction mapping
-    df = pd.merge(df_unpivot, df_event_mapping, on='interaction_type', how='left')
+    # Only the columns named in the mapping feed the interaction groups
+    interaction_columns = [col for col in df.columns
+                           if col not in INDEX_COLUMNS_TRAINING and col in interaction_matrix.index]
+    indicator = interaction_matrix.loc[interaction_columns]
+    indicator = indicator.loc[:, indicator.any(axis=0)]
     
-    # Drop the original interaction_type column
-    df = df.drop(['interaction_type'], axis=1)
+    # Fill NaN interaction values with 0 and sum them per group
+    interaction_values = df[interaction_columns].astype(float).fillna(0).to_numpy()
+    df_groups = pd.DataFrame(interaction_values @ indicator.to_numpy(dtype=float),
+                             columns=indicator.columns, index=df.index)
     
-    # Pivot the DataFrame to aggregate interaction values
-    df_pivot = df.pivot_table(
-        values='interaction_value', 
-        index=INDEX_COLUMNS_TRAINING, 
-        columns='interaction_mapping', 
-        aggfunc='sum'
-    )
+    df_pivot = pd.concat([df[INDEX_COLUMNS_TRAINING], df_groups], axis=1)
     
-    # Reset index to flatten the DataFrame
-    df_pivot = df_pivot.reset_index()
+    # Leads with a missing index value are dropped and leads sharing all the
+    # index values are summed together, as pivoting on the index columns did
+    df_pivot = df_pivot.dropna(subset=INDEX_COLUMNS_TRAINING)
+    if df_pivot.duplicated(subset=INDEX_COLUMNS_TRAINING).any():
+        df_pivot = df_pivot.groupby(INDEX_COLUMNS_TRAINING, observed=True).sum().reset_index()
+    df_pivot = df_pivot.sort_values(by=INDEX_COLUMNS_TRAINING).reset_index(drop=True)
     
     # Drop columns that are not needed for the model
     features_to_drop = [col for col in df_pivot.columns if col in NOT_FEATURES]
     df_pivot = df_pivot.drop(columns=features_to_drop, errors='ignore')
-    
-    # Save the processed DataFrame to the database
-    df_pivot.to_sql('interactions_mapped', con=conn, if_exists='replace', index=False)
-    
-    # Save the model input DataFrame
+
+    return df_pivot
+
+
+@lru_cache(maxsize=None)
+def compile_interaction_matrix(interaction_mapping_file):
+    '''
+    Reads the interaction mapping csv and returns it as an indicator matrix with
+    one row per interaction column and one column per interaction group
+    (sorted by name), holding the number of times the column is mapped to the
+    group. The matrix is cached per file so it is only built once per process.
+    '''
+    df_event_mapping = pd.read_csv(interaction_mapping_file)
+    return pd.crosstab(df_event_mapping['interaction_type'], df_event_mapping['interaction_mapping'])
+
+
+def get_model_input(df_pivot):
+    '''
+    Returns the 'model_input' frame for an interactions mapped frame: the
+    INDEX_COLUMNS_TRAINING followed by the remaining feature columns.
+    '''
     model_input_columns = [col for col in df_pivot.columns if col not in INDEX_COLUMNS_TRAINING]
-    df_model_input = df_pivot[INDEX_COLUMNS_TRAINING + model_input_columns]
-    df_model_input.to_sql('model_input', con=conn, if_exists='replace', index=False)
+    return df_pivot[INDEX_COLUMNS_TRAINING + model_input_columns]
+
+
+###############################################################################
+# Define the push-down SQL backend of the cleaning transforms
+###############################################################################
+
+def check_backend(backend):
+    '''
+    Raises a ValueError if backend isn't one of the execution backends, or is
+    'sql' while the pipeline tables aren't stored in SQLite.
+    '''
+    if backend not in ('pandas', 'sql'):
+        raise ValueError(f"backend must be 'pandas' or 'sql', got {backend!r}")
+    if backend == 'sql':
+        check_sqlite_storage("backend='sql'")
+
+
+def run_sql_transform(conn, queries):
+    '''
+    Replaces every table in queries (a dictionary of table name to SELECT
+    query) with the result of its query, inside SQLite and in one
+    transaction, so the rows never leave the db. The lookup tables the
+    queries join against are rebuilt in the same transaction (see
+    create_lookup_tables).
+    '''
+    if conn.in_transaction:
+        conn.commit()
+    apply_write_pragmas(conn)
+    try:
+        conn.execute("BEGIN")
+        create_lookup_tables(conn)
+        for table_name, query in queries.items():
+            conn.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+            conn.execute(f'CREATE TABLE "{table_name}" AS {query}')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def create_lookup_tables(conn):
+    '''
+    Loads the mappings used by the cleaning transforms into small lookup
+    tables without committing: 'city_tier_lookup' (normalized city name to
+    tier, from city_tier_mapping) and 'significant_levels_lookup' (column and
+    significant level, from significant_levels_by_column). It also registers
+    normalize_city_name as an SQL function, so cities are matched exactly as
+    the pandas backend matches them.
+    '''
+    conn.create_function('normalize_city_name', 1, normalize_city_name, deterministic=True)
+    conn.execute("DROP TABLE IF EXISTS city_tier_lookup")
+    conn.execute("CREATE TABLE city_tier_lookup (city TEXT PRIMARY KEY, city_tier REAL)")
+    conn.executemany("INSERT INTO city_tier_lookup (city, city_tier) VALUES (?, ?)",
+                     [(city, float(tier)) for city, tier in CITY_TIER_LOOKUP.items()])
+    conn.execute("DROP TABLE IF EXISTS significant_levels_lookup")
+    conn.execute("CREATE TABLE significant_levels_lookup "
+                 "(column_name TEXT, level TEXT, PRIMARY KEY (column_name, level))")
+    conn.executemany("INSERT INTO significant_levels_lookup (column_name, level) VALUES (?, ?)",
+                     [(column, level) for column, levels in SIGNIFICANT_LEVEL_LOOKUP.items() for level in levels])
+
+
+def get_city_tier_query(conn):
+    '''
+    Returns the query behind 'city_tier_mapped' in the SQL backend: the rows of
+    'loaded_data' without 'city_mapped', with the tier of the normalized city
+    joined from 'city_tier_lookup' and 3.0 for the unmapped cities.
+    '''
+    columns = ", ".join(f'd."{col}"' for col in get_table_columns(conn, 'loaded_data') if col != 'city_mapped')
+    return (f"SELECT {columns}, COALESCE(l.city_tier, 3.0) AS city_tier "
+            f"FROM loaded_data AS d LEFT JOIN city_tier_lookup AS l "
+            f"ON d.city_mapped IS NOT NULL AND l.city = normalize_city_name(d.city_mapped) "
+            f"ORDER BY d.rowid")
+
+
+def get_city_tier_misses_query():
+    '''
+    Returns the query behind 'city_tier_misses' in the SQL backend: the
+    unmapped cities of 'loaded_data' with their number of leads, ordered as
+    apply_city_tier_mapping orders them.
+    '''
+    return ("SELECT d.city_mapped, "
+            "CASE WHEN d.city_mapped IS NULL THEN NULL ELSE normalize_city_name(d.city_mapped) END AS normalized_city, "
+            "COUNT(*) AS lead_count "
+            "FROM loaded_data AS d LEFT JOIN city_tier_lookup AS l "
+            "ON d.city_mapped IS NOT NULL AND l.city = normalize_city_name(d.city_mapped) "
+            "WHERE l.city IS NULL GROUP BY d.city_mapped "
+            "ORDER BY lead_count DESC, d.city_mapped IS NULL, MIN(d.rowid)")
+
+
+def get_categorical_query(conn):
+    '''
+    Returns the query behind 'categorical_variables_mapped' in the SQL backend:
+    the rows of 'city_tier_mapped' with every column of
+    significant_levels_by_column remapped by a CASE to itself when it is one
+    of its levels in 'significant_levels_lookup' and to 'others' otherwise.
+    '''
+    columns = []
+    for col in get_table_columns(conn, 'city_tier_mapped'):
+        if col in SIGNIFICANT_LEVEL_LOOKUP:
+            columns.append(f'CASE WHEN "{col}" IN (SELECT level FROM significant_levels_lookup '
+                           f"WHERE column_name = '{col}') THEN \"{col}\" ELSE 'others' END AS \"{col}\"")
+        else:
+            columns.append(f'"{col}"')
+    return f"SELECT {', '.join(columns)} FROM city_tier_mapped ORDER BY rowid"
+
+
+def get_interactions_query(conn):
+    '''
+    Returns the query behind 'interactions_mapped' in the SQL backend: the
+    distinct rows of 'categorical_variables_mapped' without a null index
+    column, grouped by INDEX_COLUMNS_TRAINING, with one SUM per interaction
+    group of INTERACTION_MAPPING over its columns (nulls counting as 0) and
+    without NOT_FEATURES, as apply_interactions_mapping computes them.
+    '''
+    interaction_matrix = compile_interaction_matrix(INTERACTION_MAPPING)
+    interaction_columns = [col for col in get_table_columns(conn, 'categorical_variables_mapped')
+                           if col not in INDEX_COLUMNS_TRAINING and col in interaction_matrix.index]
+    indicator = interaction_matrix.loc[interaction_columns]
+    indicator = indicator.loc[:, indicator.any(axis=0)]
+
+    index_columns = ", ".join(f'"{col}"' for col in INDEX_COLUMNS_TRAINING)
+    columns = [f'"{col}"' for col in INDEX_COLUMNS_TRAINING if col not in NOT_FEATURES]
+    for group in indicator.columns:
+        if group in NOT_FEATURES:
+            continue
+        terms = [f'COALESCE("{col}", 0)' if count == 1 else f'{count} * COALESCE("{col}", 0)'
+                 for col, count in indicator[group].items() if count]
+        columns.append(f'SUM({" + ".join(terms)}) AS "{group}"')
+    not_null = " AND ".join(f'"{col}" IS NOT NULL' for col in INDEX_COLUMNS_TRAINING)
+    return (f"SELECT {', '.join(columns)} FROM (SELECT DISTINCT * FROM categorical_variables_mapped) "
+            f"WHERE {not_null} GROUP BY {index_columns} ORDER BY {index_columns}")
+
+
+def get_model_input_query(conn):
+    '''
+    Returns the query behind 'model_input' in the SQL backend, selecting the
+    columns of 'interactions_mapped' in the order get_model_input uses.
+    '''
+    table_columns = get_table_columns(conn, 'interactions_mapped')
+    model_input_columns = INDEX_COLUMNS_TRAINING + [col for col in table_columns if col not in INDEX_COLUMNS_TRAINING]
+    columns = ", ".join(f'"{col}"' for col in model_input_columns)
+    return f"SELECT {columns} FROM interactions_mapped"
+
+
+def check_backend_parity():
+    '''
+    This function checks that the SQL backend gives the same output as the
+    pandas backend. Each transform is run by both backends on the current
+    input table in the db ('loaded_data', 'city_tier_mapped' and
+    'categorical_variables_mapped') and their outputs are compared; nothing is
+    written except the lookup tables.
+
+
+    INPUTS
+        DB_FILE_NAME : Name of the database file
+        DB_PATH : path where the db file should be present
+
+
+    OUTPUT
+        Dataframe with the columns 'table_name', 'pandas_rows', 'sql_rows',
+        'status' ('passed' or 'failed') and 'difference' (the first
+        difference found), which is printed.
+
+
+    SAMPLE USAGE
+        check_backend_parity()
+    '''
+    check_sqlite_storage('check_backend_parity')
+    conn = sqlite3.connect(f"{DB_PATH}/{DB_FILE_NAME}")
+    try:
+        create_lookup_tables(conn)
+        conn.commit()
+
+        df_city_tier, df_misses = apply_city_tier_mapping(pd.read_sql("SELECT * FROM loaded_data", conn),
+                                                          return_misses=True)
+        df_pivot = apply_interactions_mapping(pd.read_sql("SELECT * FROM categorical_variables_mapped", conn))
+        checks = [('city_tier_mapped', df_city_tier, get_city_tier_query(conn)),
+                  ('city_tier_misses', df_misses, get_city_tier_misses_query()),
+                  ('categorical_variables_mapped',
+                   apply_categorical_mapping(pd.read_sql("SELECT * FROM city_tier_mapped", conn)),
+                   get_categorical_query(conn)),
+                  ('interactions_mapped', df_pivot, get_interactions_query(conn))]
+
+        rows = []
+        for table_name, df_pandas, query in checks:
+            df_sql = pd.read_sql(query, conn)
+            try:
+                # Nulls are read back from SQLite as None and computed by pandas as NaN
+                pd.testing.assert_frame_equal(df_pandas.reset_index(drop=True).astype(object).fillna(np.nan),
+                                              df_sql.astype(object).fillna(np.nan), check_dtype=False)
+                status, difference = 'passed', None
+            except AssertionError as e:
+                status, difference = 'failed', str(e).strip().splitlines()[0]
+            rows.append({'table_name': table_name, 'pandas_rows': len(df_pandas), 'sql_rows': len(df_sql),
+                         'status': status, 'difference': difference})
+    finally:
+        conn.close()
+
+    report = pd.DataFrame(rows)
+    print(report)
+    return report
+
+
+###############################################################################
+# Define functions to deduplicate leads across runs
+###############################################################################
+
+def get_lead_hashes(df):
+    '''
+    Returns a 64-bit hash of every row of df (as a signed int64 array, the
+    integer type of SQLite) computed with pd.util.hash_pandas_object.
+
+    The columns are hashed in name order after casting them to one canonical
+    dtype per kind (datetimes and the date columns of raw_data_dtypes to int64
+    nanoseconds, numbers and the numeric columns of raw_data_dtypes to
+    float64, everything else to python objects), so a lead gets the same hash
+    whether it was read from the csv with the dtype plan or read back from a
+    table of the db (where an all null column comes back as objects).
+    '''
+    canonical = {}
+    for column in sorted(df.columns):
+        values = df[column]
+        planned_dtype = raw_data_dtypes.get(column, '')
+        if pd.api.types.is_datetime64_any_dtype(values) or planned_dtype.startswith('datetime'):
+            # NaT becomes the smallest int64, astype('int64') would raise on it
+            values = pd.Series(pd.to_datetime(values, format='ISO8601').to_numpy('datetime64[ns]').view('int64'),
+                               index=df.index)
+        elif planned_dtype.startswith(('float', 'int')) or (pd.api.types.is_numeric_dtype(values) and
+                                                           not isinstance(values.dtype, pd.CategoricalDtype)):
+            values = pd.to_numeric(values).astype('float64')
+        else:
+            values = values.astype(object).where(values.notna(), None)
+        canonical[column] = values
+    hashes = pd.util.hash_pandas_object(pd.DataFrame(canonical, index=df.index), index=False)
+    return hashes.to_numpy().view('int64')
+
+
+def find_new_leads(conn, lead_hashes, batch_size=500):
+    '''
+    Returns a boolean array that is True for the leads whose hash isn't in
+    the 'lead_hashes' table, i.e. that weren't processed by an earlier run.
+    Only the hashes of the new leads are looked up (through the primary key
+    index of the table), so the cost grows with the number of new leads and
+    not with the number of leads processed before.
+    '''
+    create_lead_hashes_table(conn)
+    distinct_hashes = pd.unique(lead_hashes)
+    known_hashes = set()
+    for start in range(0, len(distinct_hashes), batch_size):
+        batch = distinct_hashes[start:start + batch_size].tolist()
+        rows = conn.execute(f"SELECT row_hash FROM lead_hashes WHERE row_hash IN ({', '.join('?' for _ in batch)})",
+                            batch).fetchall()
+        known_hashes.update(row[0] for row in rows)
+    return ~np.isin(lead_hashes, list(known_hashes))
+
+
+def save_lead_hashes(conn, lead_hashes, replace=False):
+    '''
+    Inserts the distinct lead_hashes into the 'lead_hashes' table without
+    committing, emptying it first if replace is True (when the tables are
+    rebuilt from all the leads).
+    '''
+    if replace:
+        conn.execute("DROP TABLE IF EXISTS lead_hashes")
+    create_lead_hashes_table(conn)
+    conn.executemany("INSERT OR IGNORE INTO lead_hashes (row_hash) VALUES (?)",
+                     ((row_hash,) for row_hash in pd.unique(lead_hashes).tolist()))
+
+
+def replace_lead_hashes(db_file_path, lead_hashes):
+    '''
+    Replaces the 'lead_hashes' table of the db at db_file_path with
+    lead_hashes. The lead hashes stay in the SQLite db whatever the storage
+    backend of the pipeline tables.
+    '''
+    conn = sqlite3.connect(db_file_path)
+    try:
+        save_lead_hashes(conn, lead_hashes, replace=True)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def create_lead_hashes_table(conn):
+    '''
+    Creates the 'lead_hashes' table if it doesn't exist yet. The hash is the
+    integer primary key, so the table is its own index.
+    '''
+    conn.execute("CREATE TABLE IF NOT EXISTS lead_hashes (row_hash INTEGER PRIMARY KEY)")
+
+
+###############################################################################
+# Define the date-partitioned storage of the lead tables
+###############################################################################
+
+@instrument_stage()
+def load_data_into_partitions(granularity=None):
+    '''
+    This function loads 'leadscoring.csv' like load_data_into_db, but into
+    the date-partitioned 'loaded_data' table: one parquet file per day (or
+    month) of 'created_date' under PARTITION_DIRECTORY. Only the partitions
+    whose rows changed since they were last written are rewritten (see
+    write_partitions), so reloading a file where a few days were backfilled
+    touches only those days.
+
+
+    INPUTS
+        DB_FILE_NAME : Name of the database file, holding the partition catalog
+        DB_PATH : path where the db file should be present
+        DATA_DIRECTORY : path of the directory where 'leadscoring.csv'
+                        file is present
+        granularity : 'day' or 'month', defaults to PARTITION_GRANULARITY
+
+
+    OUTPUT
+        List of the partition keys of 'loaded_data' that were written.
+
+
+    SAMPLE USAGE
+        changed_partitions = load_data_into_partitions()
+    '''
+    data_file_path = f"{DATA_DIRECTORY}/leadscoring_test.csv"
+
+    df = fill_missing_lead_counts(pd.read_csv(data_file_path, **get_raw_data_read_options()))
+    written = write_partitions(df, 'loaded_data', granularity)
+
+    print(f"{len(written)} partitions of 'loaded_data' written.")
+    return written
+
+
+@instrument_stage()
+def rebuild_partitions(partition_keys=None, start_date=None, end_date=None, force=False):
+    '''
+    This function rebuilds the 'model_input' partitions from the 'loaded_data'
+    partitions one partition at a time, running the city tier, categorical
+    and interaction transforms of the cleaning stages on each. The interaction
+    groups are keyed by INDEX_COLUMNS_TRAINING, which include 'created_date',
+    so every group lies in a single partition and the partitions together
+    give the same 'model_input' as the whole table.
+
+    By default only the stale partitions are rebuilt: those whose
+    'loaded_data' partition or mappings changed since their 'model_input'
+    partition was built. A single day is rebuilt with
+    rebuild_partitions(start_date=day, end_date=day, force=True).
+
+
+    INPUTS
+        DB_FILE_NAME : Name of the database file, holding the partition catalog
+        DB_PATH : path where the db file should be present
+        partition_keys : keys of the partitions to consider, e.g. ['2021-07-01'].
+                         Defaults to all the 'loaded_data' partitions.
+        start_date, end_date : only consider the partitions in this date range
+        force : if True the partitions are rebuilt even if they aren't stale
+
+
+    OUTPUT
+        List of the partition keys of 'model_input' that were rebuilt. If
+        PUBLISH_MODEL_INPUT is True the rows of those partitions are replaced
+        in the db's 'model_input' (see publish_model_input_partitions).
+
+
+    SAMPLE USAGE
+        rebuild_partitions()
+        rebuild_partitions(start_date='2021-07-01', end_date='2021-07-01', force=True)
+    '''
+    db_file_path = f"{DB_PATH}/{DB_FILE_NAME}"
+
+    keys = list_partitions('loaded_data', start_date, end_date)
+    if partition_keys is not None:
+        keys = [key for key in keys if key in set(partition_keys)]
+
+    catalog = get_partition_catalog('loaded_data').set_index('partition_key')
+    built_from = get_partition_catalog('model_input').set_index('partition_key')['source_fingerprint']
+    mappings_fingerprint = get_stage_fingerprint('rebuild_partitions', city_tier_mapping,
+                                                 significant_levels_by_column, hash_file(INTERACTION_MAPPING),
+                                                 INDEX_COLUMNS_TRAINING, NOT_FEATURES)
+
+    rebuilt = []
+    for key in keys:
+        source_fingerprint = get_stage_fingerprint(mappings_fingerprint, catalog.loc[key, 'fingerprint'])
+        if (not force and built_from.get(key) == source_fingerprint
+                and os.path.isfile(get_partition_path('model_input', key))):
+            continue
+        df = read_partitions('loaded_data', partition_keys=[key])
+        df = apply_categorical_mapping(apply_city_tier_mapping(df))
+        df_model_input = get_model_input(apply_interactions_mapping(df))
+        # 'model_input' is partitioned like 'loaded_data', whose keys are days or months
+        write_partitions(df_model_input, 'model_input', 'day' if len(key) == len('YYYY-MM-DD') else 'month',
+                         partition_keys=[key], source_fingerprint=source_fingerprint, only_changed=False)
+        rebuilt.append(key)
+
+    print(f"{len(rebuilt)} partitions of 'model_input' rebuilt.")
+    if rebuilt and PUBLISH_MODEL_INPUT:
+        publish_model_input_partitions(db_file_path, rebuilt)
+    return rebuilt
+
+
+def get_partition_keys(created_date, granularity=None):
+    '''
+    Returns the partition key of every value of created_date: 'YYYY-MM-DD'
+    for 'day' partitions and 'YYYY-MM' for 'month' partitions. granularity
+    defaults to PARTITION_GRANULARITY.
+    '''
+    granularity = granularity or PARTITION_GRANULARITY
+    if granularity not in ('day', 'month'):
+        raise ValueError(f"granularity must be 'day' or 'month', got {granularity!r}")
+    return pd.to_datetime(created_date).dt.strftime('%Y-%m-%d' if granularity == 'day' else '%Y-%m')
+
+
+def get_partition_path(table_name, partition_key):
+    '''
+    Returns the path of a partition of table_name, in the hive layout
+    DB_PATH/PARTITION_DIRECTORY/<table>/created_date=<key>/part.parquet
+    that parquet readers like pyarrow.dataset or duckdb recognise.
+    '''
+    return os.path.join(DB_PATH, PARTITION_DIRECTORY, table_name,
+                        f"created_date={partition_key}", 'part.parquet')
+
+
+def list_partitions(table_name, start_date=None, end_date=None):
+    '''
+    Returns the sorted keys of the partitions of table_name, pruned to the
+    partitions that overlap start_date to end_date (both included) when they
+    are given. Only the directory names are read.
+    '''
+    table_directory = os.path.join(DB_PATH, PARTITION_DIRECTORY, table_name)
+    if not os.path.isdir(table_directory):
+        return []
+    keys = sorted(name.split('=', 1)[1] for name in os.listdir(table_directory)
+                  if name.startswith('created_date=')
+                  and os.path.isfile(os.path.join(table_directory, name, 'part.parquet')))
+    # a key covers a day or a month and sorts like the dates it covers, so it
+    # overlaps the range if it isn't before start_date's or after end_date's
+    # key at the same granularity
+    if start_date is not None:
+        keys = [key for key in keys if key >= pd.Timestamp(start_date).strftime('%Y-%m-%d')[:len(key)]]
+    if end_date is not None:
+        keys = [key for key in keys if key <= pd.Timestamp(end_date).strftime('%Y-%m-%d')[:len(key)]]
+    return keys
+
+
+def read_partitions(table_name, start_date=None, end_date=None, partition_keys=None, columns=None):
+    '''
+    This function reads the date-partitioned table_name into a dataframe. Only
+    the partitions overlapping start_date to end_date are opened (partition
+    pruning), and the rows of the month partitions on the edges are then
+    filtered to the range.
+
+
+    INPUTS
+        table_name : 'loaded_data' or 'model_input'
+        start_date, end_date : dates of the first and last days to read (both
+                               included). None reads from the first or to
+                               the last partition.
+        partition_keys : keys of the partitions to read, instead of a range
+        columns : columns to read, all of them if None
+
+
+    OUTPUT
+        Dataframe with the rows of the partitions read in the order of their
+        keys, empty if there are none.
+
+
+    SAMPLE USAGE
+        df = read_partitions('model_input', start_date='2021-07-01', end_date='2021-07-31')
+    '''
+    check_pyarrow()
+    keys = partition_keys if partition_keys is not None else list_partitions(table_name, start_date, end_date)
+    tables = [pq.read_table(get_partition_path(table_name, key), columns=columns) for key in keys]
+    if not tables:
+        return pd.DataFrame(columns=columns)
+    df = pa.concat_tables(tables, promote_options='permissive').to_pandas()
+
+    if (start_date is not None or end_date is not None) and 'created_date' in df.columns:
+        days = pd.to_datetime(df['created_date']).dt.normalize()
+        in_range = pd.Series(True, index=df.index)
+        if start_date is not None:
+            in_range &= days >= pd.Timestamp(start_date).normalize()
+        if end_date is not None:
+            in_range &= days <= pd.Timestamp(end_date).normalize()
+        df = df[in_range].reset_index(drop=True)
+    return df
+
+
+def write_partitions(df, table_name, granularity=None, partition_keys=None,
+                     source_fingerprint=None, only_changed=True):
+    '''
+    This function writes the rows of df to the date-partitioned table_name,
+    one parquet file per partition key of their 'created_date'. Only the
+    partitions present in df are replaced; the others are left untouched.
+
+    Every partition is recorded in the 'partition_catalog' table of the db
+    with its row count and a fingerprint of its rows (from get_lead_hashes).
+    With only_changed a partition whose fingerprint is unchanged isn't
+    rewritten, so reloading a whole file rewrites only the partitions whose
+    rows were backfilled or changed.
+
+
+    INPUTS
+        df : dataframe with a 'created_date' column
+        table_name : name of the partitioned table
+        granularity : 'day' or 'month', defaults to PARTITION_GRANULARITY
+        partition_keys : keys of the partitions df holds, written even if df
+                         has no rows for some of them (they are emptied)
+        source_fingerprint : fingerprint of what the partitions were built
+                             from, saved in the catalog (see rebuild_partitions)
+        only_changed : if True the unchanged partitions aren't rewritten
+
+
+    OUTPUT
+        List of the partition keys written.
+
+
+    SAMPLE USAGE
+        write_partitions(df, 'loaded_data')
+    '''
+    check_pyarrow()
+    row_keys = get_partition_keys(df['created_date'], granularity)
+    partitions = dict(tuple(df.groupby(row_keys, observed=True, sort=False)))
+    if partition_keys is None:
+        partition_keys = sorted(partitions)
+    catalog = get_partition_catalog(table_name).set_index('partition_key')['fingerprint']
+
+    written = []
+    conn = sqlite3.connect(f"{DB_PATH}/{DB_FILE_NAME}")
+    try:
+        create_partition_catalog_table(conn)
+        for key in partition_keys:
+            partition = partitions.get(key, df.iloc[:0])
+            fingerprint = hashlib.sha256(get_lead_hashes(partition).tobytes()).hexdigest()
+            path = get_partition_path(table_name, key)
+            if only_changed and catalog.get(key) == fingerprint and os.path.isfile(path):
+                continue
+            write_arrow_file(partition, path)
+            conn.execute("INSERT OR REPLACE INTO partition_catalog (table_name, partition_key, row_count, "
+                         "fingerprint, source_fingerprint, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                         (table_name, key, len(partition), fingerprint, source_fingerprint,
+                          datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+            conn.commit()
+            written.append(key)
+    finally:
+        conn.close()
+    return written
+
+
+def get_partition_catalog(table_name):
+    '''
+    Returns the rows of the 'partition_catalog' table for table_name, one per
+    partition written.
+    '''
+    conn = sqlite3.connect(f"{DB_PATH}/{DB_FILE_NAME}")
+    try:
+        create_partition_catalog_table(conn)
+        return pd.read_sql("SELECT * FROM partition_catalog WHERE table_name = ? ORDER BY partition_key",
+                           conn, params=(table_name,))
+    finally:
+        conn.close()
+
+
+def create_partition_catalog_table(conn):
+    '''
+    Creates the 'partition_catalog' table if it doesn't exist yet.
+    '''
+    conn.execute("CREATE TABLE IF NOT EXISTS partition_catalog "
+                 "(table_name TEXT, partition_key TEXT, row_count INTEGER, fingerprint TEXT, "
+                 "source_fingerprint TEXT, updated_at TEXT, PRIMARY KEY (table_name, partition_key))")
+
+
+###############################################################################
+# Define function to run all the cleaning stages in memory
+###############################################################################
+
+@instrument_stage(output_table='model_input')
+def run_fused_pipeline(write_intermediate_tables=WRITE_INTERMEDIATE_TABLES):
+    '''
+    This function runs load_data_into_db, map_city_tier, map_categorical_vars
+    and interactions_mapping as one in-memory pass. 'leadscoring.csv' is read
+    once and the same dataframe is passed through all the transforms, so the
+    intermediate tables are not written to and read back from the db between
+    stages. The output tables are written in one SQLite transaction with the
+    lead hashes (see save_output_tables), so STORAGE_BACKEND must be 'sqlite'.
+    The intermediate tables are written as they are computed, outside of it.
+
+
+    INPUTS
+        DB_FILE_NAME : Name of the database file
+        DB_PATH : path where the db file should be present
+        DATA_DIRECTORY : path of the directory where 'leadscoring.csv' 
+                        file is present
+        write_intermediate_tables : if True the intermediate 'loaded_data',
+                        'city_tier_mapped' and 'categorical_variables_mapped'
+                        tables are also written (for debugging or lineage).
+                        Defaults to WRITE_INTERMEDIATE_TABLES.
+
+
+    OUTPUT
+        Saves the 'interactions_mapped', 'model_input' and 'city_tier_misses'
+        tables in the db, replacing them if they already exsist, and the
+        intermediate tables if write_intermediate_tables is True.
+
+
+    SAMPLE USAGE
+        run_fused_pipeline()
+        run_fused_pipeline(write_intermediate_tables=True)
+    '''
+    db_file_path = f"{DB_PATH}/{DB_FILE_NAME}"
     
-    # Commit changes and close the connection
-    conn.commit()
-    conn.close()
+    data_file_path = f"{DATA_DIRECTORY}/leadscoring_test.csv"
+
+    check_sqlite_storage('run_fused_pipeline')
+
+    # The tables written here no longer match the stage cache's fingerprints
+    save_stage_fingerprint(db_file_path, None, ['loaded_data', 'city_tier_mapped', 'city_tier_misses',
+                                                'categorical_variables_mapped',
+                                                'interactions_mapped', 'model_input'])
+
+    conn = sqlite3.connect(db_file_path)
+
+    def save_intermediate(df, table_name):
+        if write_intermediate_tables:
+            write_table(conn, table_name, df)
+
+    df = fill_missing_lead_counts(pd.read_csv(data_file_path, **get_raw_data_read_options()))
+    save_intermediate(df, 'loaded_data')
+
+    df, df_misses = apply_city_tier_mapping(df, return_misses=True)
+    save_intermediate(df, 'city_tier_mapped')
+
+    df = apply_categorical_mapping(df)
+    save_intermediate(df, 'categorical_variables_mapped')
+
+    lead_hashes = get_lead_hashes(df)
+    df_pivot = apply_interactions_mapping(df, lead_hashes)
+    try:
+        save_output_tables(conn, {'city_tier_misses': df_misses,
+                                  'interactions_mapped': df_pivot,
+                                  'model_input': get_model_input(df_pivot)}, lead_hashes)
+    finally:
+        conn.close()
+
+    print(f"Fused data pipeline run saved 'interactions_mapped' and 'model_input' to the database at {db_file_path}.")
+
+
+def save_output_tables(conn, tables, lead_hashes):
+    '''
+    Replaces every table of tables (a dictionary of table name to dataframe)
+    and the 'lead_hashes' table on an open SQLite connection in one
+    transaction, so a failed write leaves all of them as they were.
+    '''
+    if conn.in_transaction:
+        conn.commit()
+    apply_write_pragmas(conn)
+    try:
+        conn.execute("BEGIN")
+        for table_name, df in tables.items():
+            conn.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+            insert_dataframe(conn, table_name, df)
+        save_lead_hashes(conn, lead_hashes, replace=True)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+###############################################################################
+# Define function to run the cleaning stages on shards in a process pool
+###############################################################################
+
+@instrument_stage(output_table='model_input')
+def run_parallel_pipeline(n_workers=PARALLEL_WORKERS, shard_by=PARALLEL_SHARD_BY):
+    '''
+    This function runs the transforms of run_fused_pipeline on shards of the
+    leads in a pool of n_workers processes. 'leadscoring.csv' is read once,
+    the leads are split into n_workers shards by their 'created_date' (see
+    get_shard_ids) and every worker maps the city tiers, the categorical
+    variables and the interactions of its shard (see transform_shard).
+
+    All the leads of a 'created_date' land in the same shard, and
+    'created_date' is the first of the INDEX_COLUMNS_TRAINING the interactions
+    are grouped on. No duplicate row or group of leads spans two shards, so
+    the only global step is the merge: the shards' outputs are concatenated
+    and stably sorted on 'created_date' (see merge_shard_results). The
+    'model_input' written is the same as the one of run_fused_pipeline
+    whatever the number of workers or the sharding.
+
+    Like run_fused_pipeline it writes the tables in one SQLite transaction,
+    so STORAGE_BACKEND must be 'sqlite'.
+
+
+    INPUTS
+        DB_FILE_NAME : Name of the database file
+        DB_PATH : path where the db file should be present
+        DATA_DIRECTORY : path of the directory where 'leadscoring.csv' 
+                        file is present
+        n_workers : number of worker processes and shards, defaults to
+                    PARALLEL_WORKERS (None means one per CPU core). With 1
+                    worker the shard is transformed in this process.
+        shard_by : 'range' splits 'created_date' into contiguous ranges with
+                   about the same number of leads, 'hash' assigns the dates to
+                   shards by their hash. Defaults to PARALLEL_SHARD_BY.
+
+
+    OUTPUT
+        Saves the 'interactions_mapped', 'model_input' and 'city_tier_misses'
+        tables in the db, replacing them if they already exsist.
+
+
+    SAMPLE USAGE
+        run_parallel_pipeline()
+        run_parallel_pipeline(n_workers=4, shard_by='hash')
+    '''
+    db_file_path = f"{DB_PATH}/{DB_FILE_NAME}"
     
-    print(f"Interaction columns have been mapped and saved to 'interactions_mapped'. Model input features saved to 'model_input'.")
+    data_file_path = f"{DATA_DIRECTORY}/leadscoring_test.csv"
+
+    check_sqlite_storage('run_parallel_pipeline')
+    n_workers = n_workers or os.cpu_count() or 1
+
+    df = fill_missing_lead_counts(pd.read_csv(data_file_path, **get_raw_data_read_options()))
+    shard_ids = get_shard_ids(df['created_date'], n_workers, shard_by)
+    shards = [df[shard_ids == shard] for shard in range(n_workers)]
+    shards = [df_shard for df_shard in shards if not df_shard.empty]
+    del df
+
+    if n_workers == 1:
+        results = [transform_shard(df_shard) for df_shard in shards]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(transform_shard, shards))
+    df_pivot, df_misses, lead_hashes = merge_shard_results(results)
+
+    save_merged_tables(db_file_path, df_pivot, df_misses, lead_hashes)
+
+    print(f"Parallel data pipeline run on {len(shards)} shards saved 'interactions_mapped' and 'model_input' "
+          f"to the database at {db_file_path}.")
+
+
+def get_shard_ids(created_date, n_shards, shard_by='range'):
+    '''
+    Returns the shard (0 to n_shards - 1) of every lead from its
+    created_date, so that the leads of a date always share a shard. With
+    'range' the dates are ranked and cut into n_shards contiguous ranges of
+    about the same number of leads, with 'hash' a date's shard is its hash
+    modulo n_shards. Leads without a date go to shard 0.
+    '''
+    if shard_by == 'range':
+        ranks = created_date.rank(method='min').fillna(1).to_numpy()
+        return ((ranks - 1) * n_shards // max(created_date.count(), 1)).astype(int)
+    if shard_by == 'hash':
+        hashes = pd.util.hash_pandas_object(created_date, index=False).to_numpy()
+        return (hashes % np.uint64(n_shards)).astype(int)
+    raise ValueError(f"shard_by must be 'range' or 'hash', got {shard_by!r}")
+
+
+def transform_shard(df):
+    '''
+    Runs the city tier, categorical and interactions mapping of
+    run_fused_pipeline on the shard df and returns its interactions mapped
+    frame, its city tier misses and its lead hashes. This is the task of the
+    workers of run_parallel_pipeline.
+    '''
+    df, df_misses = apply_city_tier_mapping(df, return_misses=True)
+    df = apply_categorical_mapping(df)
+    lead_hashes = get_lead_hashes(df)
+    return apply_interactions_mapping(df, lead_hashes), df_misses, lead_hashes
+
+
+def merge_shard_results(results):
+    '''
+    Merges the outputs of transform_shard for every shard into the outputs of
+    one run over all the leads. The interactions mapped frames are
+    concatenated and stably sorted on 'created_date' (every shard is already
+    sorted on INDEX_COLUMNS_TRAINING and holds all the leads of its dates), the
+    lead counts of the city tier misses are summed per city, and the lead
+    hashes concatenated.
+    '''
+    df_pivot = pd.concat([result[0] for result in results], ignore_index=True)
+    df_pivot = df_pivot.sort_values(by='created_date', kind='stable').reset_index(drop=True)
+
+    df_misses = pd.concat([result[1] for result in results], ignore_index=True)
+    df_misses = (df_misses.groupby(['city_mapped', 'normalized_city'], dropna=False, observed=True)['lead_count']
+                 .sum().reset_index()
+                 .sort_values(['lead_count', 'city_mapped'], ascending=[False, True], kind='stable')
+                 .reset_index(drop=True))
+
+    lead_hashes = np.concatenate([result[2] for result in results]) if results else np.array([], dtype='int64')
+    return df_pivot, df_misses, lead_hashes
+
+
+def save_merged_tables(db_file_path, df_pivot, df_misses, lead_hashes):
+    '''
+    Writes the merged outputs of the shards to the db at db_file_path: the
+    'city_tier_misses', 'interactions_mapped' and 'model_input' tables and
+    the 'lead_hashes', in one transaction (see save_output_tables), and
+    forgets the stage cache fingerprints of the tables.
+    '''
+    # The tables written here no longer match the stage cache's fingerprints
+    save_stage_fingerprint(db_file_path, None, ['interactions_mapped', 'model_input', 'city_tier_misses'])
+
+    conn = sqlite3.connect(db_file_path)
+    try:
+        save_output_tables(conn, {'city_tier_misses': df_misses,
+                                  'interactions_mapped': df_pivot,
+                                  'model_input': get_model_input(df_pivot)}, lead_hashes)
+    finally:
+        conn.close()
+
+
+###############################################################################
+# Define the tasks of the sharded data pipeline DAG
+###############################################################################
+
+@instrument_stage()
+def split_leads_into_shards(artifact_run_id, n_shards=DAG_SHARD_COUNT, shard_by=PARALLEL_SHARD_BY):
+    '''
+    This function is the fan-out task of the sharded data pipeline DAG. It
+    reads 'leadscoring.csv', splits the leads into n_shards shards by their
+    'created_date' like run_parallel_pipeline (see get_shard_ids) and saves
+    every non empty shard as the stage artifact 'shard_<n>_loaded_data' of
+    the DAG run.
+
+
+    INPUTS
+        DATA_DIRECTORY : path of the directory where 'leadscoring.csv' 
+                        file is present
+        artifact_run_id : DAG run id the shard artifacts belong to
+        n_shards : number of shards, defaults to DAG_SHARD_COUNT
+        shard_by : 'range' or 'hash', defaults to PARALLEL_SHARD_BY
+
+
+    OUTPUT
+        List with the keyword arguments of clean_shard for every shard
+        written, which Airflow maps one clean_shard task over.
+
+
+    SAMPLE USAGE
+        shard_kwargs = split_leads_into_shards('manual__2024-08-18')
+    '''
+    data_file_path = f"{DATA_DIRECTORY}/leadscoring_test.csv"
+
+    df = fill_missing_lead_counts(pd.read_csv(data_file_path, **get_raw_data_read_options()))
+    shard_ids = get_shard_ids(df['created_date'], n_shards, shard_by)
+
+    shard_kwargs = []
+    for shard in range(n_shards):
+        df_shard = df[shard_ids == shard]
+        if df_shard.empty:
+            continue
+        write_artifact(df_shard, artifact_run_id, f"shard_{shard}_loaded_data")
+        shard_kwargs.append({'artifact_run_id': artifact_run_id, 'shard': shard})
+
+    print(f"{len(df)} leads split into {len(shard_kwargs)} shards.")
+    return shard_kwargs
+
+
+@instrument_stage()
+def clean_shard(artifact_run_id, shard):
+    '''
+    This function is the mapped task of the sharded data pipeline DAG. It
+    runs transform_shard on the stage artifact 'shard_<shard>_loaded_data'
+    of the DAG run and saves its outputs as the artifacts
+    'shard_<shard>_interactions_mapped', 'shard_<shard>_city_tier_misses'
+    and 'shard_<shard>_lead_hashes'.
+
+
+    INPUTS
+        artifact_run_id : DAG run id the shard artifacts belong to
+        shard : number of the shard, as returned by split_leads_into_shards
+
+
+    OUTPUT
+        Saves the three artifacts of the shard.
+
+
+    SAMPLE USAGE
+        clean_shard('manual__2024-08-18', 0)
+    '''
+    df = read_artifact(artifact_run_id, f"shard_{shard}_loaded_data")
+    df_pivot, df_misses, lead_hashes = transform_shard(df)
+
+    write_artifact(df_pivot, artifact_run_id, f"shard_{shard}_interactions_mapped")
+    write_artifact(df_misses, artifact_run_id, f"shard_{shard}_city_tier_misses")
+    write_artifact(pd.DataFrame({'row_hash': lead_hashes}), artifact_run_id, f"shard_{shard}_lead_hashes")
+
+
+@instrument_stage(output_table='model_input')
+def merge_shards(artifact_run_id, n_shards=DAG_SHARD_COUNT):
+    '''
+    This function is the fan-in task of the sharded data pipeline DAG. It
+    reads the outputs of the clean_shard tasks of the DAG run, merges them
+    with merge_shard_results and publishes the result: 'model_input' is saved
+    as a stage artifact of the run (checked by the model_input_schema_check
+    task that follows) and the 'interactions_mapped', 'model_input',
+    'city_tier_misses' and 'lead_hashes' tables are written to the db in one
+    transaction, as run_parallel_pipeline does. STORAGE_BACKEND must be
+    'sqlite'.
+
+
+    INPUTS
+        DB_FILE_NAME : Name of the database file
+        DB_PATH : path where the db file should be present
+        artifact_run_id : DAG run id the shard artifacts belong to
+        n_shards : number of shards split_leads_into_shards was called with;
+                   the shards that had no leads are skipped
+
+
+    OUTPUT
+        Saves the 'model_input' artifact and the four tables in the db,
+        replacing them if they already exsist.
+
+
+    SAMPLE USAGE
+        merge_shards('manual__2024-08-18')
+    '''
+    db_file_path = f"{DB_PATH}/{DB_FILE_NAME}"
+
+    check_sqlite_storage('merge_shards')
+
+    results = []
+    for shard in range(n_shards):
+        if find_artifact_path(artifact_run_id, f"shard_{shard}_interactions_mapped") is None:
+            continue
+        results.append((read_artifact(artifact_run_id, f"shard_{shard}_interactions_mapped"),
+                        read_artifact(artifact_run_id, f"shard_{shard}_city_tier_misses"),
+                        read_artifact(artifact_run_id, f"shard_{shard}_lead_hashes")['row_hash'].to_numpy()))
+    df_pivot, df_misses, lead_hashes = merge_shard_results(results)
+
+    write_artifact(get_model_input(df_pivot), artifact_run_id, 'model_input')
+    save_merged_tables(db_file_path, df_pivot, df_misses, lead_hashes)
+
+    print(f"{len(results)} shards merged and published to the database at {db_file_path}.")
+
+
+###############################################################################
+# Define function to process only the leads added since the last run
+###############################################################################
+
+@instrument_stage(output_table='model_input')
+def run_incremental_pipeline(chunksize=CHUNK_SIZE):
+    '''
+    This function runs the cleaning stages only on the leads whose
+    'created_date' is at or after the high-water mark saved in the db by the
+    previous run, or is null, and appends them to 'loaded_data', 'city_tier_mapped',
+    'categorical_variables_mapped', 'interactions_mapped' and 'model_input'.
+    The csv is scanned in chunks and only the new leads are kept in memory, so
+    the work done per run grows with the day's new leads and not with the
+    whole history. All the tables and the new high-water mark are written in
+    one transaction.
+
+    Leads already processed by an earlier run (found by their hash in the
+    'lead_hashes' table, see find_new_leads) are dropped as well. So the leads
+    of the high-water mark itself, the leads without a 'created_date' (kept
+    like the full load keeps them) and leads re-delivered after the
+    high-water mark was reset are each appended once.
+
+    If no high-water mark is saved yet (first run) all the leads are processed
+    and the five tables and 'lead_hashes' are replaced. Like
+    run_fused_pipeline it needs STORAGE_BACKEND = 'sqlite'.
+
+
+    INPUTS
+        DB_FILE_NAME : Name of the database file
+        DB_PATH : path where the db file should be present
+        DATA_DIRECTORY : path of the directory where 'leadscoring.csv' 
+                        file is present
+        chunksize : number of rows of the csv scanned at a time
+
+
+    OUTPUT
+        Appends the new leads to the five tables and saves the latest
+        'created_date' processed in the 'pipeline_watermark' table.
+
+
+    SAMPLE USAGE
+        run_incremental_pipeline()
+    '''
+    db_file_path = f"{DB_PATH}/{DB_FILE_NAME}"
+    
+    data_file_path = f"{DATA_DIRECTORY}/leadscoring_test.csv"
+
+    check_sqlite_storage('run_incremental_pipeline')
+
+    conn = sqlite3.connect(db_file_path)
+    try:
+        watermark = get_watermark(conn, 'created_date')
+
+        new_chunks = []
+        for chunk in pd.read_csv(data_file_path, chunksize=chunksize, **get_raw_data_read_options()):
+            if watermark is not None:
+                created_date = pd.to_datetime(chunk['created_date'])
+                chunk = chunk[(created_date >= watermark) | created_date.isna()]
+            new_chunks.append(chunk)
+        df = pd.concat(new_chunks, ignore_index=True)
+
+        if df.empty:
+            print(f"No leads from {watermark} on found, nothing to process.")
+            return
+
+        df_loaded = fill_missing_lead_counts(df)
+        df_city_tier = apply_city_tier_mapping(df_loaded.copy())
+        df_categorical = apply_categorical_mapping(df_city_tier.copy())
+
+        lead_hashes = get_lead_hashes(df_categorical)
+        if watermark is not None:
+            new_leads = find_new_leads(conn, lead_hashes)
+            df_loaded, df_city_tier, df_categorical = (df_table[new_leads] for df_table in
+                                                       (df_loaded, df_city_tier, df_categorical))
+            lead_hashes = lead_hashes[new_leads]
+            if df_loaded.empty:
+                print(f"All the {len(new_leads)} leads from {watermark} on were processed before, nothing to process.")
+                return
+
+        df_pivot = apply_interactions_mapping(df_categorical, lead_hashes)
+
+        tables = {'loaded_data': df_loaded,
+                  'city_tier_mapped': df_city_tier,
+                  'categorical_variables_mapped': df_categorical,
+                  'interactions_mapped': df_pivot,
+                  'model_input': get_model_input(df_pivot)}
+
+        # The tables written here no longer match the stage cache's fingerprints
+        save_stage_fingerprint(db_file_path, None, list(tables))
+
+        apply_write_pragmas(conn)
+        conn.execute("BEGIN")
+        for table_name, df_table in tables.items():
+            if watermark is None:
+                conn.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+            insert_dataframe(conn, table_name, df_table)
+        save_lead_hashes(conn, lead_hashes, replace=watermark is None)
+        # leads without a 'created_date' leave the high-water mark where it was
+        new_watermark = pd.to_datetime(df_loaded['created_date']).max()
+        if pd.isna(new_watermark):
+            new_watermark = watermark
+        if new_watermark is not None:
+            set_watermark(conn, 'created_date', new_watermark)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    print(f"Incremental run processed {len(df_loaded)} new leads up to {new_watermark} "
+          f"and appended them to the database at {db_file_path}.")
+
+
+def get_watermark(conn, name):
+    '''
+    Returns the high-water mark saved under name in the 'pipeline_watermark'
+    table as a pd.Timestamp, or None if there is none yet.
+    '''
+    conn.execute("CREATE TABLE IF NOT EXISTS pipeline_watermark (name TEXT PRIMARY KEY, value TEXT)")
+    row = conn.execute("SELECT value FROM pipeline_watermark WHERE name = ?", (name,)).fetchone()
+    return pd.Timestamp(row[0]) if row else None
+
+
+def set_watermark(conn, name, value):
+    '''
+    Saves value as the high-water mark under name in the 'pipeline_watermark'
+    table without committing.
+    '''
+    conn.execute("CREATE TABLE IF NOT EXISTS pipeline_watermark (name TEXT PRIMARY KEY, value TEXT)")
+    conn.execute("INSERT OR REPLACE INTO pipeline_watermark (name, value) VALUES (?, ?)",
+                 (name, pd.Timestamp(value).strftime('%Y-%m-%d %H:%M:%S')))
@@ -1,16 +1,35 @@
-DB_PATH = 
-DB_FILE_NAME = 
+DB_PATH = '/Users/I500955/Documents/PG/MLOPs/Assignment/airflow/dags/lead_scoring_data_pipeline/'
+DB_FILE_NAME = 'lead_scoring_data_cleaning.db'
 
-DB_FILE_MLFLOW = 
+DB_FILE_MLFLOW = 'Lead_scoring_mlflow_production.db'
 
-TRACKING_URI = 
-EXPERIMENT =
+TRACKING_URI = 'http://0.0.0.0:6006'
+EXPERIMENT = 'Lead_scoring_mlflow_production'
 
 
 # model config imported from pycaret experimentation
-model_config = 
+model_config = {'boosting_type': 'gbdt', 'class_weight': None, 'colsample_bytree': 1.0,
+                'importance_type': 'split', 'learning_rate': 0.1, 'max_depth': -1,
+                'min_child_samples': 20, 'min_child_weight': 0.001, 'min_split_gain': 0.0,
+                'n_estimators': 100, 'n_jobs': -1, 'num_leaves': 31, 'objective': None,
+                'random_state': 42, 'reg_alpha': 0.0, 'reg_lambda': 0.0,
+                'subsample': 1.0, 'subsample_for_bin': 200000, 'subsample_freq': 0}
 
 # list of the features that needs to be there in the final encoded dataframe
-ONE_HOT_ENCODED_FEATURES = 
+# (before one-hot encoding, the one-hot columns come from the fitted encoder)
+ONE_HOT_ENCODED_FEATURES = ['total_leads_droppped', 'referred_lead', 'city_tier',
+                            'first_platform_c', 'first_utm_medium_c', 'first_utm_source_c']
 # list of features that need to be one-hot encoded
-FEATURES_TO_ENCODE = 
+FEATURES_TO_ENCODE = ['first_platform_c', 'first_utm_medium_c', 'first_utm_source_c']
+
+# column of 'model_input' the model predicts
+TARGET = 'app_complete_flag'
+
+# json file the encoder vocabulary is saved to by encode_features (and logged
+# with the model by get_trained_model), and how the features are encoded and
+# saved: 'sparse' one-hot as a CSR matrix in FEATURES_FILE, 'dense' as uint8
+# one-hot columns in the 'features' table, 'codes' as integer level codes in
+# the 'features' table, trained with LightGBM's native categorical splits
+ENCODER_FILE = DB_PATH + 'encoder_vocabulary.json'
+FEATURES_FILE = DB_PATH + 'features.npz'
+ENCODED_FEATURES_FORMAT = 'sparse'
@@ -12,6 +12,7 @@ version: 1
 import pandas as pd
 import numpy as np
 
+import time
 import sqlite3
 from sqlite3 import Error
 
@@ -25,6 +26,8 @@ from sklearn.model_selection import train_test_split
 from sklearn.metrics import accuracy_score
 
 from Lead_scoring_training_pipeline.constants import *
+from lead_scoring_data_pipeline.feature_encoding import *
+from lead_scoring_data_pipeline.table_writer import write_table
 
 
 ###############################################################################
@@ -37,24 +40,46 @@ def encode_features():
     training dataset. This encoding is needed for feeding categorical data 
     to many scikit-learn models.
 
+    The encoder shared with the inference pipeline (see
+    lead_scoring_data_pipeline/feature_encoding.py) is fitted on 'model_input'
+    and its vocabulary saved to ENCODER_FILE, so get_trained_model can log it with
+    the model and the inference pipeline encodes with the same columns.
+    The features are then encoded in one pass by transform_features.
+
     INPUTS
         db_file_name : Name of the database file 
         db_path : path where the db file should be
         ONE_HOT_ENCODED_FEATURES : list of the features that needs to be there in the final encoded dataframe
         FEATURES_TO_ENCODE: list of features  from cleaned data that need to be one-hot encoded
+        ENCODED_FEATURES_FORMAT : 'sparse', 'dense' or 'codes' (for LightGBM's
+                        native categorical splits), see transform_features
        
 
     OUTPUT
-        1. Save the encoded features in a table - features
+        1. Save the encoded features in a table - features (or in
+           FEATURES_FILE as a CSR matrix)
         2. Save the target variable in a separate table - target
+        3. Save the encoder vocabulary in ENCODER_FILE
 
 
     SAMPLE USAGE
         encode_features()
-        
-    **NOTE : You can modify the encode_featues function used in heart disease's inference
-        pipeline from the pre-requisite module for this.
     '''
+    cnx = sqlite3.connect(DB_PATH + DB_FILE_NAME)
+    try:
+        df_model_input = pd.read_sql('select * from model_input', cnx)
+
+        encoder = fit_encoder(df_model_input, FEATURES_TO_ENCODE, ONE_HOT_ENCODED_FEATURES,
+                              output=ENCODED_FEATURES_FORMAT)
+        save_encoder(encoder, ENCODER_FILE)
+
+        features = transform_features(df_model_input, encoder)
+        save_encoded_features(cnx, features, FEATURES_FILE)
+        write_table(cnx, 'target', df_model_input[[TARGET]])
+    finally:
+        cnx.close()
+
+    print(f"{len(df_model_input)} leads encoded into {len(get_encoded_feature_names(encoder))} features.")
 
 
 ###############################################################################
@@ -79,9 +104,51 @@ def get_trained_model():
         Logs the trained model into mlflow model registry with name 'LightGBM'
         Logs the metrics and parameters into mlflow run
         Calculate auc from the test data and log into mlflow run  
+        Logs the encoder vocabulary saved by encode_features with the model,
+        for the inference pipeline to encode its features with
+        Logs the feature encoding ('feature_encoding' parameter), the number
+        of features and the fit time, so the AUC of the one-hot and native
+        categorical ('codes') runs can be compared side by side
+
+    With ENCODED_FEATURES_FORMAT = 'codes' the encoded columns are integer
+    level codes and are passed to LightGBM as categorical_feature, so the
+    trees split on them natively instead of on one column per level.
 
     SAMPLE USAGE
         get_trained_model()
     '''
+    mlflow.set_tracking_uri(TRACKING_URI)
+    mlflow.set_experiment(EXPERIMENT)
+
+    encoder = load_encoder(ENCODER_FILE)
+    cnx = sqlite3.connect(DB_PATH + DB_FILE_NAME)
+    try:
+        X = load_encoded_features(cnx, encoder, FEATURES_FILE)
+        y = pd.read_sql('select * from target', cnx)[TARGET]
+    finally:
+        cnx.close()
+
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.3, random_state=0)
+
+    feature_names = get_encoded_feature_names(encoder)
+    categorical_features = list(encoder['vocabulary']) if encoder['output'] == 'codes' else 'auto'
+
+    with mlflow.start_run(run_name=f"run_LightGB_withoutHPTune_{encoder['output']}") as run:
+        clf = lgb.LGBMClassifier()
+        clf.set_params(**model_config)
+        fit_start = time.perf_counter()
+        clf.fit(X_train, y_train, feature_name=feature_names, categorical_feature=categorical_features)
+        fit_seconds = time.perf_counter() - fit_start
+
+        mlflow.sklearn.log_model(sk_model=clf, artifact_path="models", registered_model_name='LightGBM')
+        mlflow.log_params(model_config)
+        mlflow.log_params({'feature_encoding': encoder['output'], 'n_features': len(feature_names)})
+        mlflow.log_artifact(ENCODER_FILE)
+
+        y_pred = clf.predict_proba(X_test)[:, 1]
+        auc = roc_auc_score(y_test, y_pred)
+        mlflow.log_metrics({'test_auc': auc, 'fit_seconds': fit_seconds})
+
+    print(f"Model trained in the run {run.info.run_id} with a test AUC of {auc:.4f}.")
 
    
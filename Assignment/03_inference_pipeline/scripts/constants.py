@@ -1,19 +1,28 @@
-DB_PATH = 
-DB_FILE_NAME = 
+DB_PATH = '/Users/I500955/Documents/PG/MLOPs/Assignment/airflow/dags/Lead_scoring_inference_pipeline/'
+DB_FILE_NAME = 'lead_scoring_data_cleaning.db'
 
-DB_FILE_MLFLOW = 
+DB_FILE_MLFLOW = 'Lead_scoring_mlflow_production.db'
 
-FILE_PATH = 
+FILE_PATH = '/Users/I500955/Documents/PG/MLOPs/Assignment/airflow/dags/Lead_scoring_inference_pipeline/data/leadscoring_inference.csv'
 
-TRACKING_URI = 
+TRACKING_URI = 'http://0.0.0.0:6006'
 
 # experiment, model name and stage to load the model from mlflow model registry
-MODEL_NAME = 
-STAGE = 
-EXPERIMENT = 
+MODEL_NAME = 'LightGBM'
+STAGE = 'Production'
+EXPERIMENT = 'Lead_scoring_mlflow_production'
 
 # list of the features that needs to be there in the final encoded dataframe
-ONE_HOT_ENCODED_FEATURES = 
+# (before one-hot encoding, the one-hot columns come from the model's encoder)
+ONE_HOT_ENCODED_FEATURES = ['total_leads_droppped', 'referred_lead', 'city_tier',
+                            'first_platform_c', 'first_utm_medium_c', 'first_utm_source_c']
 
 # list of features that need to be one-hot encoded
-FEATURES_TO_ENCODE = 
+FEATURES_TO_ENCODE = ['first_platform_c', 'first_utm_medium_c', 'first_utm_source_c']
+
+# name of the encoder vocabulary logged with the model by the training
+# pipeline, and the file encode_features saves the inference features to when
+# the model was trained on sparse one-hot features (the others are saved in
+# the 'features' table)
+ENCODER_ARTIFACT_PATH = 'encoder_vocabulary.json'
+FEATURES_FILE = DB_PATH + 'inference_features.npz'
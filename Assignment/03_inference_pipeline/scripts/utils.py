@@ -12,6 +12,7 @@ version: 1
 import mlflow
 import mlflow.sklearn
 import pandas as pd
+import numpy as np
 
 import sqlite3
 
@@ -20,6 +21,10 @@ import logging
 
 from datetime import datetime
 
+from Lead_scoring_inference_pipeline.constants import *
+from lead_scoring_data_pipeline.feature_encoding import *
+from lead_scoring_data_pipeline.table_writer import write_table
+
 ###############################################################################
 # Define the function to train the model
 # ##############################################################################
@@ -31,20 +36,50 @@ def encode_features():
     training dataset. This encoding is needed for feeding categorical data 
     to many scikit-learn models.
 
+    The features are encoded with the vocabulary fitted by the training
+    pipeline and logged with the model in STAGE (see load_model_encoder), so
+    they have the columns the model was trained on, in the same order, and
+    the encoding it was trained with (one-hot or the integer codes of the
+    native categorical mode). Levels the model hasn't seen are encoded as
+    'others'.
+
     INPUTS
         db_file_name : Name of the database file 
         db_path : path where the db file should be
         ONE_HOT_ENCODED_FEATURES : list of the features that needs to be there in the final encoded dataframe
         FEATURES_TO_ENCODE: list of features  from cleaned data that need to be one-hot encoded
-        **NOTE : You can modify the encode_featues function used in heart disease's inference
-        pipeline for this.
 
     OUTPUT
-        1. Save the encoded features in a table - features
+        1. Save the encoded features in a table - features (or in
+           FEATURES_FILE as a CSR matrix)
 
     SAMPLE USAGE
         encode_features()
     '''
+    encoder = load_model_encoder()
+
+    cnx = sqlite3.connect(DB_PATH + DB_FILE_NAME)
+    try:
+        df_model_input = pd.read_sql('select * from model_input', cnx)
+        features = transform_features(df_model_input, encoder)
+        save_encoded_features(cnx, features, FEATURES_FILE)
+    finally:
+        cnx.close()
+
+    print(f"{len(df_model_input)} leads encoded into {len(get_encoded_feature_names(encoder))} features.")
+
+
+def load_model_encoder():
+    '''
+    Returns the encoder logged (as ENCODER_ARTIFACT_PATH) in the run of the
+    latest version of MODEL_NAME in STAGE of the mlflow model registry.
+    '''
+    mlflow.set_tracking_uri(TRACKING_URI)
+    model_version = mlflow.tracking.MlflowClient().get_latest_versions(MODEL_NAME, stages=[STAGE])[0]
+    file_path = mlflow.artifacts.download_artifacts(run_id=model_version.run_id,
+                                                    artifact_path=ENCODER_ARTIFACT_PATH)
+    return load_encoder(file_path)
+
 
 ###############################################################################
 # Define the function to load the model from mlflow model registry
@@ -66,10 +101,29 @@ def get_models_prediction():
 
     OUTPUT
         Store the predicted values along with input data into a table
+        named 'predictions'
+
+    The features saved by encode_features are passed to the model as they
+    are: a CSR matrix for the one-hot models or the integer level codes for
+    the models trained on LightGBM's native categorical splits.
 
     SAMPLE USAGE
         load_model()
     '''
+    mlflow.set_tracking_uri(TRACKING_URI)
+    model = mlflow.sklearn.load_model(model_uri=f"models:/{MODEL_NAME}/{STAGE}")
+    encoder = load_model_encoder()
+
+    cnx = sqlite3.connect(DB_PATH + DB_FILE_NAME)
+    try:
+        df_predictions = pd.read_sql('select * from model_input', cnx)
+        X = load_encoded_features(cnx, encoder, FEATURES_FILE)
+        df_predictions['app_complete_flag'] = model.predict(X)
+        write_table(cnx, 'predictions', df_predictions)
+    finally:
+        cnx.close()
+
+    print(f"Predictions of {MODEL_NAME} in {STAGE} saved for {len(df_predictions)} leads in the 'predictions' table.")
 
 ###############################################################################
 # Define the function to check the distribution of output column
@@ -8,22 +8,36 @@ from schema import *
 from constants import *
 import os
 import sqlite3
+from datetime import datetime
+from utils import write_table, instrument_stage, connect_db, read_table, get_table_columns, get_storage_file_path
+from utils import read_artifact, get_artifact_columns
 
 ###############################################################################
 # Define function to validate raw data's schema
 ############################################################################### 
 
+@instrument_stage()
 def raw_data_schema_check():
     '''
     This function check if all the columns mentioned in schema.py are present in
     leadscoring.csv file or not.
 
-   
+    Only the header of the file is read for the column check, so a file with a
+    wrong schema fails before any data is parsed. If the columns are in line the
+    file is then validated in one streaming pass of CHUNK_SIZE rows at a time
+    (see validate_chunks): every value must parse as the dtype given in
+    raw_data_dtypes and lie in the domain given in raw_data_domains, and the
+    null rate of a column can't exceed raw_data_max_null_rates. The result of
+    the checks is saved in the 'raw_data_validation_report' table.
+
+
     INPUTS
         DATA_DIRECTORY : path of the directory where 'leadscoring.csv' 
                         file is present
         raw_data_schema : schema of raw data in the form oa list/tuple as present 
                           in 'schema.py'
+        raw_data_dtypes, raw_data_domains, raw_data_max_null_rates : rules of
+                          the streaming validation pass present in 'schema.py'
 
     OUTPUT
         If the schema is in line then prints 
@@ -31,25 +45,28 @@ def raw_data_schema_check():
         else prints
         'Raw datas schema is NOT in line with the schema present in schema.py'
 
-    
+        Raises a ValueError if the schema is not in line or any column fails
+        the validation pass, so the pipeline stops before load_data_into_db.
+
+
     SAMPLE USAGE
         raw_data_schema_check
     '''
     csv_file_path = f"{DATA_DIRECTORY}/leadscoring.csv"
 
     try:
-        df = pd.read_csv(csv_file_path)
+        header = pd.read_csv(csv_file_path, nrows=0)
     except FileNotFoundError:
         print(f"File {csv_file_path} not found.")
-        return
+        raise
     except pd.errors.EmptyDataError:
         print("The CSV file is empty.")
-        return
+        raise
     except pd.errors.ParserError:
         print("Error parsing the CSV file.")
-        return
+        raise
 
-    csv_columns = set(df.columns)
+    csv_columns = set(header.columns)
 
     # Compare with the schema
     schema_columns = set(raw_data_schema)
@@ -58,67 +75,226 @@ def raw_data_schema_check():
         print('Raw data schema is in line with the schema present in schema.py')
     else:
         print('Raw data schema is NOT in line with the schema present in schema.py')
+        raise ValueError(f"Columns missing from {csv_file_path}: {sorted(schema_columns - csv_columns)}")
+
+    chunks = pd.read_csv(csv_file_path, usecols=raw_data_schema, dtype=str, chunksize=CHUNK_SIZE)
+    report = validate_chunks(chunks, raw_data_dtypes, raw_data_domains, raw_data_max_null_rates)
+    save_validation_report(report, 'raw_data_validation_report')
+    check_validation_report(report)
+
 
-   
 ###############################################################################
 # Define function to validate model's input schema
 ############################################################################### 
 
-def model_input_schema_check():
+@instrument_stage(input_table='model_input')
+def model_input_schema_check(artifact_run_id=None):
     '''
     This function check if all the columns mentioned in model_input_schema in 
     schema.py are present in table named in 'model_input' in db file.
 
-   
+    If the columns are in line the table is then read back CHUNK_SIZE rows at
+    a time and validated against model_input_dtypes, model_input_domains (for
+    example 'city_tier' must be 1, 2 or 3) and model_input_max_null_rates.
+    The result of the checks is saved in the 'model_input_validation_report'
+    table.
+
+
     INPUTS
         DB_FILE_NAME : Name of the database file
         DB_PATH : path where the db file should be present
         model_input_schema : schema of models input data in the form oa list/tuple
                           present as in 'schema.py'
+        model_input_dtypes, model_input_domains, model_input_max_null_rates :
+                          rules of the streaming validation pass present in
+                          'schema.py'
+        artifact_run_id : DAG run id whose 'model_input' stage artifact is
+                          checked instead of the db table. If None (default)
+                          the db table is checked.
 
     OUTPUT
         If the schema is in line then prints 
         'Models input schema is in line with the schema present in schema.py'
         else prints
         'Models input schema is NOT in line with the schema present in schema.py'
-    
+
+        Raises a ValueError if the db file or the table is missing, the
+        schema is not in line or any column fails the validation pass, and
+        re-raises SQLite errors, so a broken 'model_input' never reaches
+        training.
+
     SAMPLE USAGE
         raw_data_schema_check
     '''
-    db_file_path = os.path.join(DB_PATH, DB_FILE_NAME)
-    
-    if not os.path.exists(db_file_path):
-        print(f"Database file {db_file_path} not found.")
+    if artifact_run_id is not None:
+        check_model_input_artifact(artifact_run_id)
         return
-    
+
+    db_file_path = os.path.join(DB_PATH, DB_FILE_NAME)
+
+    if not os.path.exists(get_storage_file_path(db_file_path)):
+        print(f"Database file {get_storage_file_path(db_file_path)} not found.")
+        raise ValueError(f"Database file {get_storage_file_path(db_file_path)} not found")
+
+    conn = None
     try:
-        conn = sqlite3.connect(db_file_path)
-        cursor = conn.cursor()
-        
+        conn = connect_db(db_file_path)
+
         table_name = 'model_input' 
-        
-        # Query to get the column names of the table
-        cursor.execute(f"PRAGMA table_info({table_name})")
-        columns_info = cursor.fetchall()
-        
-        # Extract column names
-        db_columns = set(col_info[1] for col_info in columns_info)  # col_info[1] is the column name
-        
+
+        # Get the column names of the table
+        db_columns = set(get_table_columns(conn, table_name))
+
         # Compare with the schema
         schema_columns = set(model_input_schema)
-        
+
         if schema_columns.issubset(db_columns):
             print('Models input schema is in line with the schema present in schema.py')
         else:
             print('Models input schema is NOT in line with the schema present in schema.py')
-    
+            raise ValueError(f"Columns missing from {table_name}: {sorted(schema_columns - db_columns)}")
+
+        chunks = read_table(conn, table_name, columns=model_input_schema, chunksize=CHUNK_SIZE)
+        report = validate_chunks(chunks, model_input_dtypes, model_input_domains, model_input_max_null_rates)
+
     except sqlite3.Error as e:
         print(f"SQLite error: {e}")
+        raise
     finally:
         # Close the connection
         if conn:
             conn.close()
-    
 
-    
-    
+    save_validation_report(report, 'model_input_validation_report')
+    check_validation_report(report)
+
+
+def check_model_input_artifact(artifact_run_id):
+    '''
+    Runs the checks of model_input_schema_check on the 'model_input' stage
+    artifact of artifact_run_id: its columns are read from the artifact's
+    schema and only the columns of model_input_schema are read for the
+    validation pass.
+    '''
+    artifact_columns = set(get_artifact_columns(artifact_run_id, 'model_input'))
+    if set(model_input_schema).issubset(artifact_columns):
+        print('Models input schema is in line with the schema present in schema.py')
+    else:
+        print('Models input schema is NOT in line with the schema present in schema.py')
+        raise ValueError(f"Columns missing from the model_input artifact: "
+                         f"{sorted(set(model_input_schema) - artifact_columns)}")
+
+    chunks = [read_artifact(artifact_run_id, 'model_input', columns=model_input_schema)]
+    report = validate_chunks(chunks, model_input_dtypes, model_input_domains, model_input_max_null_rates)
+    save_validation_report(report, 'model_input_validation_report')
+    check_validation_report(report)
+
+
+###############################################################################
+# Define the streaming validation engine
+###############################################################################
+
+def validate_chunks(chunks, dtypes, domains, max_null_rates):
+    '''
+    This function validates an iterable of dataframe chunks in one pass and
+    returns a report with one row per column. Only running counts are kept
+    between chunks so memory is bounded by the chunk size.
+
+    For every column it counts the nulls, the values that don't parse as the
+    dtype in dtypes (numeric dtypes must be numbers, integer dtypes whole
+    numbers and datetime dtypes dates) and the values outside the domain in
+    domains (a set of allowed values or a regular expression). A column fails
+    if it has any dtype or domain violation or its null rate is above its
+    limit in max_null_rates.
+
+
+    INPUTS
+        chunks : iterable of dataframes, e.g. pd.read_csv(..., chunksize=n)
+        dtypes : dictionary of column to expected dtype
+        domains : dictionary of column to set of values or regular expression
+        max_null_rates : dictionary of column to highest share of nulls allowed
+
+
+    OUTPUT
+        Dataframe with the columns 'column_name', 'rows', 'null_count',
+        'null_rate', 'dtype_violations', 'domain_violations' and 'status'.
+
+
+    SAMPLE USAGE
+        validate_chunks(pd.read_csv(path, dtype=str, chunksize=100000),
+                        raw_data_dtypes, raw_data_domains, raw_data_max_null_rates)
+    '''
+    counts = {}
+    for chunk in chunks:
+        for column in chunk.columns:
+            values = chunk[column]
+            not_null = values.notna()
+            column_counts = counts.setdefault(column, {'rows': 0, 'null_count': 0,
+                                                       'dtype_violations': 0, 'domain_violations': 0})
+            column_counts['rows'] += len(values)
+            column_counts['null_count'] += int((~not_null).sum())
+
+            parsed = parse_as_dtype(values, dtypes.get(column))
+            column_counts['dtype_violations'] += int((not_null & parsed.isna()).sum())
+
+            domain = domains.get(column)
+            if domain is None:
+                continue
+            if isinstance(domain, str):
+                in_domain = values.astype(str).str.fullmatch(domain)
+            else:
+                in_domain = parsed.isin(domain)
+            column_counts['domain_violations'] += int((not_null & ~in_domain).sum())
+
+    report = pd.DataFrame([dict(column_name=column, **column_counts) for column, column_counts in counts.items()],
+                          columns=['column_name', 'rows', 'null_count', 'dtype_violations', 'domain_violations'])
+    report['null_rate'] = (report['null_count'] / report['rows'].clip(lower=1)).round(4)
+    max_null_rate = report['column_name'].map(max_null_rates).fillna(1.0)
+    failed = (report['dtype_violations'] > 0) | (report['domain_violations'] > 0) | (report['null_rate'] > max_null_rate)
+    report['status'] = failed.map({True: 'failed', False: 'passed'})
+    report = report[['column_name', 'rows', 'null_count', 'null_rate',
+                     'dtype_violations', 'domain_violations', 'status']]
+
+    return report
+
+
+def check_validation_report(report):
+    '''
+    Prints the failed columns of a validation report and raises a ValueError
+    listing them, or prints that all the columns passed.
+    '''
+    failed = report[report['status'] == 'failed']
+    if failed.empty:
+        print('All the columns passed the validation checks')
+        return
+    print(failed)
+    raise ValueError(f"Columns failing the validation checks: {failed['column_name'].tolist()}")
+
+
+def parse_as_dtype(values, dtype):
+    '''
+    Returns values parsed as dtype, with null for every value that doesn't
+    parse. Values are returned unchanged for text, categorical or unknown
+    dtypes.
+    '''
+    if dtype is None or dtype in ('str', 'object', 'category'):
+        return values
+    if dtype.startswith('datetime'):
+        return pd.to_datetime(values, errors='coerce')
+    parsed = pd.to_numeric(values, errors='coerce')
+    if dtype.startswith(('int', 'uint')):
+        parsed = parsed.where(parsed % 1 == 0)
+    return parsed
+
+
+def save_validation_report(report, table_name):
+    '''
+    Saves the report of a validation pass with the time of the check in the
+    table named table_name of the db, replacing the previous report.
+    '''
+    report = report.assign(checked_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    conn = sqlite3.connect(f"{DB_PATH}/{DB_FILE_NAME}")
+    try:
+        write_table(conn, table_name, report)
+    finally:
+        conn.close()
@@ -2,10 +2,22 @@ import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
+import sys
 import time
+import resource
+import tracemalloc
+from functools import wraps
 from ydata_profiling import ProfileReport
 import sqlite3
 from sqlite3 import Error
+import hashlib
+import json
+import tempfile
+import shutil
+try:
+    import duckdb # run pip install duckdb, only needed for STORAGE_BACKEND = 'duckdb'
+except ImportError:
+    duckdb = None
 # from pycaret.classification import *
 import os
 from sklearn.model_selection import train_test_split
@@ -26,6 +38,7 @@ from sklearn.model_selection import StratifiedKFold
 from skopt import BayesSearchCV # run pip install scikit-optimize
 import mlflow
 import mlflow.sklearn
+import mlflow.lightgbm
 from sklearn.metrics import accuracy_score
 from sklearn.metrics import precision_score, recall_score
 from sklearn.metrics import precision_recall_fscore_support
@@ -34,10 +47,32 @@ from datetime import datetime
 from datetime import date
 
 
-def load_data(file_path_list):
+# dtype plan of the churn csv files (by file name, the new data files end with '_new'),
+# applied by pd.read_csv while the files are parsed instead of compressing the dataframes
+# afterwards: msno is categorical, counts and flags get compact ints and the yyyymmdd
+# dates are parsed as dates
+CHURN_READ_OPTIONS = {
+    'churn_logs': {'dtype': {'msno': 'category', 'is_churn': 'int8'}},
+    'userlogs': {'dtype': {'msno': 'category', 'num_25': 'int32', 'num_50': 'int32', 'num_75': 'int32',
+                           'num_985': 'int32', 'num_100': 'int32', 'num_unq': 'int32', 'total_secs': 'float32'},
+                 'parse_dates': ['date']},
+    'transactions_logs': {'dtype': {'msno': 'category', 'payment_method_id': 'int8', 'payment_plan_days': 'int16',
+                                    'plan_list_price': 'int16', 'actual_amount_paid': 'int16',
+                                    'is_auto_renew': 'int8', 'is_cancel': 'int8'},
+                          'parse_dates': ['transaction_date', 'membership_expire_date']},
+    'members_profile': {'dtype': {'msno': 'category', 'city': 'int8', 'bd': 'int16', 'gender': 'category',
+                                  'registered_via': 'int8'},
+                        'parse_dates': ['registration_init_time']},
+}
+CHURN_READ_OPTIONS['user_logs'] = CHURN_READ_OPTIONS['userlogs']
+
+def load_data(file_path_list, read_options=CHURN_READ_OPTIONS):
+    # read_options maps a csv file name (without '.csv' and '_new') to extra pd.read_csv
+    # arguments, files without an entry are read as is
     data = []
     for eachfile in file_path_list:
-        data.append(pd.read_csv(eachfile))
+        file_name = os.path.basename(eachfile).removesuffix('.csv').removesuffix('_new')
+        data.append(pd.read_csv(eachfile, **read_options.get(file_name, {})))
     return data
 
 def compress_dataframes(list_of_dfs):
@@ -241,14 +276,209 @@ def get_transformation_pipeline_from_setup():
 
 # Pipeline Functions 
 
+# Bulk writer used instead of DataFrame.to_sql: applies the pragmas below, then
+# drops/creates the typed table and inserts the rows with batched executemany
+# calls in a single transaction, so a table is replaced atomically.
+SQLITE_PRAGMAS = {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'cache_size': -65536, 'temp_store': 'MEMORY'}
+WRITE_BATCH_SIZE = 50000
+
+def apply_write_pragmas(cnx):
+    for pragma, value in SQLITE_PRAGMAS.items():
+        cnx.execute(f"PRAGMA {pragma} = {value}")
+
+def get_sqlite_values(series):
+    # numeric and string columns bind as is (NaN is stored as NULL), datetimes as text like to_sql
+    if pd.api.types.is_datetime64_any_dtype(series):
+        date_format = '%Y-%m-%d %H:%M:%S.%f' if (series.dt.microsecond != 0).any() else '%Y-%m-%d %H:%M:%S'
+        series = series.dt.strftime(date_format)
+    elif isinstance(series.dtype, np.dtype) and series.dtype.kind in 'biuf':
+        return series.tolist()
+    elif pd.api.types.is_string_dtype(series) and not isinstance(series.dtype, pd.CategoricalDtype):
+        return series.tolist()
+    return series.astype(object).where(series.notna(), None).tolist()
+
+def insert_dataframe(cnx, table_name, dataframe, batch_size=WRITE_BATCH_SIZE):
+    if is_duckdb_connection(cnx):
+        return insert_duckdb_dataframe(cnx, table_name, dataframe)
+    create_query = pd.io.sql.get_schema(dataframe, table_name, con=cnx)
+    cnx.execute(create_query.replace("CREATE TABLE", "CREATE TABLE IF NOT EXISTS", 1))
+    columns = ", ".join(f'"{col}"' for col in dataframe.columns)
+    placeholders = ", ".join("?" for _ in dataframe.columns)
+    insert_query = f'INSERT INTO "{table_name}" ({columns}) VALUES ({placeholders})'
+    for start in range(0, len(dataframe), batch_size):
+        batch = dataframe.iloc[start:start + batch_size]
+        cnx.executemany(insert_query, zip(*[get_sqlite_values(batch[col]) for col in batch.columns]))
+
+def write_table(cnx, table_name, dataframe, if_exists='replace', batch_size=WRITE_BATCH_SIZE):
+    if if_exists not in ('replace', 'append'):
+        raise ValueError(f"if_exists must be 'replace' or 'append', got {if_exists!r}")
+    if not is_duckdb_connection(cnx):
+        if cnx.in_transaction:
+            cnx.commit()
+        apply_write_pragmas(cnx)
+    try:
+        cnx.execute("BEGIN")
+        if if_exists == 'replace':
+            cnx.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+        insert_dataframe(cnx, table_name, dataframe, batch_size)
+        cnx.commit()
+    except Exception:
+        cnx.rollback()
+        raise
+
+
+# Storage backend of the data tables (user_logs, transactions, members and the
+# feature tables): 'sqlite' keeps them in db_file_name, 'duckdb' in a columnar
+# .duckdb file next to it whose full scans and group-bys run vectorized and
+# multi-threaded in-process. The drift db and stage_metrics always stay in SQLite.
+STORAGE_BACKEND = 'sqlite'
+
+def get_storage_file_path(db_path, db_file_name, backend=None):
+    backend = backend or STORAGE_BACKEND
+    if backend not in ('sqlite', 'duckdb'):
+        raise ValueError(f"storage backend must be 'sqlite' or 'duckdb', got {backend!r}")
+    if backend == 'duckdb':
+        return db_path + os.path.splitext(db_file_name)[0] + '.duckdb'
+    return db_path + db_file_name
+
+def connect_db(db_path, db_file_name, backend=None):
+    # connection to the data tables, usable with read_table/write_table/check_if_table_has_value
+    backend = backend or STORAGE_BACKEND
+    storage_file_path = get_storage_file_path(db_path, db_file_name, backend)
+    if backend == 'duckdb':
+        if duckdb is None:
+            raise ImportError("STORAGE_BACKEND = 'duckdb' needs the duckdb package: pip install duckdb")
+        return duckdb.connect(storage_file_path)
+    return sqlite3.connect(storage_file_path)
+
+def is_duckdb_connection(cnx):
+    return duckdb is not None and isinstance(cnx, duckdb.DuckDBPyConnection)
+
+def read_table(cnx, table_name):
+    if is_duckdb_connection(cnx):
+        return cnx.execute(f'SELECT * FROM "{table_name}"').df()
+    return pd.read_sql(f'select * from "{table_name}"', cnx)
+
+def insert_duckdb_dataframe(cnx, table_name, dataframe):
+    # one INSERT ... SELECT from the registered dataframe; categoricals are stored as their values
+    categorical_columns = [col for col in dataframe.columns if isinstance(dataframe[col].dtype, pd.CategoricalDtype)]
+    dataframe = dataframe.astype({col: dataframe[col].cat.categories.dtype for col in categorical_columns})
+    cnx.register('insert_dataframe_view', dataframe)
+    try:
+        cnx.execute(f'CREATE TABLE IF NOT EXISTS "{table_name}" AS SELECT * FROM insert_dataframe_view LIMIT 0')
+        cnx.execute(f'INSERT INTO "{table_name}" BY NAME SELECT * FROM insert_dataframe_view')
+    finally:
+        cnx.unregister('insert_dataframe_view')
+
+
+# Stage instrumentation: wall/CPU time and process peak RSS of every run of a
+# pipeline stage, appended to the stage_metrics table of the stage's db
+# (db_path + db_file_name, its first two arguments) and written for the latest
+# run of every stage to a Prometheus textfile next to it. The tracemalloc peak
+# slows a stage down many times over and the rows in/out cost a COUNT(*) of the
+# input and output tables, so both are only recorded when switched on here.
+STAGE_METRICS_FILE_NAME = 'churn_pipeline.prom'
+TRACE_STAGE_MEMORY = False
+COUNT_STAGE_ROWS = False
+STAGE_METRICS_COLUMNS = ['stage', 'status', 'started_at', 'wall_seconds', 'cpu_seconds',
+                         'peak_traced_bytes', 'peak_rss_bytes', 'rows_in', 'rows_out']
+
+def instrument_stage(input_table=None, output_table=None):
+    def decorator(stage):
+        @wraps(stage)
+        def instrumented_stage(db_path, db_file_name, *args, **kwargs):
+            rows_in = count_table_rows(db_path, db_file_name, input_table) if COUNT_STAGE_ROWS else None
+            start_tracing = TRACE_STAGE_MEMORY and not tracemalloc.is_tracing()
+            if start_tracing:
+                tracemalloc.start()
+            started_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            wall_start, cpu_start = time.perf_counter(), time.process_time()
+            status = 'failed'
+            try:
+                result = stage(db_path, db_file_name, *args, **kwargs)
+                status = 'success'
+                return result
+            finally:
+                metrics = {'stage': stage.__name__, 'status': status, 'started_at': started_at,
+                           'wall_seconds': round(time.perf_counter() - wall_start, 6),
+                           'cpu_seconds': round(time.process_time() - cpu_start, 6),
+                           'peak_traced_bytes': tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None,
+                           'peak_rss_bytes': get_peak_rss_bytes(),
+                           'rows_in': rows_in}
+                if start_tracing:
+                    tracemalloc.stop()
+                metrics['rows_out'] = count_table_rows(db_path, db_file_name, output_table) if COUNT_STAGE_ROWS else None
+                save_stage_metrics(db_path, db_file_name, metrics)
+        return instrumented_stage
+    return decorator
+
+def count_table_rows(db_path, db_file_name, table_name):
+    if table_name is None or not os.path.isfile(get_storage_file_path(db_path, db_file_name)):
+        return None
+    cnx = connect_db(db_path, db_file_name)
+    try:
+        if not check_if_table_has_value(cnx, table_name):
+            return None
+        return cnx.execute(f'SELECT COUNT(*) FROM "{table_name}"').fetchone()[0]
+    finally:
+        cnx.close()
+
+def get_peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+def save_stage_metrics(db_path, db_file_name, metrics):
+    print(f"Stage {metrics['stage']} {metrics['status']} in {metrics['wall_seconds']:.3f}s "
+          f"(cpu {metrics['cpu_seconds']:.3f}s, rows in {metrics['rows_in']}, rows out {metrics['rows_out']})")
+    if not os.path.isfile(db_path + db_file_name):
+        return
+    cnx = sqlite3.connect(db_path + db_file_name)
+    try:
+        cnx.execute("CREATE TABLE IF NOT EXISTS stage_metrics "
+                    "(stage TEXT, status TEXT, started_at TEXT, wall_seconds REAL, cpu_seconds REAL, "
+                    "peak_traced_bytes INTEGER, peak_rss_bytes INTEGER, rows_in INTEGER, rows_out INTEGER)")
+        cnx.execute(f"INSERT INTO stage_metrics ({', '.join(STAGE_METRICS_COLUMNS)}) "
+                    f"VALUES ({', '.join('?' for _ in STAGE_METRICS_COLUMNS)})",
+                    [metrics[column] for column in STAGE_METRICS_COLUMNS])
+        cnx.commit()
+        latest = pd.read_sql("SELECT * FROM stage_metrics WHERE rowid IN "
+                             "(SELECT MAX(rowid) FROM stage_metrics GROUP BY stage) ORDER BY stage", cnx)
+        write_prometheus_textfile(latest, db_path + STAGE_METRICS_FILE_NAME)
+    except (Error, OSError) as e:
+        # metrics must never fail the stage itself
+        print(f"Could not save the metrics of stage {metrics['stage']}: {e}")
+    finally:
+        cnx.close()
+
+def write_prometheus_textfile(latest_metrics, file_path):
+    lines = []
+    for column in STAGE_METRICS_COLUMNS[3:]:
+        name = f"churn_stage_{column}"
+        lines += [f"# HELP {name} {column} of the last run of the pipeline stage.", f"# TYPE {name} gauge"]
+        for row in latest_metrics.itertuples(index=False):
+            value = getattr(row, column)
+            if pd.notna(value):
+                value = int(value) if float(value).is_integer() else value
+                lines.append(f'{name}{{stage="{row.stage}",status="{row.status}"}} {value}')
+    # written to a temporary file and moved in place so a scrape never reads a half written file
+    with open(file_path + '.tmp', 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(file_path + '.tmp', file_path)
+
+
 def check_if_table_has_value(cnx,table_name):
     # cnx = sqlite3.connect(db_path+db_file_name)
-    check_table = pd.read_sql(f"SELECT name FROM sqlite_master WHERE type='table' AND name='{table_name}';", cnx).shape[0]
+    if is_duckdb_connection(cnx):
+        check_table = len(cnx.execute("SELECT 1 FROM information_schema.tables WHERE table_name = ?", [table_name]).fetchall())
+    else:
+        check_table = pd.read_sql(f"SELECT name FROM sqlite_master WHERE type='table' AND name='{table_name}';", cnx).shape[0]
     if check_table == 1:
         return True
     else:
         return False
     
+@instrument_stage()
 def build_dbs(db_path,db_file_name):
     if os.path.isfile(db_path+db_file_name):
         print( "DB Already Exsist")
@@ -290,14 +520,11 @@ def get_new_data_appended(old_data_directory,new_data_directory, start_data, end
     #get the list of memebers fron historical data. This assumes, no new user has been added in the system. Shouldn't be done, when new users are adde
     #Some Date Filters are manual at this point for sanity check 
     
-    user_logs_n['date'] = fix_time_in_df(user_logs_n, 'date', expand=False)
     march_user_logs = user_logs_n[(user_logs_n['date']>start_data) & 
             (user_logs_n['date']<end_date) &
             (user_logs_n['msno'].isin(members_list)) & 
             (user_logs_n['msno'].isin(train_members_list))]
 
-    transactions_n['transaction_date'] = fix_time_in_df(transactions_n, 'transaction_date', expand=False)
-    transactions_n['membership_expire_date'] = fix_time_in_df(transactions_n, 'membership_expire_date', expand=False)
     march_transactions = transactions_n[(transactions_n['transaction_date']>start_data) & 
                (transactions_n['transaction_date']<end_date) & 
                (transactions_n['membership_expire_date']<'2017-12-31') & 
@@ -311,6 +538,7 @@ def get_new_data_appended(old_data_directory,new_data_directory, start_data, end
         transactions_combined = transactions.append(march_transactions)
         return user_logs_combined, transactions_combined
 
+@instrument_stage(output_table='train')
 def load_data_from_source(db_path,db_file_name,drfit_db_name, 
                           old_data_directory,new_data_directory,
                           run_on='old',start_data='2017-03-01', end_date='2017-03-31',
@@ -324,41 +552,35 @@ def load_data_from_source(db_path,db_file_name,drfit_db_name,
     if process_flags['load_data'][0] == 1:
         if run_on=='old':
             print("Running on OLD Data") 
-            cnx = sqlite3.connect(db_path+db_file_name)
+            cnx = connect_db(db_path, db_file_name)
 
             if not check_if_table_has_value(cnx,'train'):
                 print("Table Doesn't Exsist - train, Building")
                 train = load_data( [f"{old_data_directory}churn_logs.csv",
                            ]
                          )[0]
-                train.to_sql(name='train', con=cnx,if_exists='replace',index=False)
+                write_table(cnx, 'train', train)
 
             if not check_if_table_has_value(cnx,'user_logs'):
                 print("Table Doesn't Exsist - user_logs, Building")
                 user_logs = load_data( [f"{old_data_directory}userlogs.csv",
                            ]
                          )[0]
-                user_logs, pre_size, post_size = compress_dataframes([user_logs])[0]
-                print("user_logs DF before compress was in MB ,",pre_size, "and after compress , ", post_size)
-                user_logs.to_sql(name='user_logs', con=cnx, if_exists='replace',index=False)
+                write_table(cnx, 'user_logs', user_logs)
 
             if not check_if_table_has_value(cnx,'transactions'):
                 print("Table Doesn't Exsist - transactions, Building")
                 transactions = load_data( [f"{old_data_directory}transactions_logs.csv",
                            ]
                          )[0]
-                transactions, pre_size, post_size = compress_dataframes([transactions])[0]
-                print("transactions DF before compress was in MB ,",pre_size, "and after compress , ", post_size)
-                transactions.to_sql(name='transactions', con=cnx,if_exists='replace',index=False)
+                write_table(cnx, 'transactions', transactions)
 
             if not check_if_table_has_value(cnx,'members'):
                 print("Table Doesn't Exsist - members, Building")
                 members = load_data( [f"{old_data_directory}members_profile.csv",
                            ]
                          )[0]
-                members, pre_size, post_size = compress_dataframes([members])[0]
-                print("members DF before compress was in MB ,",pre_size, "and after compress , ", post_size)
-                members.to_sql(name='members', con=cnx,if_exists='replace',index=False)
+                write_table(cnx, 'members', members)
 
             cnx.close()
             return "Writing to DataBase Done or Data Already was in Table. Check Logs."
@@ -366,7 +588,7 @@ def load_data_from_source(db_path,db_file_name,drfit_db_name,
         elif run_on=='new':
             if append:
                 print("Running on New Data") 
-                cnx = sqlite3.connect(db_path+db_file_name)
+                cnx = connect_db(db_path, db_file_name)
 
                 #Appending new Data to exsisting data
                 march_user_logs, march_transactions = get_new_data_appended(old_data_directory,new_data_directory, start_data, end_date)
@@ -377,83 +599,65 @@ def load_data_from_source(db_path,db_file_name,drfit_db_name,
                     train = load_data( [f"{old_data_directory}churn_logs.csv",
                                ]
                              )[0]
-                    train.to_sql(name='train', con=cnx,if_exists='replace',index=False)
+                    write_table(cnx, 'train', train)
 
                 if not check_if_table_has_value(cnx,'user_logs'):
                     print("Table Doesn't Exsist - user_logs, Building")
                     user_logs = load_data( [f"{old_data_directory}userlogs.csv",
                                ]
                              )[0]
-                    user_logs['date'] = fix_time_in_df(user_logs, 'date', expand=False)
-                    user_logs_appended = user_logs.append(march_user_logs)
-                    user_logs, pre_size, post_size = compress_dataframes([user_logs_appended])[0]
-
-                    print(user_logs.head())
-                    print("user_logs DF before compress was in MB ,",pre_size, "and after compress , ", post_size)
-                    user_logs.to_sql(name='user_logs', con=cnx, if_exists='replace',index=False)
+                    user_logs = user_logs.append(march_user_logs)
+                    write_table(cnx, 'user_logs', user_logs)
 
                 if not check_if_table_has_value(cnx,'transactions'):
                     print("Table Doesn't Exsist - transactions, Building")
                     transactions = load_data( [f"{old_data_directory}transactions_logs.csv",
                                ]
                              )[0]
-                    transactions['transaction_date'] = fix_time_in_df(transactions, 'transaction_date', expand=False)
-                    transactions['membership_expire_date'] = fix_time_in_df(transactions, 'membership_expire_date', expand=False)
-                    transactions_appended = transactions.append(march_transactions)
-                    transactions, pre_size, post_size = compress_dataframes([transactions_appended])[0]
-
-                    print("transactions DF before compress was in MB ,",pre_size, "and after compress , ", post_size)
-                    transactions.to_sql(name='transactions', con=cnx,if_exists='replace',index=False)
+                    transactions = transactions.append(march_transactions)
+                    write_table(cnx, 'transactions', transactions)
 
                 if not check_if_table_has_value(cnx,'members'):
                     print("Table Doesn't Exsist - members, Building")
                     members = load_data( [f"{old_data_directory}members_profile.csv",
                                ]
                              )[0]
-                    members, pre_size, post_size = compress_dataframes([members])[0]
-                    print("members DF before compress was in MB ,",pre_size, "and after compress , ", post_size)
-                    members.to_sql(name='members', con=cnx,if_exists='replace',index=False)
+                    write_table(cnx, 'members', members)
 
                 cnx.close()
                 return "Writing to DataBase Done or Data Already was in Table. Check Logs."
             
             else:
                 print("Running on New Data without Append.") 
-                cnx = sqlite3.connect(db_path+db_file_name)
+                cnx = connect_db(db_path, db_file_name)
 
                 if not check_if_table_has_value(cnx,'train'):
                     print("Table Doesn't Exsist - train, Building")
                     train = load_data( [f"{new_data_directory}churn_logs_new.csv",
                                ]
                              )[0]
-                    train.to_sql(name='train', con=cnx,if_exists='replace',index=False)
+                    write_table(cnx, 'train', train)
 
                 if not check_if_table_has_value(cnx,'user_logs'):
                     print("Table Doesn't Exsist - user_logs, Building")
                     user_logs = load_data( [f"{new_data_directory}user_logs_new.csv",
                                ]
                              )[0]
-                    user_logs, pre_size, post_size = compress_dataframes([user_logs])[0]
-                    print("user_logs DF before compress was in MB ,",pre_size, "and after compress , ", post_size)
-                    user_logs.to_sql(name='user_logs', con=cnx, if_exists='replace',index=False)
+                    write_table(cnx, 'user_logs', user_logs)
 
                 if not check_if_table_has_value(cnx,'transactions'):
                     print("Table Doesn't Exsist - transactions, Building")
                     transactions = load_data( [f"{new_data_directory}transactions_logs_new.csv",
                                ]
                              )[0]
-                    transactions, pre_size, post_size = compress_dataframes([transactions])[0]
-                    print("transactions DF before compress was in MB ,",pre_size, "and after compress , ", post_size)
-                    transactions.to_sql(name='transactions', con=cnx,if_exists='replace',index=False)
+                    write_table(cnx, 'transactions', transactions)
 
                 if not check_if_table_has_value(cnx,'members'):
                     print("Table Doesn't Exsist - members, Building")
                     members = load_data( [f"{new_data_directory}members_profile_new.csv",
                                ]
                              )[0]
-                    members, pre_size, post_size = compress_dataframes([members])[0]
-                    print("members DF before compress was in MB ,",pre_size, "and after compress , ", post_size)
-                    members.to_sql(name='members', con=cnx,if_exists='replace',index=False)
+                    write_table(cnx, 'members', members)
 
                 cnx.close()
                 return "Writing to DataBase Done or Data Already was in Table. Check Logs."
@@ -461,15 +665,16 @@ def load_data_from_source(db_path,db_file_name,drfit_db_name,
     else:
         print("Skipping.....Not required")
 
+@instrument_stage(input_table='members', output_table='members_final')
 def get_membership_data_transform(db_path,db_file_name,drfit_db_name):
-    cnx = sqlite3.connect(db_path+db_file_name)
+    cnx = connect_db(db_path, db_file_name)
     cnx_drift = sqlite3.connect(db_path+drfit_db_name)
     process_flags = pd.read_sql('select * from process_flags', cnx_drift)
     
     if process_flags['process_members'][0] == 1:
         if not check_if_table_has_value(cnx,'members_final'):
 
-            members = pd.read_sql('select * from members', cnx)
+            members = read_table(cnx, 'members')
 
             members['gender'] = get_fill_na_dataframe(members, 'gender', value="others")
             gender_mapping = {'male':0,'female':1,'others':2}
@@ -481,22 +686,23 @@ def get_membership_data_transform(db_path,db_file_name,drfit_db_name):
             condition = f"{average_age} if (x <=0 or x >100) else x"
             members['bd'] = get_apply_condiiton_on_column(members, 'bd', condition)
 
-            members.to_sql(name='members_final', con=cnx,if_exists='replace',index=False)
+            write_table(cnx, 'members_final', members)
 
             return "Membership Data is Transformed and Saved into members_final"
         return "Membership Data is already Transformed and Saved into members_final"
     else:
         print("Not Required......Skipping") 
 
+@instrument_stage(input_table='transactions', output_table='transactions_features_final')
 def get_transaction_data_transform(db_path,db_file_name,drfit_db_name):
-    cnx = sqlite3.connect(db_path+db_file_name)
+    cnx = connect_db(db_path, db_file_name)
     cnx_drift = sqlite3.connect(db_path+drfit_db_name)
     process_flags = pd.read_sql('select * from process_flags', cnx_drift)
     
     if process_flags['process_transactions'][0] == 1:
     
         if not check_if_table_has_value(cnx,'transactions_features_final'):
-            transactions = pd.read_sql('select * from transactions', cnx)
+            transactions = read_table(cnx, 'transactions')
 
             transactions['transaction_date'] = fix_time_in_df(transactions, 'transaction_date', expand=False)
             transactions['membership_expire_date'] = fix_time_in_df(transactions, 'membership_expire_date', expand=False)
@@ -539,7 +745,7 @@ def get_transaction_data_transform(db_path,db_file_name,drfit_db_name):
                                                     'payment_method_id_nunique':'change_in_payment_methods','is_cancel_max':'is_cancel_change_flag',
                                                     'is_auto_renew_max':'is_autorenew_change_flag','transaction_date_count':'total_transactions'}, inplace = True)
 
-            transactions_features.to_sql(name='transactions_features_final', con=cnx,if_exists='replace',index=False)
+            write_table(cnx, 'transactions_features_final', transactions_features)
 
             return "transactions Data is Transformed and Saved into transactions_features_final"
         return "transactions Data is already Transformed and Saved into transactions_features_final"
@@ -547,14 +753,15 @@ def get_transaction_data_transform(db_path,db_file_name,drfit_db_name):
     else:
         print("Not Required......Skipping") 
 
+@instrument_stage(input_table='user_logs', output_table='user_logs_features_final')
 def get_user_data_transform(db_path,db_file_name,drfit_db_name):
-    cnx = sqlite3.connect(db_path+db_file_name)
+    cnx = connect_db(db_path, db_file_name)
     cnx_drift = sqlite3.connect(db_path+drfit_db_name)
     process_flags = pd.read_sql('select * from process_flags', cnx_drift)
     
     if process_flags['process_userlogs'][0] == 1:
         if not check_if_table_has_value(cnx,'user_logs_features_final'):
-            user_logs = pd.read_sql('select * from user_logs', cnx)
+            user_logs = read_table(cnx, 'user_logs')
 
             user_logs['date'] =  fix_time_in_df(user_logs, column_name='date', expand=False)
             user_logs_transformed = get_fix_skew_with_log(user_logs, ['num_25','num_50','num_75','num_985','num_100','num_unq','total_secs'], 
@@ -572,7 +779,7 @@ def get_user_data_transform(db_path,db_file_name,drfit_db_name):
 
             user_logs_final = get_merge(user_logs_transformed_base, user_logs_transformed_dates, on = 'msno') 
 
-            user_logs_final.to_sql(name='user_logs_features_final', con=cnx,if_exists='replace',index=False)
+            write_table(cnx, 'user_logs_features_final', user_logs_final)
 
             return "user_logs Data is Transformed and Saved into user_logs_features_final"
         return "user_logs Data is already Transformed and Saved into user_logs_features_final"
@@ -581,9 +788,10 @@ def get_user_data_transform(db_path,db_file_name,drfit_db_name):
         print("Not Required......Skipping")
 
 
+@instrument_stage(input_table='train', output_table='final_features_v01')
 def get_final_data_merge(db_path,db_file_name,drfit_db_name):
     
-    cnx = sqlite3.connect(db_path+db_file_name)
+    cnx = connect_db(db_path, db_file_name)
     cnx_drift = sqlite3.connect(db_path+drfit_db_name)
     process_flags = pd.read_sql('select * from process_flags', cnx_drift)
     
@@ -591,16 +799,16 @@ def get_final_data_merge(db_path,db_file_name,drfit_db_name):
         
         if not check_if_table_has_value(cnx,'final_features_v01'):
             print ("Final Merge Doesn't Exsist in DB") 
-            members_final =     pd.read_sql('select * from members_final', cnx)
-            transactions_final = pd.read_sql('select * from transactions_features_final', cnx)
-            user_logs_final =    pd.read_sql('select * from user_logs_features_final', cnx)
-            train =     pd.read_sql('select * from train', cnx)
+            members_final =     read_table(cnx, 'members_final')
+            transactions_final = read_table(cnx, 'transactions_features_final')
+            user_logs_final =    read_table(cnx, 'user_logs_features_final')
+            train =     read_table(cnx, 'train')
 
             train_df_v01 = get_merge(members_final, train, on='msno', axis=1, how='inner')
             train_df_v02 = get_merge(train_df_v01, transactions_final, on='msno', axis=1, how='inner')
             train_df_final = get_merge(train_df_v02, user_logs_final, on='msno', axis=1, how='inner')
 
-            train_df_final.to_sql(name='final_features_v01', con=cnx,if_exists='replace',index=False)
+            write_table(cnx, 'final_features_v01', train_df_final)
 
             return "All Data is Merged and Saved into final_features_v01"
         else:
@@ -610,18 +818,19 @@ def get_final_data_merge(db_path,db_file_name,drfit_db_name):
         print("Not Required......Skipping")
 
 
+@instrument_stage(input_table='final_features_v01', output_table='X')
 def get_data_prepared_for_modeling(db_path,db_file_name,drfit_db_name, scale_method='standard',date_columns=None,corr_threshold=0.90,drop_corr=False,
-                                   date_transformation=True):
+                                   date_transformation=True,model_name='LightGBM',stage='Production'):
   # print(len(dataframe.columns))
   # removingmulti-colinearity 
-    cnx = sqlite3.connect(db_path+db_file_name)
+    cnx = connect_db(db_path, db_file_name)
     
     cnx_drift = sqlite3.connect(db_path+drfit_db_name)
     process_flags = pd.read_sql('select * from process_flags', cnx_drift)
     
     if process_flags['Data_Preparation'][0] == 1:
         if not check_if_table_has_value(cnx,'X') and not check_if_table_has_value(cnx,'y'):
-            dataframe = pd.read_sql('select * from final_features_v01', cnx)
+            dataframe = read_table(cnx, 'final_features_v01')
             # Create correlation matrix
             corr_matrix = dataframe.corr().abs()
             # Select upper triangle of correlation matrix
@@ -661,8 +870,22 @@ def get_data_prepared_for_modeling(db_path,db_file_name,drfit_db_name, scale_met
 
             #scaling
             column_to_scale = dataframe.select_dtypes(include=['float64','int64']).columns.drop('is_churn')
-            transformer = StandardScaler().fit(dataframe[column_to_scale])
-            scaled_data = pd.DataFrame(transformer.transform(dataframe[column_to_scale]),columns=column_to_scale)
+            # incremental retraining keeps the scale the Production model was trained on (logged
+            # with it, see log_scaler_params), so its split thresholds still apply to the new X.
+            # Refitting the scaler would silently shift them, so a mismatch fails the run instead
+            if process_flags.get('Model_Training_incremental', pd.Series([0]))[0] == 1:
+                scaler_params = load_model_scaler_params(model_name, stage)
+                if list(scaler_params['column_name']) != list(column_to_scale):
+                    raise ValueError(f"The columns to scale {list(column_to_scale)} don't match the "
+                                     f"scaler_params {list(scaler_params['column_name'])} of the {stage} "
+                                     f"model, run a full retrain (Model_Training_plain)")
+            else:
+                transformer = StandardScaler().fit(dataframe[column_to_scale])
+                scaler_params = pd.DataFrame({'column_name': column_to_scale,
+                                              'mean': transformer.mean_, 'scale': transformer.scale_})
+            # the scale X is prepared with, logged with the models trained on it
+            write_table(cnx, 'scaler_params', scaler_params)
+            scaled_data = (dataframe[column_to_scale] - scaler_params['mean'].to_numpy()) / scaler_params['scale'].to_numpy()
 
             #Combining
             if date_transformation:
@@ -678,9 +901,10 @@ def get_data_prepared_for_modeling(db_path,db_file_name,drfit_db_name, scale_met
             index_df = dataframe[['msno']]
             index_df['index_for_map'] = index_df.index
             
-            X.to_sql(name='X', con=cnx,if_exists='replace',index=False)
-            y.to_sql(name='y', con=cnx,if_exists='replace',index=False)
-            index_df.to_sql(name='index_msno_mapping', con=cnx,if_exists='replace',index=False)
+            write_table(cnx, 'X', X)
+            write_table(cnx, 'y', y)
+            write_table(cnx, 'index_msno_mapping', index_df)
+            save_training_data_fingerprint(cnx, X, y)
             return "X & Y written on database"
         else:
             return "X & Y Already exsist in Data."
@@ -689,53 +913,183 @@ def get_data_prepared_for_modeling(db_path,db_file_name,drfit_db_name, scale_met
         print("Not Required......Skipping")
 
 
+# LightGBM Dataset cache: X/y are saved next to the db as .npy files (memory-mapped
+# on load) with the train/test split once per input fingerprint (saved with X/y by
+# get_data_prepared_for_modeling), and the training split is binned once per set of
+# binning params and saved as a binary Dataset. Training and tuning runs on
+# unchanged X/y skip the SQL read, the split and the feature binning. Only the entry
+# of the current X/y is kept, the others are deleted when a new one is written.
+DATASET_CACHE_DIRECTORY = 'lgb_dataset_cache'
+DATASET_PARAMS = {'max_bin': 255, 'verbose': -1}
+TEST_SIZE = 0.3
+
+def get_training_data_fingerprint(X, y):
+    fingerprint = hashlib.sha256(json.dumps([list(X.columns), list(y.columns)]).encode())
+    for dataframe in (X, y):
+        fingerprint.update(pd.util.hash_pandas_object(dataframe, index=False).to_numpy().tobytes())
+    return fingerprint.hexdigest()
+
+def save_training_data_fingerprint(cnx, X, y):
+    write_table(cnx, 'training_data_fingerprint', pd.DataFrame({'fingerprint': [get_training_data_fingerprint(X, y)]}))
+
+def read_training_data_fingerprint(cnx):
+    if not check_if_table_has_value(cnx, 'training_data_fingerprint'):
+        return None
+    return read_table(cnx, 'training_data_fingerprint')['fingerprint'][0]
+
+def get_cache_key(*values):
+    return hashlib.sha256(json.dumps(values, sort_keys=True).encode()).hexdigest()[:16]
+
+def get_training_dataset(db_path, db_file_name, dataset_params=None, test_size=TEST_SIZE, random_state=0):
+    # returns X, y, the split and (if dataset_params is given) the binned Dataset of the
+    # training split from the cache, building what's missing first
+    cnx = connect_db(db_path, db_file_name)
+    try:
+        X = y = None
+        fingerprint = read_training_data_fingerprint(cnx)
+        if fingerprint is None:
+            # X/y written before the fingerprint was saved with them
+            X, y = read_table(cnx, 'X'), read_table(cnx, 'y')
+            fingerprint = get_training_data_fingerprint(X, y)
+        cache_path = os.path.join(db_path, DATASET_CACHE_DIRECTORY, get_cache_key(fingerprint, test_size, random_state))
+        if not os.path.isfile(os.path.join(cache_path, 'feature_names.json')):
+            if X is None:
+                X, y = read_table(cnx, 'X'), read_table(cnx, 'y')
+            save_training_arrays(cache_path, X, y, test_size, random_state)
+            prune_dataset_cache(cache_path)
+    finally:
+        cnx.close()
+
+    data = {name: np.load(os.path.join(cache_path, f"{name}.npy"), mmap_mode='r')
+            for name in ('X', 'y', 'train_index', 'test_index')}
+    with open(os.path.join(cache_path, 'feature_names.json')) as f:
+        data['feature_names'] = json.load(f)
+    data['train_set'] = None
+    if dataset_params is not None:
+        dataset_params = {**DATASET_PARAMS, **dataset_params}
+        data['train_set'] = get_binned_dataset(cache_path, data, dataset_params)
+    return data
+
+def save_training_arrays(cache_path, X, y, test_size, random_state):
+    # same split as train_test_split(X, y, test_size=test_size, random_state=random_state)
+    train_index, test_index = train_test_split(np.arange(len(X)), test_size=test_size, random_state=random_state)
+    os.makedirs(cache_path, exist_ok=True)
+    arrays = {'X': X.to_numpy(dtype=np.float64), 'y': y.iloc[:, 0].to_numpy(),
+              'train_index': train_index, 'test_index': test_index}
+    for name, values in arrays.items():
+        np.save(os.path.join(cache_path, f"{name}.npy"), values)
+    # feature_names.json is written last and moved in place, it marks the arrays as complete
+    with open(os.path.join(cache_path, 'feature_names.json.tmp'), 'w') as f:
+        json.dump(list(X.columns), f)
+    os.replace(os.path.join(cache_path, 'feature_names.json.tmp'), os.path.join(cache_path, 'feature_names.json'))
+    print(f"Training data cached in {cache_path}")
+
+def prune_dataset_cache(cache_path):
+    # deletes the cache entries of the previous X/y (arrays and binned Datasets)
+    cache_directory = os.path.dirname(cache_path)
+    for entry in os.scandir(cache_directory):
+        if entry.is_dir() and entry.path != cache_path:
+            shutil.rmtree(entry.path)
+            print(f"Deleted the stale training data cache {entry.path}")
+
+def get_binned_dataset(cache_path, data, dataset_params):
+    file_path = os.path.join(cache_path, f"train_{get_cache_key(dataset_params)}.bin")
+    if os.path.isfile(file_path):
+        print(f"Using the cached training Dataset {file_path}")
+    else:
+        train_index = data['train_index']
+        train_set = lgb.Dataset(data['X'][train_index], label=data['y'][train_index],
+                                feature_name=data['feature_names'], params=dataset_params)
+        train_set.save_binary(file_path + '.tmp')
+        os.replace(file_path + '.tmp', file_path)
+        print(f"Training Dataset binned and cached in {file_path}")
+    return lgb.Dataset(file_path, params=dataset_params)
+
+def get_dataset_params(model_config):
+    # the params of model_config the binning depends on: the rows sampled for the bin
+    # boundaries and their seed, so the cached Dataset bins like LGBMClassifier.fit does
+    params = {'bin_construct_sample_cnt': model_config.get('subsample_for_bin'),
+              'seed': model_config.get('random_state')}
+    return {key: value for key, value in params.items() if value is not None}
+
+def get_booster_params(model_config):
+    # LGBMClassifier params as lgb.train params (the sklearn names are aliases of the core params);
+    # the number of rounds is passed to lgb.train and the binning params are in DATASET_PARAMS
+    params = {key: value for key, value in model_config.items()
+              if key not in ('n_estimators', 'class_weight', 'importance_type', 'silent', 'subsample_for_bin')}
+    params['objective'] = params.get('objective') or 'binary'
+    params['n_jobs'] = max(params.get('n_jobs', 0), 0)
+    params['verbose'] = -1
+    return params
+
+def load_churn_model(model_uri):
+    # models trained on the cached Dataset are logged as LightGBM Boosters, older ones as LGBMClassifier
+    if 'lightgbm' in mlflow.models.get_model_info(model_uri).flavors:
+        return mlflow.lightgbm.load_model(model_uri)
+    return mlflow.sklearn.load_model(model_uri)
+
+def predict_churn_proba(model, X):
+    # probabilities of not churn and churn, as LGBMClassifier.predict_proba returns them
+    if isinstance(model, lgb.Booster):
+        churn = model.predict(X)
+        return np.column_stack([1 - churn, churn])
+    return model.predict_proba(X)
+
+
+# model config imported from pycaret experimentation, also used to boost the Production model further
+MODEL_CONFIG = {
+    'boosting_type': 'gbdt',
+    'class_weight': None,
+    'colsample_bytree': 1.0,
+    'importance_type': 'split' ,
+    'learning_rate': 0.1,
+    'max_depth': -1,
+    'min_child_samples': 20,
+    'min_child_weight': 0.001,
+    'min_split_gain': 0.0,
+    'n_estimators': 100,
+    'n_jobs': -1,
+    'num_leaves': 31,
+    'objective': None,
+    'random_state': 42,
+    'reg_alpha': 0.0,
+    'reg_lambda': 0.0,
+    'silent': 'warn',
+    'subsample': 1.0,
+    'subsample_for_bin': 200000 ,
+    'subsample_freq': 0
+}
+
+@instrument_stage(input_table='X')
 def get_train_model(db_path,db_file_name,drfit_db_name):
     cnx_drift = sqlite3.connect(db_path+drfit_db_name)
     process_flags = pd.read_sql('select * from process_flags', cnx_drift)
     
-    if process_flags['Data_Preparation'][0] == 1:
-        cnx = sqlite3.connect(db_path+db_file_name)
-        X = pd.read_sql('select * from X', cnx)
-        y = pd.read_sql('select * from y', cnx)
-        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size = 0.3, random_state = 0)
-
-        model_config = {
-        'boosting_type': 'gbdt',
-        'class_weight': None,
-        'colsample_bytree': 1.0,
-        'importance_type': 'split' ,
-        'learning_rate': 0.1,
-        'max_depth': -1,
-        'min_child_samples': 20,
-        'min_child_weight': 0.001,
-        'min_split_gain': 0.0,
-        'n_estimators': 100,
-        'n_jobs': -1,
-        'num_leaves': 31,
-        'objective': None,
-        'random_state': 42,
-        'reg_alpha': 0.0,
-        'reg_lambda': 0.0,
-        'silent': 'warn',
-        'subsample': 1.0,
-        'subsample_for_bin': 200000 ,
-        'subsample_freq': 0
-        }
+    # with incremental retraining the Production model is boosted further instead
+    # (get_train_model_incremental), unless a plain retrain is asked for as well
+    incremental_only = process_flags.get('Model_Training_incremental', pd.Series([0]))[0] == 1 and \
+        process_flags['Model_Training_plain'][0] == 0
+    if process_flags['Data_Preparation'][0] == 1 and not incremental_only:
+        model_config = MODEL_CONFIG
 
+        data = get_training_dataset(db_path, db_file_name, get_dataset_params(model_config))
+        X_test = pd.DataFrame(data['X'][data['test_index']], columns=data['feature_names'])
+        y_test = data['y'][data['test_index']]
 
         #Model Training
 
         with mlflow.start_run(run_name='run_LightGB_withoutHPTune') as run:
-            #Model Training
-            clf = lgb.LGBMClassifier()
-            clf.set_params(**model_config) 
-            clf.fit(X_train, y_train)
+            #Model Training on the cached binned Dataset
+            booster = lgb.train(get_booster_params(model_config), data['train_set'],
+                                num_boost_round=model_config['n_estimators'])
 
-            mlflow.sklearn.log_model(sk_model=clf,artifact_path="models", registered_model_name='LightGBM')
+            mlflow.lightgbm.log_model(booster, artifact_path="models", registered_model_name='LightGBM')
             mlflow.log_params(model_config)    
+            log_training_rows(get_row_hashes(data['X'][data['train_index']], data['y'][data['train_index']]))
+            log_scaler_params(db_path, db_file_name)
 
             # predict the results on training dataset
-            y_pred=clf.predict(X_test)
+            y_pred = predict_churn_proba(booster, X_test).argmax(axis=1)
 
             # # view accuracy
             # acc=accuracy_score(y_pred, y_test)
@@ -745,32 +1099,7 @@ def get_train_model(db_path,db_file_name,drfit_db_name):
             
             
             #Log metrics
-            acc=accuracy_score(y_pred, y_test)
-            conf_mat = confusion_matrix(y_pred, y_test)
-            precision = precision_score(y_pred, y_test,average= 'macro')
-            recall = recall_score(y_pred, y_test, average= 'macro')
-            f1 = f1_score(y_pred, y_test, average='macro')
-            cm = confusion_matrix(y_test, y_pred)
-            tn = cm[0][0]
-            fn = cm[1][0]
-            tp = cm[1][1]
-            fp = cm[0][1]
-            class_zero = precision_recall_fscore_support(y_test, y_pred, average='binary',pos_label=0)
-            class_one = precision_recall_fscore_support(y_test, y_pred, average='binary',pos_label=1)
-
-            mlflow.log_metric('test_accuracy', acc)
-            mlflow.log_metric("f1", f1)
-            mlflow.log_metric("Precision", precision)
-            mlflow.log_metric("Recall", recall)
-            mlflow.log_metric("Precision_0", class_zero[0])
-            mlflow.log_metric("Precision_1", class_one[0])
-            mlflow.log_metric("Recall_0", class_zero[1])
-            mlflow.log_metric("Recall_1", class_one[1])
-            mlflow.log_metric("f1_0", class_zero[2])
-            mlflow.log_metric("f1_1", class_one[2])
-            mlflow.log_metric("False Negative", fn)
-            mlflow.log_metric("True Negative", tn)
-            # mlflow.log_metric("f1", f1_score)
+            log_test_metrics(y_test, y_pred)
 
             runID = run.info.run_uuid
             print("Inside MLflow Run with id {}".format(runID))
@@ -778,70 +1107,190 @@ def get_train_model(db_path,db_file_name,drfit_db_name):
         print("Not Required......Skipping")
 
 
+def log_test_metrics(y_test, y_pred, prefix=''):
+    acc=accuracy_score(y_pred, y_test)
+    conf_mat = confusion_matrix(y_pred, y_test)
+    precision = precision_score(y_pred, y_test,average= 'macro')
+    recall = recall_score(y_pred, y_test, average= 'macro')
+    f1 = f1_score(y_pred, y_test, average='macro')
+    cm = confusion_matrix(y_test, y_pred)
+    tn = cm[0][0]
+    fn = cm[1][0]
+    tp = cm[1][1]
+    fp = cm[0][1]
+    class_zero = precision_recall_fscore_support(y_test, y_pred, average='binary',pos_label=0)
+    class_one = precision_recall_fscore_support(y_test, y_pred, average='binary',pos_label=1)
+
+    mlflow.log_metric(prefix + 'test_accuracy', acc)
+    mlflow.log_metric(prefix + "f1", f1)
+    mlflow.log_metric(prefix + "Precision", precision)
+    mlflow.log_metric(prefix + "Recall", recall)
+    mlflow.log_metric(prefix + "Precision_0", class_zero[0])
+    mlflow.log_metric(prefix + "Precision_1", class_one[0])
+    mlflow.log_metric(prefix + "Recall_0", class_zero[1])
+    mlflow.log_metric(prefix + "Recall_1", class_one[1])
+    mlflow.log_metric(prefix + "f1_0", class_zero[2])
+    mlflow.log_metric(prefix + "f1_1", class_one[2])
+    mlflow.log_metric(prefix + "False Negative", fn)
+    mlflow.log_metric(prefix + "True Negative", tn)
+    return {'test_accuracy': acc, 'f1': f1}
+
+
+# Hyperparameter tuning engines of get_train_model_hptune. Each one takes db_path,
+# db_file_name, the cached training data (get_training_dataset) and the search space,
+# and returns the best estimator refit on all of X with its cross validated f1 score.
+TUNING_SEARCH_SPACE = {
+    'learning_rate': [0.005, 0.01,0.1],
+    'n_estimators': [8,16,24,50],
+    'num_leaves': [6,8,12,16], # large num_leaves helps improve accuracy but might lead to over-fitting
+    'boosting_type' : ['gbdt', 'dart'], # for better accuracy -> try dart
+    'objective' : ['binary'],
+    'max_bin':[255, 510], # large max_bin helps improve accuracy but might slow down training progress
+    'random_state' : [500],
+    'colsample_bytree' : [0.64, 0.65, 0.66],
+    'subsample' : [0.7,0.75],
+    'reg_alpha' : [1,1.2],
+    'reg_lambda' : [1,1.2,1.4],
+    'max_depth': [1,3,5]
+    }
+
+# successive halving: TUNING_CANDIDATES configurations are sampled from the search space
+# and cross validated with TUNING_MAX_ROUNDS / TUNING_ETA**k boosting rounds, the best
+# 1/TUNING_ETA of them move up to TUNING_ETA times more rounds until the last rung runs
+# TUNING_MAX_ROUNDS. Every fold stops early once the validation f1 hasn't improved
+# for TUNING_EARLY_STOPPING_ROUNDS rounds, and no new trial starts after
+# TUNING_TIME_BUDGET seconds (the best configuration of the highest rung reached wins,
+# at least one configuration is always cross validated).
+# The rounds are the budget, so n_estimators is set from the early stopped folds, and
+# dart is left out since it can't stop early.
+TUNING_ENGINE = 'successive_halving'
+TUNING_CANDIDATES = 81
+TUNING_ETA = 3
+TUNING_MAX_ROUNDS = 450
+TUNING_EARLY_STOPPING_ROUNDS = 20
+TUNING_N_SPLITS = 3
+TUNING_TIME_BUDGET = 1800
+
+def bayes_search(db_path, db_file_name, data, search_space):
+    X = pd.DataFrame(data['X'], columns=data['feature_names'])
+    y = pd.Series(data['y'], name='is_churn')
+
+    categoricals = []
+    indexes_of_categories = [X.columns.get_loc(col) for col in categoricals]
+
+    gkf = StratifiedKFold(n_splits=5, shuffle=True, random_state=42).split(X, y) # startifyKFold 
+
+    model_params = {
+        'objective':'binary', 
+        'metric':'f1',
+        'categorical_feature':indexes_of_categories,
+        'verbose':-1,
+        'force_row_wise':True
+                   }
+
+    lgb_estimator = lgb.LGBMClassifier()
+    lgb_estimator.set_params(**model_params)
+
+    gsearch = BayesSearchCV(estimator=lgb_estimator, search_spaces=search_space, cv=gkf,n_iter=32,random_state=0,n_jobs=-1,verbose=-1,scoring='f1')
+    lgb_model = gsearch.fit(X, y)
+    return lgb_model.best_estimator_, lgb_model.best_score_
+
+def successive_halving_search(db_path, db_file_name, data, search_space, n_candidates=TUNING_CANDIDATES,
+                              eta=TUNING_ETA, max_rounds=TUNING_MAX_ROUNDS, time_budget=TUNING_TIME_BUDGET,
+                              random_state=0):
+    start = time.perf_counter()
+    search_space = {**search_space, 'boosting_type': [b for b in search_space['boosting_type'] if b != 'dart']}
+    candidates = list(sklearn.model_selection.ParameterSampler(
+        {p: values for p, values in search_space.items() if p != 'n_estimators'}, n_candidates, random_state=random_state))
+
+    # the folds are subsets of the cached binned training split, one per max_bin
+    train_index = data['train_index']
+    folds = list(StratifiedKFold(n_splits=TUNING_N_SPLITS, shuffle=True, random_state=42)
+                 .split(train_index, data['y'][train_index]))
+    train_sets = {}
+
+    n_rungs = int(np.floor(np.log(n_candidates) / np.log(eta))) + 1
+    results = []
+    for rung in range(n_rungs):
+        rounds = int(max_rounds / eta ** (n_rungs - 1 - rung))
+        rung_results = []
+        for params in candidates:
+            # the first trial always runs, so there is a configuration to return
+            if (results or rung_results) and time.perf_counter() - start > time_budget:
+                print(f"Tuning time budget of {time_budget}s spent in rung {rung}")
+                break
+            if params['max_bin'] not in train_sets:
+                train_sets[params['max_bin']] = get_training_dataset(
+                    db_path, db_file_name, {'max_bin': params['max_bin']})['train_set']
+            score, best_iteration = cross_validate_rounds(train_sets[params['max_bin']], folds, params, rounds)
+            rung_results.append((score, best_iteration, params))
+        if not rung_results:
+            break
+        results = sorted(rung_results, key=lambda result: result[0], reverse=True)
+        print(f"Rung {rung}: {len(rung_results)} configurations with {rounds} rounds, best f1 {results[0][0]:.4f}")
+        candidates = [params for _, _, params in results[:max(len(results) // eta, 1)]]
+
+    best_score, best_iteration, best_params = results[0]
+    best_model = lgb.LGBMClassifier(n_estimators=best_iteration, verbose=-1, force_row_wise=True, **best_params)
+    best_model.fit(pd.DataFrame(data['X'], columns=data['feature_names']), data['y'])
+    print(f"Successive halving done in {time.perf_counter() - start:.1f}s")
+    return best_model, best_score
+
+def cross_validate_rounds(train_set, folds, params, rounds):
+    # mean validation f1 of the folds at their early stopped iteration, and the mean best iteration
+    params = {p: value for p, value in params.items() if p != 'max_bin'}
+    params.update({'metric': 'None', 'verbose': -1, 'force_row_wise': True})
+    scores, best_iterations = [], []
+    for fold_train, fold_valid in folds:
+        booster = lgb.train(params, train_set.subset(fold_train), num_boost_round=rounds,
+                            valid_sets=[train_set.subset(fold_valid)], feval=f1_eval,
+                            callbacks=[lgb.early_stopping(TUNING_EARLY_STOPPING_ROUNDS, verbose=False)])
+        scores.append(booster.best_score['valid_0']['f1'])
+        best_iterations.append(booster.best_iteration)
+    return np.mean(scores), max(int(np.mean(best_iterations)), 1)
+
+def f1_eval(preds, eval_data):
+    # the f1 BayesSearchCV scores with (scoring='f1'), as a LightGBM validation metric
+    return 'f1', f1_score(eval_data.get_label(), preds > 0.5), True
+
+# the name of the mlflow run and the search function of every tuning engine
+TUNING_ENGINES = {'bayes': ('LGBM_Bayes_Search', bayes_search),
+                  'successive_halving': ('LGBM_Successive_Halving', successive_halving_search)}
+
+@instrument_stage(input_table='X')
 def get_train_model_hptune(db_path,db_file_name,drfit_db_name):
     cnx_drift = sqlite3.connect(db_path+drfit_db_name)
     process_flags = pd.read_sql('select * from process_flags', cnx_drift)
     
     if process_flags['Model_Training_hpTunning'][0] == 1:
-        cnx = sqlite3.connect(db_path+db_file_name)
-        X = pd.read_sql('select * from X', cnx)
-        y = pd.read_sql('select * from y', cnx)
-        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size = 0.3, random_state = 0)
-
-
-        categoricals = []
-        indexes_of_categories = [train.columns.get_loc(col) for col in categoricals]
-
-         #Model Training
-        gkf = StratifiedKFold(n_splits=5, shuffle=True, random_state=42).split(X, y) # startifyKFold 
-
-        gridParams = {
-            'learning_rate': [0.005, 0.01,0.1],
-            'n_estimators': [8,16,24,50],
-            'num_leaves': [6,8,12,16], # large num_leaves helps improve accuracy but might lead to over-fitting
-            'boosting_type' : ['gbdt', 'dart'], # for better accuracy -> try dart
-            'objective' : ['binary'],
-            'max_bin':[255, 510], # large max_bin helps improve accuracy but might slow down training progress
-            'random_state' : [500],
-            'colsample_bytree' : [0.64, 0.65, 0.66],
-            'subsample' : [0.7,0.75],
-            'reg_alpha' : [1,1.2],
-            'reg_lambda' : [1,1.2,1.4],
-            'max_depth': [1,3,5]
-            }
+        data = get_training_dataset(db_path, db_file_name)
+        X = pd.DataFrame(data['X'], columns=data['feature_names'])
+        y = pd.Series(data['y'], name='is_churn')
+        X_test, y_test = X.iloc[data['test_index']], y.iloc[data['test_index']]
+
 
-        model_params = {
-            'objective':'binary', 
-            'num_boost_round':200, 
-            'metric':'f1',
-            'categorical_feature':indexes_of_categories,
-            'verbose':-1,
-            'force_row_wise':True
-                       }
-
-        lgb_estimator = lgb.LGBMClassifier()
-        lgb_estimator.set_params(**model_params)
-
-        gsearch = BayesSearchCV(estimator=lgb_estimator, search_spaces=gridParams, cv=gkf,n_iter=32,random_state=0,n_jobs=-1,verbose=-1,scoring='f1')
-        lgb_model = gsearch.fit(X, y)
-        best_model = lgb_model.best_estimator_
-        f1_score = lgb_model.best_score_
-        for p in gridParams:
+        #Model Training
+        run_name, search = TUNING_ENGINES[TUNING_ENGINE]
+        best_model, f1_score = search(db_path, db_file_name, data, TUNING_SEARCH_SPACE)
+        for p in TUNING_SEARCH_SPACE:
             print(f"Best {p} : {best_model.get_params()[p]}")
 
 
         timestamp = str(int(time.time()))
-        with mlflow.start_run(run_name=f"LGBM_Bayes_Search_{timestamp}") as run:
+        with mlflow.start_run(run_name=f"{run_name}_{timestamp}") as run:
             y_pred = best_model.predict(X_test)
 
             # Log model
             mlflow.sklearn.log_model(best_model,registered_model_name='LightGBM',artifact_path='models')
+            # the best estimator is refit on all the rows of X
+            log_training_rows(get_row_hashes(data['X'], data['y']))
+            log_scaler_params(db_path, db_file_name)
             # mlflow.mlflow_log_artifact(best_model, artifact_path ="sqlite:///database/mlflow_v01.db")
 
 
             # Log params
             model_params = best_model.get_params()
-            [mlflow.log_param(p, model_params[p]) for p in gridParams]
+            [mlflow.log_param(p, model_params[p]) for p in TUNING_SEARCH_SPACE]
 
             #Log metrics
             acc=accuracy_score(y_pred, y_test)
@@ -877,29 +1326,155 @@ def get_train_model_hptune(db_path,db_file_name,drfit_db_name):
         print("Not Required......Skipping")
     
 
+# Incremental retraining (opt-in): with INCREMENTAL_RETRAINING the Production model is
+# boosted further on the new rows of X only (init_model) in the 10-20 drift band, instead
+# of retraining on all of X. Every registered model logs the hashes of the rows it was
+# trained on, the new rows are the training rows of X it hasn't seen, and the scale of X,
+# which the new X is prepared with.
+INCREMENTAL_RETRAINING = False
+INCREMENTAL_BOOST_ROUNDS = 20
+# also fit a full retrain on the same split and log its metrics (prefixed 'full_retrain_')
+# with the incremental model's, to compare them while evaluating incremental retraining.
+# Off by default, the full retrain costs what incremental retraining saves
+INCREMENTAL_EVALUATE_FULL_RETRAIN = False
+TRAINING_ROWS_ARTIFACT = 'training_rows.npy'
+SCALER_PARAMS_ARTIFACT = 'scaler_params.csv'
+
+def get_row_hashes(X, y):
+    return pd.util.hash_pandas_object(pd.DataFrame(X).assign(is_churn=y), index=False).to_numpy()
+
+def log_training_rows(row_hashes):
+    with tempfile.TemporaryDirectory() as directory:
+        file_path = os.path.join(directory, TRAINING_ROWS_ARTIFACT)
+        np.save(file_path, np.unique(row_hashes))
+        mlflow.log_artifact(file_path)
+
+def load_training_rows(run_id):
+    # None for models registered before the training rows were logged
+    try:
+        return np.load(mlflow.artifacts.download_artifacts(run_id=run_id, artifact_path=TRAINING_ROWS_ARTIFACT))
+    except (mlflow.exceptions.MlflowException, OSError):
+        return None
+
+def log_scaler_params(db_path, db_file_name):
+    # X prepared before the scale was saved has none to log
+    cnx = connect_db(db_path, db_file_name)
+    try:
+        if not check_if_table_has_value(cnx, 'scaler_params'):
+            return
+        scaler_params = read_table(cnx, 'scaler_params')
+    finally:
+        cnx.close()
+    with tempfile.TemporaryDirectory() as directory:
+        file_path = os.path.join(directory, SCALER_PARAMS_ARTIFACT)
+        scaler_params.to_csv(file_path, index=False)
+        mlflow.log_artifact(file_path)
+
+def load_model_scaler_params(model_name, stage):
+    model_versions = mlflow.tracking.MlflowClient().get_latest_versions(model_name, stages=[stage])
+    if not model_versions:
+        raise ValueError(f"No {stage} version of {model_name} to scale X like, run a full retrain (Model_Training_plain)")
+    try:
+        return pd.read_csv(mlflow.artifacts.download_artifacts(run_id=model_versions[0].run_id,
+                                                               artifact_path=SCALER_PARAMS_ARTIFACT))
+    except (mlflow.exceptions.MlflowException, OSError):
+        raise ValueError(f"No scaler params logged with {model_name} version {model_versions[0].version}, "
+                         f"run a full retrain (Model_Training_plain)")
+
+@instrument_stage(input_table='X')
+def get_train_model_incremental(db_path,db_file_name,drfit_db_name,model_name='LightGBM',stage='Production'):
+    cnx_drift = sqlite3.connect(db_path+drfit_db_name)
+    process_flags = pd.read_sql('select * from process_flags', cnx_drift)
+
+    if process_flags.get('Model_Training_incremental', pd.Series([0]))[0] == 1:
+        model_versions = mlflow.tracking.MlflowClient().get_latest_versions(model_name, stages=[stage])
+        if not model_versions:
+            print(f"No {stage} version of {model_name} to boost further......Skipping")
+            return
+        model_version = model_versions[0]
+        production_model = load_churn_model(f"models:/{model_name}/{model_version.version}")
+        init_model = getattr(production_model, 'booster_', production_model)
+
+        data = get_training_dataset(db_path, db_file_name)
+        if init_model.feature_name() != data['feature_names']:
+            raise ValueError(f"The features of X don't match the features of {model_name} version "
+                             f"{model_version.version}, run a full retrain (Model_Training_plain)")
+
+        row_hashes = get_row_hashes(data['X'], data['y'])
+        trained_rows = load_training_rows(model_version.run_id)
+        if trained_rows is None:
+            print(f"No training rows logged for {model_name} version {model_version.version}, using all of X")
+            trained_rows = np.array([], dtype=row_hashes.dtype)
+        seen = np.isin(row_hashes, trained_rows)
+        new_index = data['train_index'][~seen[data['train_index']]]
+        # the rows the Production model was trained on are left out of the evaluation as well
+        test_index = data['test_index'][~seen[data['test_index']]]
+        print(f"{len(new_index)} new training rows out of {len(data['train_index'])}")
+        if len(new_index) == 0:
+            print("No new rows to train on......Skipping")
+            return
+
+        params = get_booster_params(MODEL_CONFIG)
+        dataset_params = {**DATASET_PARAMS, **get_dataset_params(MODEL_CONFIG)}
+        X_test = pd.DataFrame(data['X'][test_index], columns=data['feature_names'])
+        y_test = data['y'][test_index]
+
+        with mlflow.start_run(run_name='run_LightGB_incremental') as run:
+            start = time.perf_counter()
+            new_set = lgb.Dataset(data['X'][new_index], label=data['y'][new_index],
+                                  feature_name=data['feature_names'], params=dataset_params)
+            booster = lgb.train(params, new_set, num_boost_round=INCREMENTAL_BOOST_ROUNDS, init_model=init_model)
+            fit_seconds = time.perf_counter() - start
+
+            mlflow.lightgbm.log_model(booster, artifact_path="models", registered_model_name=model_name)
+            mlflow.log_params({**MODEL_CONFIG, 'init_model_version': model_version.version,
+                               'incremental_boost_rounds': INCREMENTAL_BOOST_ROUNDS, 'new_rows': len(new_index)})
+            log_training_rows(np.concatenate([trained_rows, row_hashes[new_index]]))
+            log_scaler_params(db_path, db_file_name)
+            mlflow.log_metric('fit_seconds', fit_seconds)
+            metrics = log_test_metrics(y_test, predict_churn_proba(booster, X_test).argmax(axis=1))
+
+            if INCREMENTAL_EVALUATE_FULL_RETRAIN:
+                start = time.perf_counter()
+                train_index = data['train_index']
+                full_set = lgb.Dataset(data['X'][train_index], label=data['y'][train_index],
+                                       feature_name=data['feature_names'], params=dataset_params)
+                full_booster = lgb.train(params, full_set, num_boost_round=MODEL_CONFIG['n_estimators'])
+                mlflow.log_metric('full_retrain_fit_seconds', time.perf_counter() - start)
+                full_metrics = log_test_metrics(y_test, predict_churn_proba(full_booster, X_test).argmax(axis=1),
+                                                prefix='full_retrain_')
+                print(f"Incremental f1 {metrics['f1']:.4f} vs full retrain f1 {full_metrics['f1']:.4f}")
+
+            runID = run.info.run_id
+            print("Inside MLflow Run with id {}".format(runID))
+    else:
+        print("Not Required......Skipping")
+
+
 #'runs:/e220f226ee624a79996e049c81924ec1/models' example:
+@instrument_stage(input_table='X', output_table='predictions')
 def get_predict(db_path,db_file_name,ml_flow_path,drfit_db_name):
     cnx_drift = sqlite3.connect(db_path+drfit_db_name)
     process_flags = pd.read_sql('select * from process_flags', cnx_drift)
     
     if process_flags['Prediction'][0] == 1:
         mlflow.set_tracking_uri("http://0.0.0.0:6006")
-        cnx = sqlite3.connect(db_path+db_file_name)
+        cnx = connect_db(db_path, db_file_name)
         logged_model = ml_flow_path
         # Load model as a PyFuncModel.
-        loaded_model = mlflow.sklearn.load_model(logged_model)
+        loaded_model = load_churn_model(logged_model)
         # Predict on a Pandas DataFrame.
-        X = pd.read_sql('select * from X', cnx)
-        predictions_proba = loaded_model.predict_proba(pd.DataFrame(X))
-        predictions = loaded_model.predict(pd.DataFrame(X))
+        X = read_table(cnx, 'X')
+        predictions_proba = predict_churn_proba(loaded_model, pd.DataFrame(X))
+        predictions = predictions_proba.argmax(axis=1)
         pred_df = X.copy()
         
         pred_df['churn'] = predictions
         pred_df[["Prob of Not Churn","Prob of Churn"]] = predictions_proba
-        index_msno_mapping = pd.read_sql('select * from index_msno_mapping', cnx)
+        index_msno_mapping = read_table(cnx, 'index_msno_mapping')
         pred_df['index_for_map'] = pred_df.index
         final_pred_df = pred_df.merge(index_msno_mapping, on='index_for_map') 
-        final_pred_df.to_sql(name='predictions', con=cnx,if_exists='replace',index=False)
+        write_table(cnx, 'predictions', final_pred_df)
         print (pd.DataFrame(predictions_proba,columns=["Prob of Not Churn","Prob of Churn"]).head()) 
         # pd.DataFrame(predictions,columns=["Prob of Not Churn","Prob of Churn"]).to_sql(name='Final_Predictions', con=cnx,if_exists='replace',index=False)
         return "Predictions are done and save in Final_Predictions Table"
@@ -927,6 +1502,7 @@ def get_reset_process_flags():
             'Data_Preparation': 0, 
             'Model_Training_plain': 0, 
             'Model_Training_hpTunning':0,
+            'Model_Training_incremental':0,
             'Prediction':0
            }
 
@@ -941,6 +1517,7 @@ def get_reset_process_flags_flip():
             'Data_Preparation': 1, 
             'Model_Training_plain': 1, 
             'Model_Training_hpTunning':1,
+            'Model_Training_incremental':1,
             'Prediction':1
            }
 
@@ -949,12 +1526,12 @@ def get_flush_db_process_flags(db_path,drfit_db_name,flip=True):
         cnx = sqlite3.connect(db_path+drfit_db_name)
         process_flags = get_reset_process_flags_flip()
         process_flags_df = pd.DataFrame(process_flags,index=[0])
-        process_flags_df.to_sql(name='process_flags', con=cnx, if_exists='replace', index=False)
+        write_table(cnx, 'process_flags', process_flags_df)
     else:
         cnx = sqlite3.connect(db_path+drfit_db_name)
         process_flags = get_reset_process_flags()
         process_flags_df = pd.DataFrame(process_flags,index=[0])
-        process_flags_df.to_sql(name='process_flags', con=cnx, if_exists='replace', index=False)
+        write_table(cnx, 'process_flags', process_flags_df)
 
 def get_difference(df):
     percnt_df = get_change(df['new'], df['old'])
@@ -990,7 +1567,7 @@ def get_data_drift(current_data, old_data, column_list,exclude_list, cnx, metric
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     df['time'] = timestamp
     print(df)
-    df.to_sql(name='drift_df', con=cnx, if_exists='append', index=False)
+    write_table(cnx, 'drift_df', df, if_exists='append')
     
     if metric == 'std':
         return np.mean(std_deviation_percentage)
@@ -1004,29 +1581,20 @@ def get_drift(old_data_directory,new_data_directory,db_path,drfit_db_name,
     
     #New Data 
     march_user_logs, march_transactions = get_new_data_appended(old_data_directory,new_data_directory, start_data, end_date)
-    march_user_logs, pre_size, post_size = compress_dataframes([march_user_logs])[0]
-    march_transactions, pre_size, post_size = compress_dataframes([march_transactions])[0]
 
     #Old Data 
     transactions = load_data( [f"{old_data_directory}transactions_logs.csv",
                        ]
                      )[0]
-    transactions['transaction_date'] = fix_time_in_df(transactions, 'transaction_date', expand=False)
-    transactions['membership_expire_date'] = fix_time_in_df(transactions, 'membership_expire_date', expand=False)
 
-    
     user_logs = load_data( [f"{old_data_directory}userlogs.csv",
                        ]
                      )[0]
-    user_logs['date'] = fix_time_in_df(user_logs, 'date', expand=False)
-    
-    transactions, pre_size, post_size = compress_dataframes([transactions])[0]
-    user_logs, pre_size, post_size = compress_dataframes([user_logs])[0]
 
     #Print Statements
-    column_list_tran = list(transactions.select_dtypes(include=['int8','int16','int32','float16']).columns)
+    column_list_tran = list(transactions.select_dtypes(include=['int8','int16','int32','float16','float32']).columns)
     print(column_list_tran)
-    column_list_userlogs = list(user_logs.select_dtypes(include=['int8','int16','int32','float16']).columns)
+    column_list_userlogs = list(user_logs.select_dtypes(include=['int8','int16','int32','float16','float32']).columns)
     print(column_list_tran)
     exclude_list_tran = ['date'] 
     exclude_list_user_log = ['transaction_date','membership_expire_date']
@@ -1072,7 +1640,7 @@ def get_drift(old_data_directory,new_data_directory,db_path,drfit_db_name,
     print(drift)
     #Building & Checking Databases
     # build_dbs(db_path, drfit_db_name)
-    drift.to_sql(name='drift', con=cnx, if_exists='replace', index=False)
+    write_table(cnx, 'drift', drift)
     print("Writing to Database Done... at", db_path+drfit_db_name)
     get_drift_trigger(db_path, drfit_db_name)
 
@@ -1090,6 +1658,7 @@ def get_drift_trigger(db_path, drfit_db_name):
     
     # 0-10 --> No Change. Just Inference/predictions
     # 10-20 --> Previos Model just retrained on New Data. Old Data + New Data 
+    #           (or boosted further on the New Data only, with INCREMENTAL_RETRAINING)
     # 20-30 --> Hyper Parameter Tunning on same model.
     # 30+   --> Repeat Notebook
     
@@ -1104,7 +1673,10 @@ def get_drift_trigger(db_path, drfit_db_name):
         process_flags['process_userlogs'] = 1
         process_flags['merge_data'] = 1
         process_flags['Data_Preparation'] = 1
-        process_flags['Model_Training_plain'] = 1
+        if INCREMENTAL_RETRAINING:
+            process_flags['Model_Training_incremental'] = 1
+        else:
+            process_flags['Model_Training_plain'] = 1
     
     elif drift_value >= 20 and drift_value <=30:
         process_flags['load_data'] = 1
@@ -1119,7 +1691,7 @@ def get_drift_trigger(db_path, drfit_db_name):
         
     print ("After Change process_flags", process_flags) 
     process_flags_df = pd.DataFrame(process_flags,index=[0])
-    process_flags_df.to_sql(name='process_flags', con=cnx, if_exists='replace', index=False)
+    write_table(cnx, 'process_flags', process_flags_df)
         
         
         